@@ -2,7 +2,9 @@
 # auth_web.py
 
 import threading
-import os
+import json
+import datetime
+from concurrent.futures import ThreadPoolExecutor
 import logging
 from flask import Flask, request
 # --- ДОБАВЛЯЕМ ЭТОТ ИМПОРТ ---
@@ -12,12 +14,21 @@ import requests
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 import config
+import service_cache
+import credential_store
+import event_mirror
+import subject_registry
 
 # --- Настройки ---
 CLIENT_SECRETS_FILE = 'client_secret3.json' # Убедитесь, что ваш файл называется так
 SCOPES = ['https://www.googleapis.com/auth/calendar', 'https://www.googleapis.com/auth/drive.file']
+# Папка со старыми файлами token_{id}.json (нужна только для одноразового переноса в хранилище)
 TOKEN_DIR = '.venv/tokens'
 
+# Хранилище учетных данных всех пользователей: кэш в памяти поверх одной таблицы.
+# Создается в init_credential_store() при запуске бота, а не при импорте модуля.
+_credential_store = None
+
 app = Flask(__name__)
 
 # --- ДОБАВЛЯЕМ ЭТУ СТРОКУ ---
@@ -36,21 +47,32 @@ def get_google_auth_flow():
     )
 
 
+def init_credential_store():
+    """Создает хранилище, пакетно загружает токены всех пользователей в память и переносит старые файлы токенов."""
+    global _credential_store
+    _credential_store = credential_store.create_store(config.CREDENTIAL_STORE_BACKEND, config.CREDENTIAL_DB_PATH)
+    _credential_store.load_all()
+    _credential_store.import_token_files(TOKEN_DIR)
+
+
 def save_credentials(user_id, credentials):
-    """Сохраняет учетные данные пользователя в файл."""
-    if not os.path.exists(TOKEN_DIR):
-        os.makedirs(TOKEN_DIR)
-    token_path = os.path.join(TOKEN_DIR, f'token_{user_id}.json')
-    with open(token_path, 'w') as token_file:
-        token_file.write(credentials.to_json())
-
-
-def load_credentials(user_id):
-    """Загружает учетные данные пользователя из файла."""
-    token_path = os.path.join(TOKEN_DIR, f'token_{user_id}.json')
-    if os.path.exists(token_path):
-        creds = Credentials.from_authorized_user_file(token_path, SCOPES)
-        if creds and creds.expired and creds.refresh_token:
+    """Сохраняет учетные данные пользователя в хранилище."""
+    _credential_store.save(user_id, json.loads(credentials.to_json()))
+    # Клиенты, построенные со старым токеном, больше не нужны
+    service_cache.invalidate(user_id)
+
+
+def load_credentials(user_id, refresh_if_expired: bool = False):
+    """
+    Загружает учетные данные пользователя из хранилища.
+    Обычно токены заранее обновляет фоновая задача (refresh_expiring_credentials), поэтому
+    по умолчанию здесь нет сетевых запросов: просроченный токен при необходимости обновит
+    транспорт Google API. refresh_if_expired=True принудительно обновляет токен сразу.
+    """
+    token_info = _credential_store.get(user_id)
+    if token_info:
+        creds = Credentials.from_authorized_user_info(token_info, SCOPES)
+        if refresh_if_expired and creds and creds.expired and creds.refresh_token:
             try:
                 creds.refresh(Request())
                 save_credentials(user_id, creds)
@@ -61,11 +83,71 @@ def load_credentials(user_id):
     return None
 
 
+def refresh_credentials(user_id) -> bool:
+    """Обновляет токен пользователя и сохраняет его в хранилище."""
+    token_info = _credential_store.get(user_id)
+    if not token_info:
+        return False
+    creds = Credentials.from_authorized_user_info(token_info, SCOPES)
+    if not creds.refresh_token:
+        logging.warning(f"У пользователя {user_id} нет refresh_token, обновить токен невозможно.")
+        return False
+    creds.refresh(Request())
+    save_credentials(user_id, creds)
+    return True
+
+
+def refresh_expiring_credentials(margin_seconds: int, max_workers: int) -> tuple[list, list]:
+    """
+    Обновляет токены всех пользователей, срок действия которых истекает в ближайшие margin_seconds.
+    Запросы к Google выполняются параллельно в пуле из max_workers потоков.
+    Возвращает списки (обновленные user_id, user_id с ошибкой обновления).
+    """
+    user_ids = list_user_ids()
+    if config.DEBUG_MODE:
+        user_ids.append("debug")
+
+    # Время в токенах Google хранится в UTC без часового пояса
+    deadline = datetime.datetime.utcnow() + datetime.timedelta(seconds=margin_seconds)
+    expiring = []
+    for user_id in user_ids:
+        token_info = _credential_store.get(user_id)
+        if not token_info:
+            continue
+        expiry = Credentials.from_authorized_user_info(token_info, SCOPES).expiry
+        if expiry is None or expiry <= deadline:
+            expiring.append(user_id)
+
+    if not expiring:
+        return [], []
+
+    refreshed, failed = [], []
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='token-refresh') as executor:
+        futures = {executor.submit(refresh_credentials, user_id): user_id for user_id in expiring}
+        for future, user_id in futures.items():
+            try:
+                if future.result():
+                    refreshed.append(user_id)
+                else:
+                    failed.append(user_id)
+            except Exception as e:
+                logging.error(f"Не удалось обновить токен для user_id {user_id}: {e}")
+                failed.append(user_id)
+
+    return refreshed, failed
+
+
 def delete_credentials(user_id):
-    """Удаляет файл с учетными данными пользователя."""
-    token_path = os.path.join(TOKEN_DIR, f'token_{user_id}.json')
-    if os.path.exists(token_path):
-        os.remove(token_path)
+    """Удаляет учетные данные пользователя из хранилища."""
+    _credential_store.delete(user_id)
+    service_cache.invalidate(user_id)
+    event_mirror.invalidate(user_id)
+    subject_registry.forget_user(user_id)
+
+
+def list_user_ids() -> list[int]:
+    """Возвращает ID всех пользователей, у которых есть сохраненные учетные данные."""
+    return _credential_store.list_user_ids()
 
 
 @app.route('/oauth2callback')
@@ -83,6 +165,8 @@ def oauth2callback():
         flow.fetch_token(authorization_response=request.url)
         credentials = flow.credentials
         save_credentials(user_id, credentials)
+        # Пользователь мог войти в другой аккаунт Google: старая копия календаря больше не годится
+        event_mirror.invalidate(user_id)
 
         try:
             requests.post(config.BOT_CALLBACK_URL, json={'user_id': str(user_id)}, timeout=5)
@@ -0,0 +1,123 @@
+# bench_render.py
+"""
+Сравнивает старый (pixmap -> PIL -> JPEG -> copy -> thumbnail -> JPEG) и новый (JPEG прямо из pixmap
+в нужном размере) способы подготовки изображений страниц для конспекта.
+
+Каждый замер выполняется в отдельном процессе: память pixmap и PIL выделяется в нативном коде и не видна
+tracemalloc, поэтому сравнивается пиковый RSS процесса (ru_maxrss). Оба пути прогреваются, а порядок
+запуска чередуется между раундами, чтобы кэш файла и ОС не давал преимущества одному из них.
+
+Запуск: python bench_render.py учебник.pdf [--pages 10] [--rounds 3] [--no-previews]
+"""
+import io
+import sys
+import json
+import time
+import argparse
+import resource
+import statistics
+import subprocess
+import fitz  # PyMuPDF
+import page_render
+
+
+def render_legacy(page, settings: dict, with_previews: bool) -> tuple[bytes, bytes]:
+    """Прежний путь рендера из generate_summary_from_pdf (HQ рендерится всегда)."""
+    from PIL import Image
+
+    pix = page.get_pixmap(dpi=settings['hq_dpi'])
+    img_high_quality = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+
+    buffer_for_user = io.BytesIO()
+    img_high_quality.save(buffer_for_user, format="JPEG", quality=settings['hq_quality'])
+
+    img_low_quality = img_high_quality.copy()
+    img_low_quality.thumbnail((settings['lq_max_size'], settings['lq_max_size']))
+    buffer_for_ai = io.BytesIO()
+    img_low_quality.save(buffer_for_ai, format="JPEG", quality=settings['lq_quality'])
+    return buffer_for_user.getvalue(), buffer_for_ai.getvalue()
+
+
+def render_current(page, settings: dict, with_previews: bool) -> tuple[bytes | None, bytes]:
+    hq_image = page_render.render_hq_image(page, settings) if with_previews else None
+    return hq_image, page_render.render_lq_image(page, settings)
+
+
+RENDERERS = {'старый': render_legacy, 'новый': render_current}
+
+
+def _max_rss_kb() -> int:
+    """Пиковый RSS текущего процесса в КБ (в Linux ru_maxrss уже в КБ)."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_worker(name: str, pdf_path: str, page_limit: int, with_previews: bool):
+    """Один замер в чистом процессе; результат печатается в stdout одной строкой JSON."""
+    render = RENDERERS[name]
+    settings = page_render._current_settings()
+    with fitz.open(pdf_path) as doc:
+        pages = list(range(1, min(page_limit, doc.page_count) + 1))
+        # Прогрев: первый рендер подгружает шрифты, ресурсы документа и библиотеки этого пути
+        render(doc.load_page(0), settings, with_previews)
+        baseline_kb = _max_rss_kb()
+
+        started_at = time.perf_counter()
+        lq_bytes = 0
+        for page_num in pages:
+            _, lq_image = render(doc.load_page(page_num - 1), settings, with_previews)
+            lq_bytes += len(lq_image)
+        elapsed = time.perf_counter() - started_at
+
+    print(json.dumps({
+        'pages': len(pages),
+        'per_page_ms': elapsed * 1000 / max(len(pages), 1),
+        'max_rss_kb': _max_rss_kb(),
+        'growth_kb': _max_rss_kb() - baseline_kb,
+        'lq_bytes': lq_bytes,
+    }))
+
+
+def measure(name: str, args) -> dict:
+    command = [sys.executable, __file__, args.pdf_path, '--pages', str(args.pages), '--worker', name]
+    if args.no_previews:
+        command.append('--no-previews')
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк рендера страниц для конспекта")
+    parser.add_argument('pdf_path')
+    parser.add_argument('--pages', type=int, default=10, help="сколько первых страниц рендерить")
+    parser.add_argument('--rounds', type=int, default=3, help="сколько раз замерить каждый путь")
+    parser.add_argument('--no-previews', action='store_true', help="новый путь без HQ-версий")
+    parser.add_argument('--worker', choices=list(RENDERERS), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    with_previews = not args.no_previews
+    if args.worker:
+        run_worker(args.worker, args.pdf_path, args.pages, with_previews)
+        return
+
+    results = {name: [] for name in RENDERERS}
+    names = list(RENDERERS)
+    for round_num in range(args.rounds):
+        # Чередуем порядок: в нечетных раундах первым идет новый путь
+        for name in (names if round_num % 2 == 0 else names[::-1]):
+            results[name].append(measure(name, args))
+
+    if not results[names[0]][0]['pages']:
+        sys.exit("В документе нет страниц.")
+    print(f"Страниц: {results[names[0]][0]['pages']}, раундов: {args.rounds}, "
+          f"HQ-версии: {'да' if with_previews else 'нет'}")
+    for name, runs in results.items():
+        per_page_ms = statistics.median(run['per_page_ms'] for run in runs)
+        max_rss_kb = max(run['max_rss_kb'] for run in runs)
+        growth_kb = max(run['growth_kb'] for run in runs)
+        lq_bytes = runs[0]['lq_bytes']
+        print(f"{name:>7}: {per_page_ms:8.1f} мс/стр. (медиана), пик RSS {max_rss_kb / 1024:7.1f} МБ "
+              f"(+{growth_kb / 1024:.1f} МБ после прогрева), LQ всего {lq_bytes / 1024:7.1f} КБ")
+
+
+if __name__ == '__main__':
+    main()
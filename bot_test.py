@@ -7,30 +7,46 @@ import re
 import telegram
 import asyncio
 import time
+import threading
 
 import io
-import base64
-import fitz  # PyMuPDF
-from telegram import InputMediaPhoto
+import mimetypes
 from doc_formatter import format_docx
-from PIL import Image
 from openai import OpenAI
+import database
+import sheets_logger
 from sheets_logger import log_g_sheets
 from dotenv import load_dotenv
 from aiohttp import web
 from google.auth.transport.requests import Request
 from io import BytesIO
 from googleapiclient.http import MediaIoBaseUpload
-from googleapiclient.discovery import build
 from google.oauth2.credentials import Credentials
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, filters,
     ConversationHandler, CallbackContext, CallbackQueryHandler
 )
-from database import get_textbooks_by_subject, delete_textbook_by_id
+from database import get_textbooks_by_subject, get_textbook_by_file_id, delete_textbook_by_id, get_cached_summary, save_cached_summary, delete_cached_summaries
 import auth_web
 import config
+import service_cache
+import fanout
+import google_async
+import event_mirror
+import subject_registry
+import calendar_batch
+import textbook_cache
+import textbook_ingest
+import page_cache
+import page_render
+import summary_input
+import summary_queue
+import telegram_files
+import usage_ledger
+import usage_limits
+import uuid
+from googleapiclient.errors import HttpError
 from database import get_textbooks_by_subject
 
 load_dotenv()
@@ -115,40 +131,126 @@ def get_creds():
 
 def get_calendar_service(user_id: int):
     """
-    Создает сервис для работы с Google Calendar API для конкретного пользователя.
+    Возвращает сервис для работы с Google Calendar API для конкретного пользователя.
+    Готовые клиенты берутся из кэша service_cache, чтобы не строить их на каждое нажатие кнопки.
     """
-    if config.DEBUG_MODE:
-        creds = auth_web.load_credentials("debug")
-    else:
-        # В обычном режиме используем токен конкретного пользователя
-        creds = auth_web.load_credentials(user_id)
-
-    if not creds:
-        logger.warning(f"Не удалось загрузить учетные данные для user_id: {user_id}")
-        return None
-    try:
-        return build('calendar', 'v3', credentials=creds)
-    except Exception as e:
-        logger.error(f"Ошибка при создании сервиса календаря для user_id {user_id}: {e}")
-        return None
+    return _get_google_service(user_id, 'calendar', 'v3')
 
 def get_drive_service(user_id: int):
     """
-    Создает сервис для работы с Google Drive API для конкретного пользователя.
+    Возвращает сервис для работы с Google Drive API для конкретного пользователя.
+    """
+    return _get_google_service(user_id, 'drive', 'v3')
+
+
+async def get_calendar_service_async(user_id: int):
+    """Асинхронная версия get_calendar_service: клиент строится вне цикла событий."""
+    return await google_async.run(get_calendar_service, user_id)
+
+async def get_drive_service_async(user_id: int):
+    """Асинхронная версия get_drive_service: клиент строится вне цикла событий."""
+    return await google_async.run(get_drive_service, user_id)
+
+async def get_user_events(user_id: int, service, **filters) -> list:
+    """
+    Возвращает события пользователя из локальной копии календаря (см. event_mirror.list_events).
+    Запрос изменений у Google, если он нужен, выполняется вне цикла событий.
+    """
+    return await google_async.run(event_mirror.list_events, user_id, service, **filters)
+
+
+class TelegramProgress:
+    """
+    Прогресс долгой фоновой операции: вызывается из рабочих потоков как progress_callback(done, total)
+    и не чаще раза в SCHEDULE_PROGRESS_INTERVAL_SECONDS редактирует сообщение в Telegram.
+    """
+
+    def __init__(self, message, text: str, loop):
+        self.message = message
+        self.text = text
+        self.loop = loop
+        self._last_update = 0.0
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def __call__(self, done: int, total: int):
+        with self._lock:
+            now = time.monotonic()
+            if done >= total or now - self._last_update < config.SCHEDULE_PROGRESS_INTERVAL_SECONDS:
+                return
+            self._last_update = now
+            coroutine = self._edit(f"{self.text}... Готово {done} из {total}.")
+            self._futures.append(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    async def _edit(self, text: str):
+        try:
+            await self.message.edit_text(text)
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось обновить сообщение с прогрессом: {e}")
+
+    async def wait(self):
+        """Дожидается отправки всех обновлений, чтобы итоговое сообщение не было перезаписано прогрессом."""
+        if self._futures:
+            await asyncio.gather(*(asyncio.wrap_future(future) for future in self._futures), return_exceptions=True)
+
+
+class StreamingPreview:
     """
-    # Используем новую функцию из auth_web для загрузки учетных данных
+    Показывает ответ модели по мере генерации: вызывается из рабочего потока как on_partial(text)
+    и не чаще раза в SUMMARY_STREAM_EDIT_INTERVAL_SECONDS редактирует статусное сообщение.
+    Текст показывается без разметки: до конца ответа она может быть незакрытой.
+    """
+
+    def __init__(self, message, loop):
+        self.message = message
+        self.loop = loop
+        self._last_update = 0.0
+        self._futures = []
+        self._lock = threading.Lock()
+
+    def __call__(self, text: str):
+        with self._lock:
+            now = time.monotonic()
+            if now - self._last_update < config.SUMMARY_STREAM_EDIT_INTERVAL_SECONDS:
+                return
+            self._last_update = now
+            if len(text) > config.SUMMARY_STREAM_PREVIEW_CHARS:
+                text = text[:config.SUMMARY_STREAM_PREVIEW_CHARS] + "…"
+            coroutine = self._edit(f"✍️ Пишу конспект...\n\n{text}")
+            self._futures.append(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    async def _edit(self, text: str):
+        try:
+            await self.message.edit_text(text)
+        except telegram.error.TelegramError as e:
+            logger.warning(f"Не удалось обновить сообщение с частью конспекта: {e}")
+
+    async def wait(self):
+        """Дожидается отправки всех обновлений перед тем, как заменить превью готовым конспектом."""
+        if self._futures:
+            await asyncio.gather(*(asyncio.wrap_future(future) for future in self._futures), return_exceptions=True)
+
+
+def get_group_user_ids() -> list[int]:
+    """Возвращает ID всех пользователей группы, для которых выполняются групповые операции."""
     if config.DEBUG_MODE:
-        creds = auth_web.load_credentials("debug")
-    else:
-        creds = auth_web.load_credentials(user_id)
-    if not creds:
-        logger.warning(f"Не удалось загрузить учетные данные для user_id: {user_id}")
-        return None
+        # В режиме отладки для теста используем первого админа из списка
+        return config.ADMIN_IDS[:1]
+    return auth_web.list_user_ids()
+
+
+def _get_google_service(user_id, api: str, version: str):
+    """Общая логика получения клиента Google API из кэша."""
+    # В режиме отладки все пользователи работают с одним тестовым токеном
+    owner_id = "debug" if config.DEBUG_MODE else user_id
     try:
-        return build('drive', 'v3', credentials=creds)
+        service = service_cache.get_service(owner_id, api, version, auth_web.load_credentials)
     except Exception as e:
-        logger.error(f"Ошибка при создании сервиса Google Drive для user_id {user_id}: {e}")
+        logger.error(f"Ошибка при создании сервиса {api} для user_id {user_id}: {e}")
         return None
+    if not service:
+        logger.warning(f"Не удалось загрузить учетные данные для user_id: {user_id}")
+    return service
 
 
 async def get_hw_text(update: Update, context: CallbackContext) -> int:
@@ -224,7 +326,7 @@ async def start(update: Update, context: CallbackContext) -> None:
         await main_menu(update, context)
         return
 
-    creds = auth_web.load_credentials(user_id)
+    creds = await google_async.run(auth_web.load_credentials, user_id, True)
 
     if creds and not creds.expired:
         # Если пользователь уже вошел, сразу показываем главное меню
@@ -319,22 +421,14 @@ async def login(update: Update, context: CallbackContext):
 async def get_dynamic_subject_list(user_id: int) -> list:
     """
     Формирует единый, всегда актуальный список предметов из конфига и календаря.
+    Список берется из subject_registry; календарь пользователя просматривается, только если его предметы устарели.
     """
-    # 1. Собираем статичные предметы из config.py
-    static_subjects = set(l['subject'] for d in config.SCHEDULE_DATA.values() for w in d.values() for l in w)
-
-    # 2. Собираем кастомные предметы из календаря
-    calendar_subjects = await asyncio.to_thread(get_all_subjects_from_calendar, user_id)
-
-    # 3. Объединяем их в один уникальный список
-    all_subjects = sorted(list(static_subjects.union(calendar_subjects)))
+    if subject_registry.needs_refresh(user_id):
+        calendar_subjects = await google_async.run(get_all_subjects_from_calendar, user_id)
+        if calendar_subjects is not None:
+            subject_registry.set_user_subjects(user_id, calendar_subjects)
 
-    # 4. Добавляем специальный пункт про Лабораторную
-    if "Теоретические основы информатики" in all_subjects and "Лабораторная: Теоретические основы информатики" not in all_subjects:
-        all_subjects.append("Лабораторная: Теоретические основы информатики")
-        all_subjects.sort()
-
-    return all_subjects
+    return subject_registry.get_subjects()
 
 
 
@@ -425,33 +519,82 @@ async def create_schedule_confirm(update: Update, context: CallbackContext) -> i
     )
     return CONFIRM_CREATE_SCHEDULE
 
-def create_semester_schedule_blocking(user_id) -> int:
+# Приватное свойство, которым помечаются все события расписания, созданные ботом
+SCHEDULE_EVENT_PROPERTY = 'bot_managed_schedule'
+
+
+def get_week_type(date: datetime.date) -> str:
+    """Определяет четность недели относительно начала учебного года (первая неделя сентября — нечетная)."""
+    semester_start_ref_date = datetime.date(date.year, 9, 1) if date.month >= 9 else datetime.date(date.year - 1, 9, 1)
+    semester_start_monday = semester_start_ref_date - datetime.timedelta(days=semester_start_ref_date.weekday())
+    date_monday = date - datetime.timedelta(days=date.weekday())
+    weeks_diff = (date_monday - semester_start_monday).days // 7
+    return "Нечетная неделя" if weeks_diff % 2 == 0 else "Четная неделя"
+
+
+def _lesson_event_body(lesson: dict, date: datetime.date) -> dict:
+    """Тело события Google Calendar для занятия из config.SCHEDULE_DATA в указанный день."""
+    time_parts = [t.strip() for t in lesson["time"].split('–')]
+    start_h, start_m = map(int, time_parts[0].split(':'))
+    end_h, end_m = map(int, time_parts[1].split(':'))
+    start_datetime = datetime.datetime.combine(date, datetime.time(start_h, start_m))
+    end_datetime = datetime.datetime.combine(date, datetime.time(end_h, end_m))
+    return {
+        'summary': f'{lesson["subject"]} ({lesson["room"]})',
+        'description': f'Преподаватель: {lesson["teacher"]}',
+        'start': {'dateTime': start_datetime.isoformat(), 'timeZone': 'Europe/Moscow'},
+        'end': {'dateTime': end_datetime.isoformat(), 'timeZone': 'Europe/Moscow'},
+        'colorId': config.COLOR_MAP.get(lesson["type"], "9"),
+        'extendedProperties': {
+            'private': {SCHEDULE_EVENT_PROPERTY: 'true'}  # <-- ПОДПИСЬ СОБЫТИЙ РАСПИСАНИЯ ДЛЯ УДАЛЕНИЯ
+        }
+    }
+
+
+def build_recurring_semester_events(start_date: datetime.date, end_date: datetime.date) -> list[dict]:
     """
-    Блокирующая функция для создания расписания с использованием batch-запросов и задержки.
+    Строит расписание в виде повторяющихся серий: одна серия на каждое занятие дня недели и четности
+    (RRULE с INTERVAL=2). Если занятие одинаково в обе недели, создается одна еженедельная серия.
     """
-    service = get_calendar_service(user_id)
-    if not service:
-        logger.error(f"Не удалось создать сервис календаря для user_id {user_id} в фоновом потоке.")
-        return 0
+    day_map = {'Понедельник': 0, 'Вторник': 1, 'Среда': 2, 'Четверг': 3, 'Пятница': 4}
+    until = end_date.strftime('%Y%m%dT235959Z')
+    events = []
 
-    events_created_count = 0
+    for day_name, weeks in config.SCHEDULE_DATA.items():
+        if day_name not in day_map:
+            continue
+        first_day = start_date + datetime.timedelta(days=(day_map[day_name] - start_date.weekday()) % 7)
+
+        # Собираем, в какие недели проходит каждое занятие
+        lesson_weeks = {}
+        for week_type, lessons in weeks.items():
+            for lesson in lessons:
+                key = tuple(sorted(lesson.items()))
+                lesson_weeks.setdefault(key, (lesson, set()))[1].add(week_type)
+
+        for lesson, week_types in lesson_weeks.values():
+            if len(week_types) > 1:
+                first_date, interval = first_day, 1
+            else:
+                first_date = first_day
+                if get_week_type(first_date) not in week_types:
+                    first_date += datetime.timedelta(weeks=1)
+                interval = 2
+            if first_date > end_date:
+                continue
 
-    def batch_callback(request_id, response, exception):
-        """Callback-функция для подсчета успешно созданных событий."""
-        nonlocal events_created_count
-        if exception is None:
-            events_created_count += 1
-        else:
-            logger.error(f"Ошибка при создании события в batch-запросе: {exception}")
+            event = _lesson_event_body(lesson, first_date)
+            event['recurrence'] = [f'RRULE:FREQ=WEEKLY;INTERVAL={interval};UNTIL={until}']
+            events.append(event)
 
-    batch = service.new_batch_http_request(callback=batch_callback)
-    requests_in_batch = 0
+    return events
 
-    today = datetime.date.today()
-    start_date = today - datetime.timedelta(days=today.weekday())
-    end_date = datetime.date(2025, 12, 31)
+
+def build_semester_events(start_date: datetime.date, end_date: datetime.date) -> list[dict]:
+    """Заранее вычисляет все занятия из config.SCHEDULE_DATA между start_date и end_date (тела событий для API)."""
     day_map = {'Понедельник': 0, 'Вторник': 1, 'Среда': 2, 'Четверг': 3, 'Пятница': 4}
     day_names_rus = list(day_map.keys())
+    events = []
 
     current_date = start_date
     while current_date <= end_date:
@@ -461,49 +604,47 @@ def create_semester_schedule_blocking(user_id) -> int:
             continue
         day_name = day_names_rus[weekday_index]
         if day_name in config.SCHEDULE_DATA:
-            semester_start_ref_date = datetime.date(current_date.year, 9,
-                                                    1) if current_date.month >= 9 else datetime.date(
-                current_date.year - 1, 9, 1)
-            semester_start_monday = semester_start_ref_date - datetime.timedelta(days=semester_start_ref_date.weekday())
-            current_date_monday = current_date - datetime.timedelta(days=current_date.weekday())
-            weeks_diff = (current_date_monday - semester_start_monday).days // 7
-            week_type = "Нечетная неделя" if weeks_diff % 2 == 0 else "Четная неделя"
-
+            week_type = get_week_type(current_date)
             if week_type in config.SCHEDULE_DATA[day_name]:
                 for lesson in config.SCHEDULE_DATA[day_name][week_type]:
-                    time_parts = [t.strip() for t in lesson["time"].split('–')]
-                    start_h, start_m = map(int, time_parts[0].split(':'))
-                    end_h, end_m = map(int, time_parts[1].split(':'))
-                    start_datetime = datetime.datetime.combine(current_date, datetime.time(start_h, start_m))
-                    end_datetime = datetime.datetime.combine(current_date, datetime.time(end_h, end_m))
-                    event = {
-                        'summary': f'{lesson["subject"]} ({lesson["room"]})',
-                        'description': f'Преподаватель: {lesson["teacher"]}',
-                        'start': {'dateTime': start_datetime.isoformat(), 'timeZone': 'Europe/Moscow'},
-                        'end': {'dateTime': end_datetime.isoformat(), 'timeZone': 'Europe/Moscow'},
-                        'colorId': config.COLOR_MAP.get(lesson["type"], "9"),
-                    }
-                    batch.add(service.events().insert(calendarId='primary', body=event))
-                    requests_in_batch += 1
-
-                    if requests_in_batch >= 50:
-                        try:
-                            batch.execute()
-                        except Exception as e:
-                            logger.error(f"Ошибка при выполнении batch-запроса на создание: {e}")
-
-                        batch = service.new_batch_http_request(callback=batch_callback)
-                        requests_in_batch = 0
+                    events.append(_lesson_event_body(lesson, current_date))
 
         current_date += datetime.timedelta(days=1)
 
-    if requests_in_batch > 0:
-        try:
-            batch.execute()
-        except Exception as e:
-            logger.error(f"Ошибка при выполнении финального batch-запроса на создание: {e}")
+    return events
+
+
+def create_semester_schedule_blocking(user_id, progress_callback=None) -> int:
+    """
+    Блокирующая функция для создания расписания.
+    Все занятия вычисляются заранее и отправляются параллельными batch-запросами через calendar_batch.
+    В режиме SCHEDULE_MODE = 'recurring' создаются повторяющиеся серии вместо отдельных событий.
+    """
+    service = get_calendar_service(user_id)
+    if not service:
+        logger.error(f"Не удалось создать сервис календаря для user_id {user_id} в фоновом потоке.")
+        return 0
+
+    today = datetime.date.today()
+    start_date = today - datetime.timedelta(days=today.weekday())
+    end_date = datetime.date.fromisoformat(config.SEMESTER_END_DATE)
+    if config.SCHEDULE_MODE == 'recurring':
+        events = build_recurring_semester_events(start_date, end_date)
+    else:
+        events = build_semester_events(start_date, end_date)
+
+    # Заранее выбранный ID делает повтор вставки безопасным: если запрос на самом деле прошел, Google ответит 409
+    requests = []
+    for event in events:
+        body = {**event, 'id': uuid.uuid4().hex}
+        requests.append((body['id'], lambda body=body: service.events().insert(calendarId='primary', body=body)))
 
-    return events_created_count
+    result = calendar_batch.run_batched(service, requests, ok_statuses=(409,), progress_callback=progress_callback)
+    for error in list(result.failed.values())[:5]:
+        logger.error(f"Ошибка при создании события расписания для user_id {user_id}: {error}")
+
+    event_mirror.mark_stale(user_id)
+    return len(result.succeeded)
 
 
 async def schedule_menu(update: Update, context: CallbackContext) -> int:
@@ -527,7 +668,7 @@ async def run_schedule_creation(update: Update, context: CallbackContext) -> int
     query = update.callback_query
     user_id = update.effective_user.id
 
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await query.answer("Ошибка авторизации. Попробуйте войти снова через главное меню.", show_alert=True)
         return ConversationHandler.END
@@ -535,10 +676,9 @@ async def run_schedule_creation(update: Update, context: CallbackContext) -> int
     await query.answer()
     await query.edit_message_text("Начинаю составлять расписание... Это может занять несколько минут.")
 
-    loop = asyncio.get_running_loop()
-    events_created = await loop.run_in_executor(
-        None, create_semester_schedule_blocking, user_id
-    )
+    progress = TelegramProgress(query.message, "Составляю расписание", asyncio.get_running_loop())
+    events_created = await google_async.run(create_semester_schedule_blocking, user_id, progress)
+    await progress.wait()
     color_legend = (
         "Расписание создано!\n"
         f"Всего создано мероприятий: {events_created}\n\n"
@@ -557,80 +697,132 @@ async def run_schedule_creation(update: Update, context: CallbackContext) -> int
 
 # --- Логика управления расписанием (удаление) ---
 
-def delete_schedule_blocking(user_id) -> int:
+def _list_schedule_events(service, time_min: str, time_max: str) -> list:
     """
-    Блокирующая функция для удаления расписания с использованием batch-запросов и задержки.
+    Находит события расписания по приватному свойству (фильтрация на стороне Google, серии — одним событием).
+    Возвращает события с полями id, start и recurrence.
+    """
+    events = []
+    page_token = None
+    while True:
+        events_result = service.events().list(
+            calendarId='primary', timeMin=time_min, timeMax=time_max, singleEvents=False,
+            privateExtendedProperty=f'{SCHEDULE_EVENT_PROPERTY}=true',
+            fields='items(id,start,recurrence),nextPageToken',
+            pageToken=page_token, maxResults=2500
+        ).execute()
+        events.extend(events_result.get('items', []))
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            return events
+
+
+def _event_start_date(event: dict) -> datetime.date:
+    start = event.get('start', {})
+    return datetime.date.fromisoformat((start.get('dateTime') or start['date'])[:10])
+
+
+def _truncate_recurrence(recurrence: list, last_date: datetime.date) -> list:
+    """Заканчивает правила повторения (RRULE) днем last_date; COUNT заменяется на UNTIL, EXDATE и прочее не меняются."""
+    until = last_date.strftime('%Y%m%dT235959Z')
+    truncated = []
+    for rule in recurrence:
+        if rule.startswith('RRULE:'):
+            parts = [part for part in rule[len('RRULE:'):].split(';') if not part.startswith(('UNTIL=', 'COUNT='))]
+            rule = 'RRULE:' + ';'.join(parts + [f'UNTIL={until}'])
+        truncated.append(rule)
+    return truncated
+
+
+def _list_legacy_schedule_event_ids(service, time_min: str, time_max: str) -> list:
+    """
+    Находит события расписания, созданные до появления подписи, по названию предмета.
+    Может захватить события пользователя с тем же названием, поэтому включается только через SCHEDULE_DELETE_LEGACY_SCAN.
+    """
+    bot_subjects = subject_registry.STATIC_SUBJECTS
+    event_ids = []
+    page_token = None
+    while True:
+        events_result = service.events().list(
+            calendarId='primary', timeMin=time_min, timeMax=time_max,
+            singleEvents=True, pageToken=page_token, maxResults=2500
+        ).execute()
+        for event in events_result.get('items', []):
+            if event.get('extendedProperties', {}).get('private', {}).get(SCHEDULE_EVENT_PROPERTY):
+                continue
+            summary = event.get('summary', '')
+            match = re.search(r'^(.*)\s\(', summary)
+            if match:
+                subject_name = match.group(1).strip().replace(config.HOMEWORK_TITLE_TAG, "").strip()
+                if subject_name in bot_subjects:
+                    # Экземпляр повторяющейся серии удаляется вместе со всей серией одним запросом
+                    event_id = event.get('recurringEventId', event['id'])
+                    if event_id not in event_ids:
+                        event_ids.append(event_id)
+        page_token = events_result.get('nextPageToken')
+        if not page_token:
+            return event_ids
+
+
+def delete_schedule_blocking(user_id, progress_callback=None) -> tuple[int, int]:
+    """
+    Блокирующая функция для удаления расписания с понедельника текущей недели (как и в режиме 'single').
+    События находятся по подписи bot_managed_schedule и удаляются параллельными batch-запросами через calendar_batch.
+    Серия, начавшаяся раньше этой недели, не удаляется целиком (вместе с прошлыми занятиями и ДЗ в них),
+    а обрезается: UNTIL в ее RRULE переносится на день перед start_date.
+    Возвращает (сколько удалено, сколько найдено похожих событий без подписи, которые не удалялись).
+    События без подписи ищутся, только если подписанных нет, а SCHEDULE_DELETE_LEGACY_SCAN выключен,
+    чтобы подсказать пользователю, что расписание от старой версии бота осталось в календаре.
     """
     service = get_calendar_service(user_id)
     if not service:
         logger.error(f"Не удалось создать сервис календаря для user_id {user_id} в фоновом потоке.")
-        return 0
+        return 0, 0
 
-    bot_subjects = {lesson['subject'] for day in config.SCHEDULE_DATA.values() for week in day.values() for lesson in
-                    week}
-    end_date = datetime.date(2025, 12, 31)
+    end_date = datetime.date.fromisoformat(config.SEMESTER_END_DATE)
     today = datetime.date.today()
     start_date = today - datetime.timedelta(days=today.weekday())
     time_min = datetime.datetime.combine(start_date, datetime.time.min).isoformat() + 'Z'
     time_max = datetime.datetime.combine(end_date, datetime.time.max).isoformat() + 'Z'
 
-    events_to_delete = []
-    page_token = None
-    while True:
-        try:
-            events_result = service.events().list(
-                calendarId='primary', timeMin=time_min, timeMax=time_max,
-                singleEvents=True, pageToken=page_token, maxResults=2500
-            ).execute()
-            events = events_result.get('items', [])
-            for event in events:
-                summary = event.get('summary', '')
-                match = re.search(r'^(.*)\s\(', summary)
-                if match:
-                    subject_name = match.group(1).strip().replace(config.HOMEWORK_TITLE_TAG, "").strip()
-                    if subject_name in bot_subjects:
-                        events_to_delete.append(event['id'])
-            page_token = events_result.get('nextPageToken')
-            if not page_token:
-                break
-        except Exception as e:
-            logger.error(f"Ошибка при получении списка событий для удаления: {e}")
-            break
-
-    if not events_to_delete:
-        return 0
-
-    deleted_count = 0
-
-    def batch_callback(request_id, response, exception):
-        nonlocal deleted_count
-        if exception is None:
-            deleted_count += 1
-        else:
-            logger.error(f"Ошибка при удалении события в batch-запросе: {exception}")
-
-    batch = service.new_batch_http_request(callback=batch_callback)
-    requests_in_batch = 0
-
-    for event_id in events_to_delete:
-        batch.add(service.events().delete(calendarId='primary', eventId=event_id))
-        requests_in_batch += 1
-        if requests_in_batch >= 50:
-            try:
-                batch.execute()
-            except Exception as e:
-                logger.error(f"Ошибка при выполнении batch-запроса на удаление: {e}")
+    try:
+        events_to_delete, series_to_truncate = [], []
+        for event in _list_schedule_events(service, time_min, time_max):
+            if event.get('recurrence') and _event_start_date(event) < start_date:
+                series_to_truncate.append(event)
+            else:
+                events_to_delete.append(event['id'])
+        if config.SCHEDULE_DELETE_LEGACY_SCAN:
+            legacy_ids = _list_legacy_schedule_event_ids(service, time_min, time_max)
+            events_to_delete += [event_id for event_id in legacy_ids if event_id not in events_to_delete]
+        elif not events_to_delete and not series_to_truncate:
+            return 0, len(_list_legacy_schedule_event_ids(service, time_min, time_max))
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка событий для удаления: {e}")
+        return 0, 0
 
-            batch = service.new_batch_http_request(callback=batch_callback)
-            requests_in_batch = 0
+    if not events_to_delete and not series_to_truncate:
+        return 0, 0
 
-    if requests_in_batch > 0:
-        try:
-            batch.execute()
-        except Exception as e:
-            logger.error(f"Ошибка при выполнении финального batch-запроса на удаление: {e}")
+    requests = [
+        (event_id, lambda event_id=event_id: service.events().delete(calendarId='primary', eventId=event_id))
+        for event_id in events_to_delete
+    ]
+    last_date = start_date - datetime.timedelta(days=1)
+    requests += [
+        (event['id'], lambda event=event: service.events().patch(
+            calendarId='primary', eventId=event['id'],
+            body={'recurrence': _truncate_recurrence(event['recurrence'], last_date)}
+        ))
+        for event in series_to_truncate
+    ]
+    # 404/410: событие уже удалено (например, повтором после временной ошибки)
+    result = calendar_batch.run_batched(service, requests, ok_statuses=(404, 410), progress_callback=progress_callback)
+    for error in list(result.failed.values())[:5]:
+        logger.error(f"Ошибка при удалении события расписания для user_id {user_id}: {error}")
 
-    return deleted_count
+    event_mirror.mark_stale(user_id)
+    return len(result.succeeded), 0
 
 
 async def delete_schedule_confirm(update: Update, context: CallbackContext) -> int:
@@ -655,7 +847,7 @@ async def run_schedule_deletion(update: Update, context: CallbackContext) -> int
     user_id = update.effective_user.id
 
     # --- ИЗМЕНЕНИЕ: Проверяем, авторизован ли пользователь ---
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await query.answer("Ошибка авторизации.", show_alert=True)
         return ConversationHandler.END
@@ -663,12 +855,19 @@ async def run_schedule_deletion(update: Update, context: CallbackContext) -> int
     await query.answer()
     await query.edit_message_text("Начинаю удаление... Это может занять время.")
 
-    loop = asyncio.get_running_loop()
-    deleted_count = await loop.run_in_executor(
-        None, delete_schedule_blocking, user_id
-    )
+    progress = TelegramProgress(query.message, "Удаляю расписание", asyncio.get_running_loop())
+    deleted_count, legacy_count = await google_async.run(delete_schedule_blocking, user_id, progress)
+    await progress.wait()
+    text = f"Удаление завершено. Удалено мероприятий: {deleted_count}"
+    if legacy_count:
+        text += (
+            f"\n\nВ календаре найдено {legacy_count} похожих на расписание событий, созданных старой версией бота. "
+            "Они не удалены автоматически, потому что их нельзя надежно отличить от ваших собственных событий "
+            "с тем же названием. Удалите их вручную в Google Календаре (для повторяющегося события выберите "
+            "«Все мероприятия»)."
+        )
     await query.edit_message_text(
-        f"Удаление завершено. Удалено мероприятий: {deleted_count}",
+        text,
         reply_markup=InlineKeyboardMarkup(
             [[InlineKeyboardButton("« В меню расписания", callback_data="schedule_menu")]])
     )
@@ -731,7 +930,7 @@ async def add_textbook_get_file(update: Update, context: CallbackContext) -> int
     file_bytes = await file.download_as_bytearray()
 
     # 1. Загружаем на Google Drive, используя новую функцию
-    upload_result = await asyncio.to_thread(
+    upload_result = await google_async.run(
         upload_textbook_to_shared_drive, user_id, file_name, bytes(file_bytes)
     )
 
@@ -748,6 +947,12 @@ async def add_textbook_get_file(update: Update, context: CallbackContext) -> int
 
     add_textbook(subject=subject, file_name=file_name, file_id=file_id)
 
+    # 3. В фоне извлекаем число страниц, оглавление и текст страниц, чтобы конспект не разбирал файл заново
+    context.application.create_task(
+        asyncio.to_thread(textbook_ingest.ingest_textbook, file_id, bytes(file_bytes)),
+        name=f"ingest_textbook_{file_id}"
+    )
+
     await message.reply_text(
         f"✅ Учебник '{file_name}' успешно добавлен в базу по предмету '{subject}'."
     )
@@ -762,8 +967,11 @@ async def add_textbook_get_file(update: Update, context: CallbackContext) -> int
 
 
 def save_homework_to_event(event: dict, homework_text, service : str = "", is_group_hw: bool = False,
-                           attachment_data: dict = None):
-    """Обновляет описание, заголовок и ВЛОЖЕНИЯ события с ДЗ."""
+                           attachment_data: dict = None, user_id: int = None) -> dict:
+    """
+    Обновляет описание, заголовок и ВЛОЖЕНИЯ события с ДЗ.
+    Если передан user_id, обновленное событие сразу попадает в локальную копию календаря пользователя.
+    """
     description = event.get('description', '')
     summary = event.get('summary', '')
     full_homework_text = homework_text.strip()
@@ -817,12 +1025,15 @@ def save_homework_to_event(event: dict, homework_text, service : str = "", is_gr
     else:
         event['summary'] = summary
 
-    service.events().update(
+    updated_event = service.events().update(
         calendarId='primary',
         eventId=event['id'],
         body=event,
         supportsAttachments=True
     ).execute()
+    if user_id is not None:
+        event_mirror.upsert(user_id, updated_event)
+    return updated_event
 
 def extract_homework_part(description: str, target_tag: str) -> str:
     """
@@ -940,7 +1151,7 @@ async def find_next_class(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id  # <-- ДОБАВЛЕНО
 
     # --- ИЗМЕНЕНИЕ: Получаем сервис для конкретного пользователя ---
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await query.answer("Ошибка авторизации. Попробуйте войти снова.", show_alert=True)
         return ConversationHandler.END
@@ -957,11 +1168,7 @@ async def find_next_class(update: Update, context: CallbackContext) -> int:
     search_start_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
     try:
-        events_result = service.events().list(
-            calendarId='primary', timeMin=search_start_time, singleEvents=True,
-            orderBy='startTime', maxResults=250
-        ).execute()
-        events = events_result.get('items', [])
+        events = await get_user_events(user_id, service, time_min=search_start_time)
 
         for event in events:
             event_summary = event.get('summary', '')
@@ -970,7 +1177,8 @@ async def find_next_class(update: Update, context: CallbackContext) -> int:
             event_subject = match.group(1).strip() if match else event_summary.strip()
 
             if event_subject == subject_to_find and event_color_id == color_id_to_find:
-                save_homework_to_event(event=event, service=service, homework_text=homework_text)
+                await google_async.run(save_homework_to_event, event=event, service=service, homework_text=homework_text,
+                                       user_id=user_id)
                 event_date_str = event['start'].get('dateTime', event['start'].get('date'))
                 event_date = datetime.datetime.fromisoformat(event_date_str).strftime('%d.%m.%Y')
                 await query.edit_message_text(
@@ -994,7 +1202,7 @@ async def find_next_class(update: Update, context: CallbackContext) -> int:
 
 async def get_manual_date_for_hw(update: Update, context: CallbackContext, is_editing: bool = False) -> int:
     user_id = update.effective_user.id  # <-- Добавляем эту строку для получения ID
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await update.message.reply_text("Ошибка авторизации. Убедитесь, что файл token.pickle существует.")
         context.user_data.clear()
@@ -1015,8 +1223,7 @@ async def get_manual_date_for_hw(update: Update, context: CallbackContext, is_ed
     time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
 
     try:
-        all_events_today = service.events().list(calendarId='primary', timeMin=time_min, timeMax=time_max,
-                                                 singleEvents=True).execute().get('items', [])
+        all_events_today = await get_user_events(user_id, service, time_min=time_min, time_max=time_max)
 
         matching_classes = []
         for event in all_events_today:
@@ -1048,7 +1255,8 @@ async def get_manual_date_for_hw(update: Update, context: CallbackContext, is_ed
             return EDIT_HW_GET_NEW_TEXT
         else:
             homework_text = context.user_data.get('homework_text')
-            save_homework_to_event(event=event_to_process, service=service, homework_text=homework_text)
+            await google_async.run(save_homework_to_event, event=event_to_process, service=service,
+                                   homework_text=homework_text, user_id=user_id)
 
             # Сначала отправляем подтверждение
             await update.message.reply_text(
@@ -1069,7 +1277,7 @@ async def get_manual_date_for_hw(update: Update, context: CallbackContext, is_ed
 async def edit_group_hw_get_date(update: Update, context: CallbackContext) -> int:
     """Обрабатывает введенную дату, находит семинар и показывает меню редактирования группового ДЗ."""
     user_id = update.effective_user.id
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await update.message.reply_text("Ошибка авторизации.")
         return ConversationHandler.END
@@ -1087,8 +1295,7 @@ async def edit_group_hw_get_date(update: Update, context: CallbackContext) -> in
     time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
 
     try:
-        events = service.events().list(calendarId='primary', timeMin=time_min, timeMax=time_max,
-                                       singleEvents=True).execute().get('items', [])
+        events = await get_user_events(user_id, service, time_min=time_min, time_max=time_max)
         found_event = None
         for event in events:
             event_summary = event.get('summary', '')
@@ -1172,7 +1379,7 @@ async def edit_hw_get_date(update: Update, context: CallbackContext) -> int:
     Находит событие по дате, показывает текущее ДЗ и меню действий.
     """
     user_id = update.effective_user.id
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await update.message.reply_text("Ошибка авторизации. Попробуйте войти снова.")
         return ConversationHandler.END
@@ -1191,8 +1398,7 @@ async def edit_hw_get_date(update: Update, context: CallbackContext) -> int:
     time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
 
     try:
-        events = service.events().list(calendarId='primary', timeMin=time_min, timeMax=time_max,
-                                       singleEvents=True).execute().get('items', [])
+        events = await get_user_events(user_id, service, time_min=time_min, time_max=time_max)
         found_event = None
         for event in events:
             event_summary = event.get('summary', '')
@@ -1253,15 +1459,15 @@ async def edit_delete_text(update: Update, context: CallbackContext) -> int:
     await query.answer()
 
     # --- ИЗМЕНЕНИЕ: Получаем сервис для конкретного пользователя ---
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     event_id = context.user_data.get('event_to_edit_id')
 
     if not service or not event_id:
         await query.edit_message_text("Произошла ошибка, сессия истекла. Попробуйте снова.")
         return ConversationHandler.END
 
-    event = service.events().get(calendarId='primary', eventId=event_id).execute()
-    save_homework_to_event(event, service=service, homework_text="")
+    event = await google_async.get_event(service, event_id)
+    await google_async.run(save_homework_to_event, event, service=service, homework_text="", user_id=user_id)
     await query.edit_message_text("✅ Текст домашнего задания удален.")
     await main_menu(update, context, force_new_message=True)
     context.user_data.clear()
@@ -1275,8 +1481,8 @@ async def edit_delete_file(update: Update, context: CallbackContext) -> int:
 
     # --- ИСПРАВЛЕНИЕ ЗДЕСЬ ---
     user_id = update.effective_user.id
-    service = get_calendar_service(user_id)
-    drive_service = get_drive_service(user_id)
+    service = await get_calendar_service_async(user_id)
+    drive_service = await get_drive_service_async(user_id)
     # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
 
     event_id = context.user_data.get('event_to_edit_id')
@@ -1285,7 +1491,7 @@ async def edit_delete_file(update: Update, context: CallbackContext) -> int:
         await query.edit_message_text("Произошла ошибка, сессия истекла. Попробуйте снова.")
         return ConversationHandler.END
 
-    event = service.events().get(calendarId='primary', eventId=event_id).execute()
+    event = await google_async.get_event(service, event_id)
 
     if not event.get('attachments'):
         await query.edit_message_text("❌ У этого ДЗ нет прикрепленного файла.")
@@ -1297,10 +1503,12 @@ async def edit_delete_file(update: Update, context: CallbackContext) -> int:
     file_id = file_to_delete['fileId']
 
     event['attachments'] = []
-    save_homework_to_event(event, service=service, homework_text=extract_homework_part(event.get('description', ''),
-                                                                                       config.PERSONAL_HOMEWORK_DESC_TAG))
+    await google_async.run(save_homework_to_event, event, service=service,
+                           homework_text=extract_homework_part(event.get('description', ''),
+                                                               config.PERSONAL_HOMEWORK_DESC_TAG),
+                           user_id=user_id)
     try:
-        drive_service.files().delete(fileId=file_id).execute()
+        await google_async.execute(drive_service.files().delete(fileId=file_id))
         await query.edit_message_text(f"✅ Файл `{file_to_delete['title']}` удален.", parse_mode='Markdown')
     except Exception as e:
         logger.error(f"Не удалось удалить файл {file_id} с Google Drive: {e}")
@@ -1324,7 +1532,7 @@ async def edit_hw_get_new_text(update: Update, context: CallbackContext) -> int:
     user_id = update.effective_user.id  # <-- ДОБАВЛЕНО
 
     # --- ИЗМЕНЕНИЕ: Получаем сервис для конкретного пользователя ---
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     event_id = context.user_data.get('event_to_edit_id')
 
     if not service or not event_id:
@@ -1332,12 +1540,14 @@ async def edit_hw_get_new_text(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
     new_text = update.message.text
-    event = service.events().get(calendarId='primary', eventId=event_id).execute()
-    save_homework_to_event(
+    event = await google_async.get_event(service, event_id)
+    await google_async.run(
+        save_homework_to_event,
         event,
         service=service,
         homework_text=new_text,
-        attachment_data=event.get('attachments', [None])[0]
+        attachment_data=event.get('attachments', [None])[0],
+        user_id=user_id
     )
     await update.message.reply_text("✅ Текст домашнего задания обновлен.")
     await main_menu(update, context, force_new_message=True)
@@ -1351,7 +1561,7 @@ async def delete_personal_hw(update: Update, context: CallbackContext) -> int:
     await query.answer()
 
     user_id = update.effective_user.id
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service or 'event_to_edit' not in context.user_data:
         await query.edit_message_text("Произошла ошибка или сессия истекла. Попробуйте снова.")
         return ConversationHandler.END
@@ -1359,7 +1569,7 @@ async def delete_personal_hw(update: Update, context: CallbackContext) -> int:
     event_to_edit = context.user_data.get('event_to_edit')
     subject = context.user_data.get('homework_subject')
 
-    save_homework_to_event(event_to_edit, "", service, is_group_hw=False)
+    await google_async.run(save_homework_to_event, event_to_edit, "", service, is_group_hw=False, user_id=user_id)
 
     await query.edit_message_text(
         f"Личное ДЗ для '{subject}' успешно удалено!",
@@ -1450,7 +1660,7 @@ async def edit_group_hw_get_new_text(update: Update, context: CallbackContext) -
     target_date = context.user_data.get('target_date') # Получаем дату из предыдущего шага
 
     # Передаем class_type и target_date
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         find_and_update_or_delete_group_hw_blocking, subject, new_homework_text, class_type, target_date
     )
 
@@ -1472,7 +1682,7 @@ async def delete_group_hw(update: Update, context: CallbackContext) -> int:
     target_date = context.user_data.get('target_date')  # Получаем дату
 
     # Передаем class_type и target_date, но пустой текст для удаления
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         find_and_update_or_delete_group_hw_blocking, subject, "", class_type, target_date
     )
 
@@ -1509,7 +1719,7 @@ async def get_manual_date_for_group_hw_text(update: Update, context: CallbackCon
 
     await update.message.reply_text(f"Начинаю обновление текста ДЗ для группы...")
 
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         update_group_homework_blocking, subject, class_type, target_date, new_text=homework_text
     )
 
@@ -1552,13 +1762,13 @@ async def get_manual_date_for_group_hw_file(update: Update, context: CallbackCon
 
     await update.message.reply_text(f"Загружаю файл на ваш диск и обновляю ДЗ для группы...")
 
-    attachment_info = await asyncio.to_thread(upload_file_to_drive, file_name, file_bytes)
+    attachment_info = await google_async.run(upload_file_to_drive, file_name, file_bytes)
     if not attachment_info:
         await update.message.reply_text("Не удалось загрузить файл на Google Drive.")
         context.user_data.clear()
         return ConversationHandler.END
 
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         update_group_homework_blocking, subject, class_type, target_date, new_attachment=attachment_info
     )
 
@@ -1590,7 +1800,7 @@ async def get_manual_date_for_group_hw_file(update: Update, context: CallbackCon
 async def edit_group_hw_get_date(update: Update, context: CallbackContext) -> int:
     """Показывает меню редактирования группового ДЗ, используя календарь админа как образец."""
     user_id = update.effective_user.id
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await update.message.reply_text("Ошибка авторизации админа.")
         return ConversationHandler.END
@@ -1609,8 +1819,7 @@ async def edit_group_hw_get_date(update: Update, context: CallbackContext) -> in
     time_min = datetime.datetime.combine(target_date, datetime.time.min).isoformat() + 'Z'
     time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
 
-    events = service.events().list(calendarId='primary', timeMin=time_min, timeMax=time_max,
-                                   singleEvents=True).execute().get('items', [])
+    events = await get_user_events(user_id, service, time_min=time_min, time_max=time_max)
     found_event = None
     for event in events:
         event_summary = event.get('summary', '')
@@ -1661,7 +1870,7 @@ async def edit_group_delete_text(update: Update, context: CallbackContext) -> in
     target_date = context.user_data.get('target_date')
 
     await query.edit_message_text("Начинаю удаление текста ДЗ для группы...")
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         update_group_homework_blocking, subject, class_type, target_date, delete_text=True
     )
     await query.edit_message_text(f"✅ Текст группового ДЗ удален у {updated_count} пользователей.")
@@ -1680,8 +1889,8 @@ async def edit_group_delete_file(update: Update, context: CallbackContext) -> in
 
     # --- ИСПРАВЛЕНИЕ ЗДЕСЬ ---
     user_id = update.effective_user.id
-    service = get_calendar_service(user_id)
-    drive_service = get_drive_service(user_id)
+    service = await get_calendar_service_async(user_id)
+    drive_service = await get_drive_service_async(user_id)
     # --- КОНЕЦ ИСПРАВЛЕНИЯ ---
 
     subject = context.user_data.get('homework_subject')
@@ -1692,8 +1901,7 @@ async def edit_group_delete_file(update: Update, context: CallbackContext) -> in
     time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
     class_color_id = config.COLOR_MAP.get(class_type)
 
-    events = service.events().list(calendarId='primary', timeMin=time_min, timeMax=time_max,
-                                   singleEvents=True).execute().get('items', [])
+    events = await get_user_events(user_id, service, time_min=time_min, time_max=time_max)
     found_event = None
     for event in events:
         event_summary = event.get('summary', '')
@@ -1707,12 +1915,12 @@ async def edit_group_delete_file(update: Update, context: CallbackContext) -> in
         try:
             file_to_delete = found_event['attachments'][0]
             file_id = file_to_delete.get('fileId')
-            drive_service.files().delete(fileId=file_id).execute()
+            await google_async.execute(drive_service.files().delete(fileId=file_id))
             logger.info(f"Файл {file_id} успешно удален с диска админа.")
         except Exception as e:
             logger.warning(f"Не удалось удалить файл с Google Drive админа (возможно, он уже удален): {e}")
 
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         update_group_homework_blocking, subject, class_type, target_date, delete_attachment=True
     )
 
@@ -1737,7 +1945,7 @@ async def edit_group_get_new_text(update: Update, context: CallbackContext) -> i
     target_date = context.user_data.get('target_date')
 
     await update.message.reply_text("Обновляю текст для группы...")
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         update_group_homework_blocking, subject, class_type, target_date, new_text=new_text
     )
     await update.message.reply_text(f"✅ Текст группового ДЗ обновлен у {updated_count} пользователей.")
@@ -1754,28 +1962,10 @@ def update_group_homework_blocking(subject: str, class_type: str, target_date: d
                                    new_attachment: dict = None, delete_attachment: bool = False) -> tuple[int, list]:
     """
     Блокирующая функция для обновления ДЗ для ВСЕХ зарегистрированных пользователей.
+    Пользователи обрабатываются параллельно через fanout.run_for_users.
     """
-    updated_count = 0
-    failed_users = []
-
     # --- НОВАЯ ЛОГИКА: Ищем всех пользователей ---
-    user_ids = []
-    if config.DEBUG_MODE:
-        # В режиме отладки для теста добавляем первого админа из списка
-        logger.info("Режим отладки: для теста группового ДЗ используется ID первого админа.")
-        if config.ADMIN_IDS:
-            user_ids.append(config.ADMIN_IDS[0])
-    else:
-        # В рабочем режиме ищем всех реальных пользователей
-        try:
-            user_ids = [
-                int(f.split('_')[1].split('.')[0])
-                for f in os.listdir(auth_web.TOKEN_DIR)
-                if f.startswith('token_') and f.endswith('.json')
-            ]
-        except (FileNotFoundError, IndexError):
-            logger.error(f"Папка с токенами {auth_web.TOKEN_DIR} не найдена или пуста.")
-            user_ids = []
+    user_ids = get_group_user_ids()
 
     if not user_ids:
         logger.warning("Не найдено ни одного пользователя для обновления группового ДЗ.")
@@ -1784,61 +1974,56 @@ def update_group_homework_blocking(subject: str, class_type: str, target_date: d
 
     class_color_id = config.COLOR_MAP.get(class_type)
 
-    # --- НОВАЯ ЛОГИКА: Запускаем цикл по всем пользователям ---
-    for user_id in user_ids:
-        try:
-            service = get_calendar_service(user_id)
-            if not service:
-                failed_users.append(str(user_id))
-                continue
+    # Определяем время поиска
+    time_min, time_max, order_by = None, None, None
+    if target_date:
+        time_min = datetime.datetime.combine(target_date, datetime.time.min).isoformat() + 'Z'
+        time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
+    else:
+        # Ищем начиная с текущего момента
+        time_min = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        order_by = 'startTime'
 
-            # Определяем время поиска
-            time_min, time_max, order_by = None, None, None
-            if target_date:
-                time_min = datetime.datetime.combine(target_date, datetime.time.min).isoformat() + 'Z'
-                time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
-            else:
-                # Ищем начиная с текущего момента
-                time_min = datetime.datetime.now(datetime.timezone.utc).isoformat()
-                order_by = 'startTime'
+    def update_for_user(user_id) -> bool:
+        service = get_calendar_service(user_id)
+        if not service:
+            return False
 
-            # Ищем событие в календаре текущего пользователя
-            events = service.events().list(
-                calendarId='primary', timeMin=time_min, timeMax=time_max,
-                singleEvents=True, orderBy=order_by, maxResults=250
-            ).execute().get('items', [])
+        # Ищем событие в календаре текущего пользователя
+        events = service.events().list(
+            calendarId='primary', timeMin=time_min, timeMax=time_max,
+            singleEvents=True, orderBy=order_by, maxResults=250
+        ).execute().get('items', [])
 
-            found_event = None
-            for event in events:
-                event_summary = event.get('summary', '')
-                match = re.search(r'^(.*?)\s\(', event_summary)
-                event_subject = match.group(1).strip() if match else ''
-                if event_subject == subject and event.get('colorId') == class_color_id:
-                    found_event = event
-                    break
-
-            if found_event:
-                # Определяем, каким будет новый текст
-                final_text = "" if delete_text else new_text if new_text is not None else extract_homework_part(
-                    found_event.get('description', ''), config.GROUP_HOMEWORK_DESC_TAG)
-
-                # Определяем, каким будет новое вложение
-                final_attachment = None if delete_attachment else new_attachment if new_attachment is not None else (
-                    found_event.get('attachments', [None])[0])
-
-                save_homework_to_event(
-                    event=found_event, service=service, homework_text=final_text,
-                    attachment_data=final_attachment, is_group_hw=True
-                )
-                updated_count += 1
-            else:
-                logger.warning(f"Событие '{subject}' для user_id {user_id} на дату '{target_date}' не найдено.")
+        found_event = None
+        for event in events:
+            event_summary = event.get('summary', '')
+            match = re.search(r'^(.*?)\s\(', event_summary)
+            event_subject = match.group(1).strip() if match else ''
+            if event_subject == subject and event.get('colorId') == class_color_id:
+                found_event = event
+                break
 
-        except Exception as e:
-            logger.error(f"Критическая ошибка при обновлении ДЗ для user_id {user_id}: {e}")
-            failed_users.append(str(user_id))
+        if not found_event:
+            logger.warning(f"Событие '{subject}' для user_id {user_id} на дату '{target_date}' не найдено.")
+            return False
+
+        # Определяем, каким будет новый текст
+        final_text = "" if delete_text else new_text if new_text is not None else extract_homework_part(
+            found_event.get('description', ''), config.GROUP_HOMEWORK_DESC_TAG)
 
-    return updated_count, failed_users
+        # Определяем, каким будет новое вложение
+        final_attachment = None if delete_attachment else new_attachment if new_attachment is not None else (
+            found_event.get('attachments', [None])[0])
+
+        save_homework_to_event(
+            event=found_event, service=service, homework_text=final_text,
+            attachment_data=final_attachment, is_group_hw=True, user_id=user_id
+        )
+        return True
+
+    result = fanout.run_for_users(user_ids, update_for_user)
+    return len(result.succeeded), [str(user_id) for user_id in result.failed]
 
 async def group_homework_start(update: Update, context: CallbackContext) -> int:
     query = update.callback_query
@@ -1860,7 +2045,7 @@ async def find_next_class_for_group_hw_text(update: Update, context: CallbackCon
 
     await query.edit_message_text(f"Начинаю поиск занятия и обновление текста ДЗ для группы...")
 
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         update_group_homework_blocking, subject, class_type, target_date=None, new_text=homework_text
     )
 
@@ -1896,13 +2081,13 @@ async def find_next_class_for_group_hw_file(update: Update, context: CallbackCon
     await query.edit_message_text(f"Загружаю файл и ищу следующее занятие для группы...")
 
     # --- ИЗМЕНЕНИЕ: Передаем ID админа в функцию загрузки ---
-    attachment_info = await asyncio.to_thread(upload_file_to_drive, user_id, file_name, file_bytes)
+    attachment_info = await google_async.run(upload_file_to_drive, user_id, file_name, file_bytes)
     if not attachment_info:
         await query.edit_message_text("Не удалось загрузить файл на Google Drive.")
         context.user_data.clear()
         return ConversationHandler.END
 
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         update_group_homework_blocking, subject, class_type, target_date=None, new_attachment=attachment_info
     )
 
@@ -1985,7 +2170,7 @@ async def find_next_seminar_for_group(update: Update, context: CallbackContext)
     homework_text = context.user_data.get('group_homework_text')
 
     # Передаем class_type в блокирующую функцию
-    updated_count, failed_users = await asyncio.to_thread(
+    updated_count, failed_users = await google_async.run(
         find_and_update_or_delete_group_hw_blocking, subject, homework_text, class_type
     )
 
@@ -2017,7 +2202,7 @@ async def get_manual_date_for_group_hw(update: Update, context: CallbackContext)
         return CHOOSE_GROUP_HW_DATE_OPTION
 
     # Передаем class_type и target_date в блокирующую функцию
-    updated_count, _ = await asyncio.to_thread(
+    updated_count, _ = await google_async.run(
         find_and_update_or_delete_group_hw_blocking, subject, homework_text, class_type, target_date
     )
 
@@ -2168,9 +2353,9 @@ async def get_file_only(update: Update, context: CallbackContext) -> int:
     context.user_data['file_name'] = file_name
     await message.reply_text("Файл получен!")
 
-    subjects = sorted(list(set(l['subject'] for d in config.SCHEDULE_DATA.values() for w in d.values() for l in w)))
-    if "Теоретические основы информатики" in subjects:
-        subjects.append("Лабораторная: Теоретические основы информатики")
+    subjects = sorted(subject_registry.STATIC_SUBJECTS)
+    if subject_registry.LAB_SUBJECT in subjects:
+        subjects.append(subject_registry.LAB_SUBJECT_ITEM)
         subjects.sort()
     context.user_data['subjects_list'] = subjects
 
@@ -2353,9 +2538,9 @@ async def delete_textbook_confirm(update: Update, context: CallbackContext) -> i
     # 2. Удаляем с Google Drive
     drive_deleted = False
     try:
-        drive_service = get_drive_service(user_id)
+        drive_service = await get_drive_service_async(user_id)
         if drive_service:
-            drive_service.files().delete(fileId=book_to_delete['file_id']).execute()
+            await google_async.execute(drive_service.files().delete(fileId=book_to_delete['file_id']))
             drive_deleted = True
     except Exception as e:
         logger.error(f"Не удалось удалить файл {book_to_delete['file_id']} с Google Drive: {e}")
@@ -2449,8 +2634,8 @@ async def choose_subject_for_group_file(update: Update, context: CallbackContext
 async def save_file_to_event_logic(update: Update, context: CallbackContext, event: dict, user_id: int) -> int:
     """Общая логика загрузки файла и сохранения его в событие для конкретного пользователя."""
     # --- ИЗМЕНЕНИЕ: Получаем сервисы для конкретного пользователя ---
-    service = get_calendar_service(user_id)
-    drive_service = get_drive_service(user_id) # drive_service здесь больше не создается, но проверка не помешает
+    service = await get_calendar_service_async(user_id)
+    drive_service = await get_drive_service_async(user_id) # drive_service здесь больше не создается, но проверка не помешает
 
     file_bytes = context.user_data.get('file_bytes')
     file_name = context.user_data.get('file_name')
@@ -2468,7 +2653,7 @@ async def save_file_to_event_logic(update: Update, context: CallbackContext, eve
         message_to_edit = await update.message.reply_text(f"Загружаю файл '{file_name}' на ваш Google Drive...")
 
     # --- ИЗМЕНЕНИЕ: Передаем user_id в функцию загрузки ---
-    attachment_info = await asyncio.to_thread(
+    attachment_info = await google_async.run(
         upload_file_to_drive, user_id, file_name, file_bytes
     )
 
@@ -2482,11 +2667,13 @@ async def save_file_to_event_logic(update: Update, context: CallbackContext, eve
     existing_description = event.get('description', '')
     existing_hw_text = extract_homework_part(existing_description, config.PERSONAL_HOMEWORK_DESC_TAG)
 
-    save_homework_to_event(
+    await google_async.run(
+        save_homework_to_event,
         event=event,
         service=service,
         homework_text=existing_hw_text,
-        attachment_data=attachment_info
+        attachment_data=attachment_info,
+        user_id=user_id
     )
 
     event_date_str = event['start'].get('dateTime', event['start'].get('date'))
@@ -2504,7 +2691,7 @@ async def find_next_class_for_file(update: Update, context: CallbackContext) ->
     user_id = update.effective_user.id # <-- ДОБАВЛЕНО
 
     # --- ИЗМЕНЕНИЕ: Получаем сервис для конкретного пользователя ---
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await query.answer("Ошибка авторизации.", show_alert=True)
         return ConversationHandler.END
@@ -2520,11 +2707,7 @@ async def find_next_class_for_file(update: Update, context: CallbackContext) ->
     search_start_time = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
     try:
-        events_result = service.events().list(
-            calendarId='primary', timeMin=search_start_time, singleEvents=True,
-            orderBy='startTime', maxResults=250
-        ).execute()
-        events = events_result.get('items', [])
+        events = await get_user_events(user_id, service, time_min=search_start_time)
         for event in events:
             event_summary = event.get('summary', '')
             match = re.search(r'^(.*?)\s\(', event_summary)
@@ -2548,7 +2731,7 @@ async def get_manual_date_for_file(update: Update, context: CallbackContext) ->
     user_id = update.effective_user.id # <-- ДОБАВЛЕНО
 
     # --- ИЗМЕНЕНИЕ: Получаем сервис для конкретного пользователя ---
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await update.message.reply_text("Ошибка авторизации.")
         return ConversationHandler.END
@@ -2567,8 +2750,7 @@ async def get_manual_date_for_file(update: Update, context: CallbackContext) ->
     time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
 
     try:
-        events = service.events().list(calendarId='primary', timeMin=time_min, timeMax=time_max,
-                                       singleEvents=True).execute().get('items', [])
+        events = await get_user_events(user_id, service, time_min=time_min, time_max=time_max)
         found_event = None
         for event in events:
             event_summary = event.get('summary', '')
@@ -2622,13 +2804,11 @@ def find_next_homework_event(user_id: int, subject: str) -> dict | None:
     if not service:
         return None
 
-    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    now = datetime.datetime.now(datetime.timezone.utc)
     try:
-        events_result = service.events().list(
-            calendarId='primary', timeMin=now, maxResults=100,
-            singleEvents=True, orderBy='startTime'
-        ).execute()
-        events = events_result.get('items', [])
+        # Текст ДЗ пользователь мог поправить прямо в Google Календаре — запрашиваем изменения по syncToken
+        event_mirror.mark_stale(user_id)
+        events = event_mirror.list_events(user_id, service, time_min=now, title_contains=config.HOMEWORK_TITLE_TAG)
 
         for event in events:
             summary = event.get('summary', '')
@@ -2656,7 +2836,7 @@ async def summary_choose_subject(update: Update, context: CallbackContext) -> in
     await query.edit_message_text(f"Ищу ближайшее ДЗ по предмету '{subject}'...")
 
     # --- 1. Ищем ближайшее ДЗ в Google Календаре ---
-    homework_event = await asyncio.to_thread(find_next_homework_event, user_id, subject)
+    homework_event = await google_async.run(find_next_homework_event, user_id, subject)
 
     # --- НОВЫЙ БЛОК: ИЗВЛЕКАЕМ ТЕКСТ ДЗ ---
     homework_text = ""
@@ -2755,6 +2935,7 @@ async def summary_file_chosen(update: Update, context: CallbackContext) -> int:
 
     file_id = None
     mime_type = None
+    textbook = None
 
     # --- 1. Определяем, какой файл был выбран, и получаем его данные ---
     if query.data == 'use_calendar_file':
@@ -2774,25 +2955,46 @@ async def summary_file_chosen(update: Update, context: CallbackContext) -> int:
 
     # --- 2. Определяем количество страниц ---
     page_count = 0
-    if mime_type == 'application/pdf':
+    if textbook and textbook.get('page_count'):
+        # Учебник уже обработан при загрузке: число страниц и оглавление есть в базе
+        page_count = textbook['page_count']
+    elif mime_type == 'application/pdf':
         await query.edit_message_text("Анализирую PDF, секунду...")
         # Запускаем подсчет страниц в фоне
-        count = await asyncio.to_thread(get_pdf_page_count, user_id, file_id)
+        count = await google_async.run(get_pdf_page_count, user_id, file_id)
         page_count = count if count is not None else 0
     elif mime_type and mime_type.startswith('image/'):
         page_count = 1
 
+    user_data['summary_page_count'] = page_count
+
     # --- 3. Выбираем дальнейший шаг в зависимости от кол-ва страниц ---
     if page_count > 1:
         # Сценарий 1: Страниц много (старое поведение)
         homework_text = user_data.get('homework_text')
-        message_text = f"В документе {page_count} страниц. Введите номера для анализа (например: 45, 48-51)."
+        message_text = (
+            f"В документе {page_count} страниц. Введите номера для анализа (например: 45, 48-51), "
+            f"не больше {config.SUMMARY_MAX_PAGES} страниц."
+        )
         if homework_text:
-            message_text = (
-                f"Текущее задание:\n```\n{homework_text}\n```\n\n"
-                f"В документе {page_count} страниц. Введите номера для анализа (например: 45, 48-51)."
-            )
-        await query.edit_message_text(text=message_text, parse_mode='Markdown')
+            message_text = f"Текущее задание:\n```\n{homework_text}\n```\n\n" + message_text
+
+        # Если у учебника есть оглавление, предлагаем выбрать раздел кнопкой
+        outline = get_outline_choices(textbook.get('outline')) if textbook else []
+        user_data['summary_outline'] = outline
+        reply_markup = None
+        if outline:
+            message_text += "\n\nИли выберите раздел из оглавления:"
+            buttons = [
+                [InlineKeyboardButton(
+                    f"{section['title'][:40]} (стр. {section['start_page']}-{section['end_page']})",
+                    callback_data=f"summary_chapter_{i}"
+                )]
+                for i, section in enumerate(outline)
+            ]
+            reply_markup = InlineKeyboardMarkup(buttons)
+
+        await query.edit_message_text(text=message_text, parse_mode='Markdown', reply_markup=reply_markup)
         return GET_PAGE_NUMBERS
 
     elif page_count == 1:
@@ -2817,6 +3019,58 @@ async def summary_file_chosen(update: Update, context: CallbackContext) -> int:
         return ConversationHandler.END
 
 
+def get_outline_choices(outline: list | None) -> list:
+    """
+    Выбирает из оглавления учебника разделы для кнопок: самый крупный уровень,
+    на котором разделов не больше SUMMARY_OUTLINE_MAX_BUTTONS.
+    """
+    if not outline:
+        return []
+    for level in sorted({section['level'] for section in outline}, reverse=True):
+        sections = [section for section in outline if section['level'] <= level]
+        if len(sections) <= config.SUMMARY_OUTLINE_MAX_BUTTONS:
+            return sections
+    return [section for section in outline if section['level'] == 1][:config.SUMMARY_OUTLINE_MAX_BUTTONS]
+
+
+async def ask_additional_info(message_func) -> int:
+    """Запрашивает дополнительные требования к конспекту."""
+    keyboard = [[InlineKeyboardButton("Пропустить", callback_data="skip_additional_info")]]
+    await message_func(
+        "Если есть дополнительные требования (например, ваш вариант или номер группы), "
+        "напишите их в следующем сообщении (до 30 символов).\n\n"
+        "Если требований нет, просто нажмите 'Пропустить'.",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+    return GET_ADDITIONAL_INFO
+
+
+async def summary_chapter_chosen(update: Update, context: CallbackContext) -> int:
+    """Берет страницы из выбранного раздела оглавления вместо ручного ввода номеров."""
+    query = update.callback_query
+    await query.answer()
+
+    outline = context.user_data.get('summary_outline') or []
+    section_index = int(query.data.split('_')[-1])
+    if section_index >= len(outline):
+        await query.edit_message_text("❌ Раздел не найден. Введите номера страниц вручную (например: 45, 48-51).")
+        return GET_PAGE_NUMBERS
+
+    section = outline[section_index]
+    pages_to_process = list(range(section['start_page'], section['end_page'] + 1))
+    if len(pages_to_process) > config.SUMMARY_MAX_PAGES:
+        await query.edit_message_text(
+            f"Раздел «{section['title']}» занимает {len(pages_to_process)} страниц, а за один раз можно обработать "
+            f"не больше {config.SUMMARY_MAX_PAGES}. Введите номера нужных страниц вручную "
+            f"(раздел: {section['start_page']}-{section['end_page']})."
+        )
+        return GET_PAGE_NUMBERS
+    context.user_data['pages_to_process'] = pages_to_process
+    context.user_data['pages_str'] = f"{section['start_page']}-{section['end_page']} ({section['title']})"
+
+    return await ask_additional_info(query.edit_message_text)
+
+
 async def summary_get_pages(update: Update, context: CallbackContext) -> int:
     """Получает и парсит номера страниц, запрашивает финальное подтверждение."""
     page_input = update.message.text
@@ -2842,6 +3096,11 @@ async def summary_get_pages(update: Update, context: CallbackContext) -> int:
 
         if not pages_to_process:
             raise ValueError("Не указаны страницы.")
+        page_count = context.user_data.get('summary_page_count')
+        if pages_to_process[0] < 1 or (page_count and pages_to_process[-1] > page_count):
+            raise ValueError(f"В документе только {page_count} страниц.")
+        if len(pages_to_process) > config.SUMMARY_MAX_PAGES:
+            raise ValueError(f"За один раз можно обработать не больше {config.SUMMARY_MAX_PAGES} страниц.")
 
     except ValueError as e:
         await update.message.reply_text(
@@ -2853,26 +3112,20 @@ async def summary_get_pages(update: Update, context: CallbackContext) -> int:
     context.user_data['pages_to_process'] = pages_to_process
     context.user_data['pages_str'] = ", ".join(map(str, pages_to_process))
 
-    keyboard = [[InlineKeyboardButton("Пропустить", callback_data="skip_additional_info")]]
-    await update.message.reply_text(
-        "Если есть дополнительные требования (например, ваш вариант или номер группы), "
-        "напишите их в следующем сообщении (до 30 символов).\n\n"
-        "Если требований нет, просто нажмите 'Пропустить'.",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
-    return GET_ADDITIONAL_INFO
+    return await ask_additional_info(update.message.reply_text)
 
 
-def download_file_from_drive(user_id: int, file_id: str) -> bytes | None:
-    """Скачивает файл с Google Drive по его ID и возвращает в виде байтов."""
+def get_drive_file_path(user_id: int, file_id: str, suffix: str = '.pdf') -> str | None:
+    """
+    Возвращает путь к локальной копии файла с Google Drive из кэша учебников.
+    Файл скачивается, только если его текущей версии еще нет в кэше. Файл закреплен в кэше,
+    после использования его нужно отпустить через textbook_cache.release(path).
+    """
     try:
         drive_service = get_drive_service(user_id)
         if not drive_service:
             return None
-
-        request = drive_service.files().get_media(fileId=file_id)
-        file_bytes = request.execute()
-        return file_bytes
+        return textbook_cache.get_path(drive_service, file_id, suffix=suffix, pin=True)
     except Exception as e:
         logger.error(f"Ошибка при скачивании файла {file_id} с Google Drive: {e}")
         return None
@@ -2914,6 +3167,7 @@ async def summary_show_final_confirmation(update: Update, context: CallbackConte
 
     keyboard = [
         [InlineKeyboardButton("✅ Начать", callback_data="confirm_summary_yes")],
+        [InlineKeyboardButton("📝 Начать без фото страниц", callback_data="confirm_summary_text_only")],
         [InlineKeyboardButton("❌ Отмена", callback_data="main_menu")]
     ]
 
@@ -2966,31 +3220,40 @@ def split_message(text: str, chunk_size: int = 4000) -> list[str]:
     return chunks
 
 def get_pdf_page_count(user_id: int, file_id: str) -> int | None:
-    """Скачивает PDF и возвращает количество страниц."""
-    pdf_bytes = download_file_from_drive(user_id, file_id)
-    if not pdf_bytes:
+    """
+    Возвращает количество страниц PDF: для учебника из базы — сохраненное при загрузке,
+    иначе по возможности не скачивая файл целиком (см. textbook_cache).
+    """
+    textbook = get_textbook_by_file_id(file_id)
+    if textbook and textbook.get('page_count'):
+        return textbook['page_count']
+    drive_service = get_drive_service(user_id)
+    if not drive_service:
         return None
     try:
-        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-            return doc.page_count
+        return textbook_cache.get_page_count(drive_service, file_id)
     except Exception as e:
         logger.error(f"Ошибка при подсчете страниц в PDF {file_id}: {e}")
         return None
 
 async def summary_generate(update: Update, context: CallbackContext) -> int:
-    """Финальный шаг: запускает скачивание, обработку и отправку результата."""
+    """
+    Финальный шаг: ставит задачу на конспект в очередь и завершает диалог.
+    Место в очереди и результат приходят в статусное сообщение и следующие за ним.
+    """
     query = update.callback_query
     await query.answer()
-    await query.edit_message_text("Начинаю обработку... Это может занять минуту. ⏳")
 
     user_id = update.effective_user.id
     user_data = context.user_data
     file_id_to_download = None
+    file_suffix = '.pdf'
 
     callback_data = user_data.get('chosen_file_callback')
     if callback_data == 'use_calendar_file':
         attachment = user_data.get('calendar_attachment')
         file_id_to_download = attachment.get('fileId')
+        file_suffix = mimetypes.guess_extension(attachment.get('mimeType') or '') or '.pdf'
     elif callback_data and callback_data.startswith('use_db_book_'):
         book_index = int(callback_data.split('_')[-1])
         textbook = user_data['db_textbooks'][book_index]
@@ -3001,22 +3264,72 @@ async def summary_generate(update: Update, context: CallbackContext) -> int:
         await main_menu(update, context, force_new_message=True)
         return ConversationHandler.END
 
-    pdf_bytes = await asyncio.to_thread(download_file_from_drive, user_id, file_id_to_download)
+    # Лимиты проверяются до постановки в очередь, чтобы не занимать ее запросами, которые все равно отклонятся
+    try:
+        await asyncio.to_thread(usage_limits.check_request, user_id)
+    except usage_limits.LimitExceeded as e:
+        await query.edit_message_text(f"⛔ {e}")
+        await main_menu(update, context, force_new_message=True)
+        return ConversationHandler.END
+
+    job_params = {
+        'file_id': file_id_to_download,
+        'file_suffix': file_suffix,
+        'pages': user_data.get('pages_to_process'),
+        'subject': user_data.get('selected_subject'),
+        'homework_text': user_data.get('homework_text', ''),
+        'pages_str': user_data.get('pages_str', ''),
+        'additional_info': user_data.get('additional_info'),
+        # Фото страниц рендерятся в высоком качестве, только если пользователь хочет их получить
+        'with_previews': query.data != 'confirm_summary_text_only',
+    }
+    status_message = query.message
+
+    async def on_position(position: int):
+        await status_message.edit_text(f"⏳ Запрос на конспект в очереди, ваше место: {position}.")
 
-    if not pdf_bytes:
-        await query.edit_message_text("❌ Ошибка при скачивании файла ...")
+    await query.edit_message_text("⏳ Запрос на конспект принят.")
+    try:
+        job_id, _ = await summary_queue.submit(
+            user_id, lambda: run_summary_job(update, context, status_message, job_params), on_position
+        )
+    except summary_queue.QueueFullError as e:
+        # Запрос так и не был принят — возвращаем его в лимит частоты
+        usage_limits.refund_request(user_id)
+        await query.edit_message_text(f"❌ {e}")
         await main_menu(update, context, force_new_message=True)
         return ConversationHandler.END
 
-    pages = user_data.get('pages_to_process')
-    subject = user_data.get('selected_subject')
-    homework_text = user_data.get('homework_text', '')
-    pages_str = user_data.get('pages_str', '')
-    additional_info = user_data.get('additional_info')
+    logger.info(f"Пользователь {user_id} поставил в очередь конспект {job_id}.")
+    user_data.clear()
+    return ConversationHandler.END
 
-    raw_summary, image_buffers = await asyncio.to_thread(
-        generate_summary_from_pdf, pdf_bytes, pages, subject, homework_text, user_id, pages_str, additional_info
-    )
+
+async def run_summary_job(update: Update, context: CallbackContext, status_message, params: dict):
+    """Задача из очереди конспектов: скачивает файл, готовит конспект и отправляет результат."""
+    user_id = update.effective_user.id
+
+    # Дневной бюджет проверяется и резервируется в generate_summary_from_pdf только перед обращением
+    # к OpenAI: конспект из кэша не расходует токенов и выдается даже при исчерпанном бюджете
+    preview = StreamingPreview(status_message, asyncio.get_running_loop())
+    pdf_path = None
+    try:
+        await status_message.edit_text("Начинаю обработку... Это может занять минуту. ⏳")
+        pdf_path = await google_async.run(get_drive_file_path, user_id, params['file_id'], params['file_suffix'])
+
+        if not pdf_path:
+            await status_message.edit_text("❌ Ошибка при скачивании файла ...")
+            await main_menu(update, context, force_new_message=True)
+            return
+
+        raw_summary, image_buffers = await asyncio.to_thread(
+            generate_summary_from_pdf, pdf_path, params['pages'], params['subject'], params['homework_text'], user_id,
+            params['pages_str'], params['additional_info'], params['with_previews'], params['file_id'], preview
+        )
+    finally:
+        if pdf_path:
+            textbook_cache.release(pdf_path)
+    await preview.wait()
 
     # --- ВОЗВРАЩАЕМ МОЩНУЮ ОЧИСТКУ ---
     first_char_match = re.search(r'\S', raw_summary)
@@ -3027,7 +3340,7 @@ async def summary_generate(update: Update, context: CallbackContext) -> int:
         summary = raw_summary.strip()
     # --------------------------------
 
-    await query.delete_message()
+    await status_message.delete()
     summary_chunks = split_message(summary)
 
     for chunk in summary_chunks:
@@ -3045,58 +3358,172 @@ async def summary_generate(update: Update, context: CallbackContext) -> int:
     if image_buffers:
         await context.bot.send_message(chat_id=user_id, text="Изображения страниц для вашего запроса:")
 
-        media_group = []
-        for buffer in image_buffers:
-            buffer.seek(0)
-            media_group.append(InputMediaPhoto(media=buffer))
-
-        # Отправляем группу, если она не пустая
-        if media_group:
-            await context.bot.send_media_group(chat_id=user_id, media=media_group)
+        # Уже отправленные кому-то страницы уходят по file_id, без повторной загрузки
+        await telegram_files.send_photo_group(context.bot, user_id, [buffer.getvalue() for buffer in image_buffers])
 
         # 3. В конце присылаем главное меню
     await main_menu(update, context, force_new_message=True)
 
-    user_data.clear()
-    return ConversationHandler.END
 
+def load_page_variants(pdf_path: str, requested: dict) -> dict:
+    """
+    Возвращает {страница: {вариант: данные}} для запрошенных {страница: варианты}, беря готовые из кэша страниц.
+    Недостающее рендерится параллельно в пуле процессов (page_render).
+    """
+    doc_key = page_cache.document_key(pdf_path)
+    result = {page_num: {} for page_num in requested}
+    missing = {}
+    for page_num, variants in requested.items():
+        for variant in variants:
+            data = page_cache.get(doc_key, page_num, variant)
+            if data is None:
+                missing.setdefault(page_num, []).append(variant)
+            else:
+                result[page_num][variant] = data
+
+    rendered = page_render.render_pages(pdf_path, missing)
+    for page_num, page_data in rendered.items():
+        for variant, data in page_data.items():
+            page_cache.put(doc_key, page_num, variant, data)
+            result[page_num][variant] = data
 
-def generate_summary_from_pdf(pdf_bytes: bytes, pages: list, subject: str, homework_text: str, user_id: int,
-                              pages_str: str, additional_info: str | None) -> tuple[str, list]:
+    logger.info(f"Данные страниц: {len(requested) - len(missing)} из кэша, {len(missing)} отрендерено.")
+    return result
+
+
+def get_summary_page_inputs(pdf_path: str, pages: list, with_previews: bool = True,
+                            file_id: str = None) -> tuple[list, list]:
     """
-    Извлекает страницы, создает 2 версии изображений (HQ для юзера, LQ для AI),
-    отправляет в GPT-4o и возвращает конспект и список HQ-изображений.
+    Готовит страницы для конспекта: возвращает HQ-изображения для пользователя (если with_previews)
+    и список входных данных для модели — текст страницы, если у нее хороший текстовый слой, иначе изображение.
+    Для учебника (file_id) анализ страниц берется из сохраненного при загрузке, остальные страницы разбираются.
+    Детализацию изображений (low/high) выбирает summary_input.plan_image_details в пределах бюджета токенов.
     """
-    image_buffers_for_user = []  # Список HQ изображений для отправки пользователю
-    base64_images_for_ai = []  # Список LQ изображений в base64 для OpenAI
+    analyses = {}
+    if config.SUMMARY_INPUT_MODE == 'auto' or config.SUMMARY_IMAGE_DETAIL_MODE == 'adaptive':
+        if file_id:
+            analyses = textbook_ingest.get_page_analyses(file_id, page_cache.document_key(pdf_path), pages)
+        missing = [page_num for page_num in pages if page_num not in analyses]
+        if missing:
+            texts = load_page_variants(pdf_path, {page_num: [page_cache.VARIANT_TEXT] for page_num in missing})
+            analyses.update({
+                page_num: summary_input.parse_analysis(data.get(page_cache.VARIANT_TEXT))
+                for page_num, data in texts.items()
+            })
+    kinds = {page_num: summary_input.choose_page_input(analyses.get(page_num)) for page_num in pages}
+
+    text_tokens = sum(
+        summary_input.estimate_text_tokens(analyses[page_num]['text'])
+        for page_num in pages if kinds[page_num] == summary_input.INPUT_TEXT
+    )
+    image_pages = [page_num for page_num in pages if kinds[page_num] == summary_input.INPUT_IMAGE]
+    details = summary_input.plan_image_details(analyses, image_pages, text_tokens)
+
+    requested = {}
+    for page_num in pages:
+        variants = [page_cache.VARIANT_HQ] if with_previews else []
+        if page_num in details:
+            variants.append(page_cache.VARIANT_HD if details[page_num] == summary_input.DETAIL_HIGH
+                            else page_cache.VARIANT_LQ)
+        requested[page_num] = variants
+    images = load_page_variants(pdf_path, requested)
+
+    hq_images = [images[page_num][page_cache.VARIANT_HQ] for page_num in pages] if with_previews else []
+    page_inputs = []
+    for page_num in pages:
+        analysis = analyses.get(page_num)
+        # Размер страницы в пунктах PDF — для оценки цены изображения (summary_input.page_image_tokens)
+        size = {'width': analysis['width'], 'height': analysis['height']} if analysis else {}
+        if kinds[page_num] == summary_input.INPUT_TEXT:
+            page_inputs.append({'page': page_num, 'kind': summary_input.INPUT_TEXT,
+                                'text': analysis['text'], **size})
+        elif details[page_num] == summary_input.DETAIL_HIGH:
+            page_inputs.append({'page': page_num, 'kind': summary_input.INPUT_IMAGE,
+                                'detail': summary_input.DETAIL_HIGH, 'image': images[page_num][page_cache.VARIANT_HD],
+                                **size})
+        else:
+            page_inputs.append({'page': page_num, 'kind': summary_input.INPUT_IMAGE,
+                                'detail': summary_input.DETAIL_LOW, 'image': images[page_num][page_cache.VARIANT_LQ],
+                                **size})
 
-    try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+    high_pages = [page_num for page_num, detail in details.items() if detail == summary_input.DETAIL_HIGH]
+    if high_pages:
+        logger.info(f"Страницы с detail=high: {high_pages}, остальные изображения — detail=low.")
+    return hq_images, page_inputs
 
-        for page_num in pages:
-            page = pdf_document.load_page(page_num - 1)
 
-            # --- 1. Создаем базовое изображение хорошего качества ---
-            pix = page.get_pixmap(dpi=150)  # DPI повыше для качества
-            img_high_quality = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+class StreamInterrupted(Exception):
+    """Поток ответа оборвался после того, как запрос был принят: токены уже израсходованы."""
 
-            # --- 2. Сохраняем ВЫСОКОКАЧЕСТВЕННУЮ версию для пользователя ---
-            buffer_for_user = io.BytesIO()
-            img_high_quality.save(buffer_for_user, format="JPEG", quality=90)  # Качество 90
-            image_buffers_for_user.append(buffer_for_user)
+    def __init__(self, error: Exception, partial_text: str):
+        super().__init__(str(error))
+        self.error = error
+        self.partial_text = partial_text
 
-            # --- 3. Создаем и сохраняем НИЗКОКАЧЕСТВЕННУЮ версию для ИИ ---
-            img_low_quality = img_high_quality.copy()  # Копируем, чтобы не портить оригинал
-            img_low_quality.thumbnail((512, 512))  # Сильно уменьшаем размер
 
-            buffer_for_ai = io.BytesIO()
-            img_low_quality.save(buffer_for_ai, format="JPEG", quality=50)  # Качество 50
+def stream_completion(client, completion_params: dict, on_partial) -> tuple[str, object, str]:
+    """
+    Запрашивает ответ потоком (stream=True) и передает накопленный текст в on_partial по мере поступления.
+    Возвращает полный текст, usage (приходит последним чанком благодаря include_usage) и finish_reason.
+    Если поток обрывается, выбрасывает StreamInterrupted с уже полученным текстом.
+    """
+    parts = []
+    usage = None
+    finish_reason = 'N/A'
+    stream = client.chat.completions.create(**completion_params, stream=True, stream_options={"include_usage": True})
+    try:
+        for chunk in stream:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if choice.finish_reason:
+                finish_reason = choice.finish_reason
+            if choice.delta and choice.delta.content:
+                parts.append(choice.delta.content)
+                on_partial(''.join(parts))
+    except Exception as e:
+        raise StreamInterrupted(e, ''.join(parts)) from e
+    return ''.join(parts), usage, finish_reason
 
-            base64_image = base64.b64encode(buffer_for_ai.getvalue()).decode('utf-8')
-            base64_images_for_ai.append(base64_image)
 
-        if not base64_images_for_ai:
+def generate_summary_from_pdf(pdf_path: str, pages: list, subject: str, homework_text: str, user_id: int,
+                              pages_str: str, additional_info: str | None,
+                              with_previews: bool = True, file_id: str = None,
+                              on_partial=None) -> tuple[str, list]:
+    """
+    Готовит страницы учебника и отправляет их в config.SUMMARY_OPENAI_MODEL, возвращает конспект
+    и список HQ-изображений для пользователя. Для каждой страницы summary_input выбирает вход для модели:
+    текстовый слой, если его хватает, иначе LQ-изображение.
+    Такой же запрос (та же версия файла, страницы, ДЗ и доп. требования) отдается из кэша конспектов.
+    Если включен SUMMARY_STREAMING, ответ читается потоком и on_partial(text) получает уже готовую часть.
+    """
+    try:
+        # Страниц не больше лимита, даже если проверку в диалоге обошли
+        pages = pages[:config.SUMMARY_MAX_PAGES]
+
+        cache_key = summary_input.make_cache_key(
+            page_cache.document_key(pdf_path), pages, subject, homework_text, additional_info
+        )
+        cached = get_cached_summary(cache_key)
+        if cached:
+            logger.info(f"Конспект для пользователя {user_id} взят из кэша ({cache_key[:12]}).")
+            image_buffers_for_user = []
+            if with_previews:
+                images = load_page_variants(pdf_path, {page_num: [page_cache.VARIANT_HQ] for page_num in pages})
+                image_buffers_for_user = [io.BytesIO(images[page_num][page_cache.VARIANT_HQ]) for page_num in pages]
+            log_g_sheets(user_id=user_id, prompt_tokens=0, completion_tokens=0, total_tokens=0,
+                         summary_text=cached['summary_text'], subject=subject, homework_text=homework_text,
+                         pages_str=pages_str, input_mode='cache')
+            return cached['summary_text'], image_buffers_for_user
+        hq_images, page_inputs = get_summary_page_inputs(pdf_path, pages, with_previews, file_id)
+        # Список HQ изображений для отправки пользователю
+        image_buffers_for_user = [io.BytesIO(image) for image in hq_images]
+
+        if not page_inputs:
             return "Не удалось извлечь страницы из файла.", []
+        input_mode, text_pages, tokens_saved = summary_input.describe_inputs(page_inputs)
 
         client = OpenAI(api_key=config.OPENAI_API_KEY)
 
@@ -3131,7 +3558,8 @@ def generate_summary_from_pdf(pdf_bytes: bytes, pages: list, subject: str, homew
             "4. Активно используй списки для лучшей читаемости.\n"
             "5. Не решай задания, только объясни общую суть того, что нужно сделать в анализе дз.\n"
             "6. Пиши только по-русски и сохраняй академический стиль.\n\n"
-            "Проанализируй изображения страниц и составь отформатированный конспект по этим строгим правилам."
+            "Страницы переданы ниже: текстом (если у страницы есть текстовый слой) или изображением.\n"
+            "Проанализируй материалы страниц и составь отформатированный конспект по этим строгим правилам."
             "\n\n---ДОПОЛНИТЕЛЬНАЯ ЗАДАЧА---\n"
             "В самом конце ответа, после основного конспекта, добавь дополнительный блок.\n"
             "1. Определи, что нужно пользователю сделать в домашнем задании.\n"
@@ -3149,42 +3577,78 @@ def generate_summary_from_pdf(pdf_bytes: bytes, pages: list, subject: str, homew
         )
 
         # ... (Код вызова API и логирования остается без изменений) ...
-        logger.info(f"Отправка {len(base64_images)} изображений в OpenAI.")
+        estimated_prompt_tokens = summary_input.estimate_prompt_tokens(prompt_text, page_inputs)
+        logger.info(
+            f"Отправка {len(page_inputs)} страниц в OpenAI (режим: {input_mode}, текстом: {text_pages}, "
+            f"оценка экономии: {tokens_saved} токенов, оценка входных токенов: {estimated_prompt_tokens})."
+        )
         # --- ДОБАВЛЯЕМ ЛОГ ДЛЯ ОТЛАДКИ ПРОМПТА ---
         logger.info(f"--- Финальный промпт для OpenAI ---\n{prompt_text}")
         # ----------------------------------------
         messages = [
             {"role": "user", "content": [
                 {"type": "text", "text": prompt_text},
-                # Добавляем все изображения страниц с низкой детализацией
-                *[
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{img}",
-                            "detail": "low"  # <-- ПРИНУДИТЕЛЬНО ВКЛЮЧАЕМ ЭКОНОМНЫЙ РЕЖИМ
-                        }
-                    }
-                    for img in base64_images
-                ]
+                # Добавляем страницы: текстом или изображениями с низкой детализацией
+                *summary_input.build_content_parts(page_inputs)
             ]}
         ]
-        response = client.chat.completions.create(model="gpt-5-mini", messages=messages, max_completion_tokens=6000)
+        completion_params = {"model": config.SUMMARY_OPENAI_MODEL, "messages": messages, "max_completion_tokens": 6000}
+
+        def log_usage(prompt_tokens: int, completion_tokens: int, summary_text: str, mode: str):
+            log_g_sheets(user_id=user_id, prompt_tokens=prompt_tokens, completion_tokens=completion_tokens,
+                         total_tokens=prompt_tokens + completion_tokens, summary_text=summary_text, subject=subject,
+                         homework_text=homework_text, pages_str=pages_str, input_mode=mode,
+                         text_pages=text_pages, tokens_saved=tokens_saved,
+                         estimated_prompt_tokens=estimated_prompt_tokens)
+
+        def log_estimated_usage(summary_text: str):
+            # usage не пришел (поток оборвался или не дошел последний чанк), но токены израсходованы:
+            # списываем оценку, чтобы вызов попал в журнал и в дневной бюджет
+            completion_tokens = summary_input.estimate_text_tokens(summary_text)
+            logger.warning(f"OpenAI не вернул usage, в журнал записана оценка: {estimated_prompt_tokens} + "
+                           f"{completion_tokens} токенов.")
+            log_usage(estimated_prompt_tokens, completion_tokens, summary_text, f"{input_mode}-estimate")
+
+        # Бюджет резервируется только сейчас, когда запрос к OpenAI действительно будет сделан
+        try:
+            usage_limits.reserve(user_id)
+        except usage_limits.LimitExceeded as e:
+            return f"⛔ {e}", []
+        try:
+            if config.SUMMARY_STREAMING and on_partial:
+                try:
+                    summary, response_usage, finish_reason = stream_completion(client, completion_params, on_partial)
+                except StreamInterrupted as e:
+                    log_estimated_usage(e.partial_text)
+                    raise e.error
+            else:
+                response = client.chat.completions.create(**completion_params)
+                summary = response.choices[0].message.content if response.choices else None
+                response_usage = response.usage
+                finish_reason = response.choices[0].finish_reason if response.choices else 'N/A'
 
-        if response.choices and response.choices[0].message.content:
-            summary = response.choices[0].message.content
-            if response.usage:
+            if response_usage:
                 logger.info(
-                    f"Токены: Входные: {response.usage.prompt_tokens}, Выходные: {response.usage.completion_tokens}, Всего: {response.usage.total_tokens}")
-                log_g_sheets(user_id=user_id, prompt_tokens=response.usage.prompt_tokens,
-                             completion_tokens=response.usage.completion_tokens,
-                             total_tokens=response.usage.total_tokens, summary_text=summary, subject=subject,
-                             homework_text=homework_text, pages_str=pages_str)
-            return summary, image_buffers
+                    f"Токены: Входные: {response_usage.prompt_tokens} (оценка: {estimated_prompt_tokens}), "
+                    f"Выходные: {response_usage.completion_tokens}, Всего: {response_usage.total_tokens}")
+                log_usage(response_usage.prompt_tokens, response_usage.completion_tokens, summary or '', input_mode)
+            else:
+                log_estimated_usage(summary or '')
+        finally:
+            # Фактический расход уже записан в журнал — резерв больше не нужен
+            usage_limits.release(user_id)
+
+        if summary:
+            usage = {}
+            if response_usage:
+                usage = {'prompt_tokens': response_usage.prompt_tokens,
+                         'completion_tokens': response_usage.completion_tokens,
+                         'total_tokens': response_usage.total_tokens}
+            save_cached_summary(cache_key, file_id, summary, usage)
+            return summary, image_buffers_for_user
         else:
-            logger.warning(
-                f"Ответ от OpenAI не содержит текста. Finish reason: {response.choices[0].finish_reason if response.choices else 'N/A'}")
-            return "Не удалось получить конспект от AI. Ответ от нейросети был пустым."
+            logger.warning(f"Ответ от OpenAI не содержит текста. Finish reason: {finish_reason}")
+            return "Не удалось получить конспект от AI. Ответ от нейросети был пустым.", []
 
 
     except Exception as e:
@@ -3199,6 +3663,39 @@ def generate_summary_from_pdf(pdf_bytes: bytes, pages: list, subject: str, homew
 
 
 
+#Фоновое обновление токенов Google
+
+async def refresh_tokens_job(context: CallbackContext):
+    """
+    Заранее обновляет токены, срок действия которых скоро истечет,
+    чтобы обработчики кнопок не ждали обновления токена.
+    """
+    refreshed, failed = await google_async.run(
+        auth_web.refresh_expiring_credentials,
+        config.TOKEN_REFRESH_MARGIN_SECONDS, config.TOKEN_REFRESH_MAX_WORKERS
+    )
+    if refreshed:
+        logger.info(f"Фоновое обновление: обновлено токенов: {len(refreshed)}.")
+    if not failed:
+        return
+
+    logger.warning(f"Фоновое обновление: не удалось обновить токены пользователей: {failed}")
+
+    # Сообщаем разработчику только о новых ошибках, чтобы не присылать одно и то же каждые 10 минут
+    reported = context.bot_data.setdefault('token_refresh_failures', set())
+    new_failures = [user_id for user_id in failed if user_id not in reported]
+    reported.intersection_update(failed)
+    reported.update(failed)
+    if new_failures and config.DEVELOPER_TELEGRAM_ID:
+        try:
+            await context.bot.send_message(
+                chat_id=config.DEVELOPER_TELEGRAM_ID,
+                text=f"⚠️ Не удалось обновить Google-токены пользователей: {', '.join(map(str, new_failures))}"
+            )
+        except Exception as e:
+            logger.error(f"Не удалось уведомить разработчика об ошибках обновления токенов: {e}")
+
+
 #Напоминание админам о записи дз
 
 
@@ -3241,14 +3738,8 @@ async def check_seminars_and_schedule_reminders(context: CallbackContext):
     if 'scheduled_reminders' not in bot_data:
         bot_data['scheduled_reminders'] = set()
 
-    # Ищем всех пользователей по файлам токенов
-    try:
-        user_ids = [
-            int(f.split('_')[1].split('.')[0])
-            for f in os.listdir(auth_web.TOKEN_DIR) if f.startswith('token_')
-        ]
-    except (FileNotFoundError, IndexError):
-        user_ids = []
+    # Ищем всех зарегистрированных пользователей
+    user_ids = get_group_user_ids()
 
     now = datetime.datetime.now(datetime.timezone.utc)
     # Ищем семинары в ближайшие 30 минут
@@ -3257,15 +3748,14 @@ async def check_seminars_and_schedule_reminders(context: CallbackContext):
     unique_seminars = set()
 
     for user_id in user_ids:
-        service = get_calendar_service(user_id)
+        service = await get_calendar_service_async(user_id)
         if not service:
             continue
 
         try:
-            events = service.events().list(
-                calendarId='primary', timeMin=now.isoformat(), timeMax=time_max.isoformat(),
-                singleEvents=True, orderBy='startTime'
-            ).execute().get('items', [])
+            events = await get_user_events(
+                user_id, service, time_min=now, time_max=time_max, color_id=config.COLOR_MAP.get("Семинар")
+            )
 
             for event in events:
                 # Ищем только семинары
@@ -3325,6 +3815,48 @@ async def reminder_ignore(update: Update, context: CallbackContext) -> None:
             logger.warning(f"Unexpected error in reminder_ignore: {e}")
 
 
+async def clear_summary_cache_command(update: Update, context: CallbackContext) -> None:
+    """
+    Команда админа /clear_summary_cache [file_id]: удаляет сохраненные конспекты
+    по файлу или, без аргумента, все.
+    """
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    file_id = context.args[0] if context.args else None
+    deleted = await asyncio.to_thread(delete_cached_summaries, file_id)
+    target = f"по файлу {file_id}" if file_id else "все"
+    await update.message.reply_text(f"🧹 Кэш конспектов очищен ({target}), удалено записей: {deleted}.")
+
+
+async def usage_command(update: Update, context: CallbackContext) -> None:
+    """
+    Команда админа /usage [user_id]: расход токенов за сегодня по пользователям
+    или по дням и предметам за неделю для одного пользователя.
+    """
+    if update.effective_user.id not in config.ADMIN_IDS:
+        return
+    if context.args and context.args[0].isdigit():
+        user_id = int(context.args[0])
+        rows = await asyncio.to_thread(usage_ledger.get_user_usage, user_id)
+        lines = [f"📊 Пользователь {user_id}, последние 7 дней:"]
+        lines += [
+            f"{row['day']} · {row['subject'] or '—'}: {row['requests']} запр. (из кэша {row['cache_hits']}), "
+            f"{row['total_tokens']} токенов"
+            for row in rows
+        ]
+    else:
+        rows = await asyncio.to_thread(usage_ledger.get_daily_totals)
+        lines = [f"📊 Расход за {usage_ledger.today()}:"]
+        lines += [
+            f"{row['user_id']}: {row['requests']} запр. (из кэша {row['cache_hits']}), {row['total_tokens']} токенов"
+            for row in rows
+        ]
+    if len(lines) == 1:
+        lines.append("Запросов не было.")
+    for chunk in split_message("\n".join(lines)):
+        await update.message.reply_text(chunk)
+
+
 async def reminder_add_hw_start(update: Update, context: CallbackContext) -> int:
     """
     Начинает диалог добавления ДЗ из напоминания, пропуская шаг выбора предмета.
@@ -3511,15 +4043,7 @@ def create_group_event_blocking(event_data: dict) -> int:
     logger.info(f"Начинаю создание кастомного мероприятия: {event_data}")
 
     # --- 1. Ищем всех пользователей ---
-    user_ids = []
-    if not config.DEBUG_MODE:
-        try:
-            user_ids = [int(f.split('_')[1].split('.')[0]) for f in os.listdir(auth_web.TOKEN_DIR) if
-                        f.startswith('token_')]
-        except (FileNotFoundError, IndexError):
-            user_ids = []
-    elif config.ADMIN_IDS:
-        user_ids.append(config.ADMIN_IDS[0])
+    user_ids = get_group_user_ids()
 
     if not user_ids:
         logger.warning("Не найдено пользователей для создания мероприятия.")
@@ -3566,22 +4090,33 @@ def create_group_event_blocking(event_data: dict) -> int:
 
     if event_data['duration'] == "Весь семестр":
         interval = 2 if event_data['week'] in ["Четная", "Нечетная"] else 1
-        end_of_semester = "20251231T235959Z"  # Примерная дата конца семестра
+        end_of_semester = datetime.date.fromisoformat(config.SEMESTER_END_DATE).strftime('%Y%m%dT235959Z')
         event_body['recurrence'] = [f'RRULE:FREQ=WEEKLY;INTERVAL={interval};UNTIL={end_of_semester}']
 
     # --- 3. Добавляем событие для каждого пользователя ---
-    created_count = 0
-    for user_id in user_ids:
+    # Заранее выбранный ID события делает повторную вставку после временной ошибки безопасной:
+    # если первая попытка на самом деле прошла, Google ответит 409 и дубля не будет
+    event_ids = {user_id: uuid.uuid4().hex for user_id in user_ids}
+
+    def create_for_user(user_id) -> bool:
+        service = get_calendar_service(user_id)
+        if not service:
+            return False
+        body = {**event_body, 'id': event_ids[user_id]}
         try:
-            service = get_calendar_service(user_id)
-            if service:
-                service.events().insert(calendarId='primary', body=event_body).execute()
-                created_count += 1
-                logger.info(f"Событие '{event_data['name']}' создано для user_id {user_id}")
-        except Exception as e:
-            logger.error(f"Не удалось создать событие для user_id {user_id}: {e}")
+            service.events().insert(calendarId='primary', body=body).execute()
+        except HttpError as e:
+            if e.resp.status != 409:
+                raise
+        logger.info(f"Событие '{event_data['name']}' создано для user_id {user_id}")
+        return True
 
-    return created_count
+    result = fanout.run_for_users(user_ids, create_for_user)
+    # Серии повторяющихся событий раскрываются на стороне Google, поэтому копии календарей просто помечаются устаревшими
+    for user_id in result.succeeded:
+        event_mirror.mark_stale(user_id)
+    subject_registry.add_custom_subject(event_data['name'], result.succeeded)
+    return len(result.succeeded)
 
 
 async def create_event_confirm(update: Update, context: CallbackContext) -> int:
@@ -3592,7 +4127,7 @@ async def create_event_confirm(update: Update, context: CallbackContext) -> int:
 
     event_data = context.user_data['new_event']
 
-    created_count = await asyncio.to_thread(create_group_event_blocking, event_data)
+    created_count = await google_async.run(create_group_event_blocking, event_data)
 
     await query.edit_message_text(
         f"✅ Готово! Мероприятие «{event_data['name']}» создано у {created_count} пользователей.",
@@ -3606,65 +4141,56 @@ async def create_event_confirm(update: Update, context: CallbackContext) -> int:
 
 
 # --- ЛОГИКА РЕДАКТИРОВАНИЯ МЕРОПРИЯТИЙ (ADMIN) ---
-def get_all_subjects_from_calendar(user_id: int) -> set:
-    """Собирает названия всех уникальных будущих мероприятий из календаря пользователя."""
+def get_all_subjects_from_calendar(user_id: int) -> set | None:
+    """
+    Собирает названия всех уникальных будущих мероприятий из календаря пользователя.
+    Возвращает None, если календарь прочитать не удалось.
+    """
     service = get_calendar_service(user_id)
     if not service:
-        return set()
+        return None
 
-    now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+    now = datetime.datetime.now(datetime.timezone.utc)
     unique_subjects = set()
-    page_token = None
 
-    while True:
-        try:
-            events_result = service.events().list(
-                calendarId='primary',
-                timeMin=now,
-                maxResults=2500,
-                singleEvents=True,
-                pageToken=page_token,
-                privateExtendedProperty='bot_managed_custom=true'  # <-- ИЩЕМ ТОЛЬКО НОВЫЕ МЕРОПРИЯТИЯ
-            ).execute()
-            events = events_result.get('items', [])
+    try:
+        # Ищем только мероприятия, созданные ботом
+        events = event_mirror.list_events(user_id, service, time_min=now,
+                                          private_property=('bot_managed_custom', 'true'))
+    except Exception as e:
+        logger.error(f"Ошибка при получении списка событий из календаря: {e}")
+        return None
 
-            for event in events:
-                summary = event.get('summary', '')
-                # Извлекаем чистое название предмета, без кабинета
-                match = re.search(r'^(.*?)\s\(', summary)
-                subject = match.group(1).strip() if match else summary.strip()
-                if subject:
-                    unique_subjects.add(subject)
-
-            page_token = events_result.get('nextPageToken')
-            if not page_token:
-                break
-        except Exception as e:
-            logger.error(f"Ошибка при получении списка событий из календаря: {e}")
-            break
+    for event in events:
+        summary = event.get('summary', '')
+        # Извлекаем чистое название предмета, без кабинета
+        match = re.search(r'^(.*?)\s\(', summary)
+        subject = match.group(1).strip() if match else summary.strip()
+        if subject:
+            unique_subjects.add(subject)
 
     return unique_subjects
 
 
+def refresh_user_subjects(user_ids: list):
+    """Заново собирает кастомные предметы пользователей из их календарей (после удаления или переименования)."""
+    def refresh_for_user(user_id) -> bool:
+        subjects = get_all_subjects_from_calendar(user_id)
+        if subjects is None:
+            return False
+        subject_registry.set_user_subjects(user_id, subjects)
+        return True
+
+    fanout.run_for_users(user_ids, refresh_for_user)
+
+
 async def edit_event_start(update: Update, context: CallbackContext) -> int:
     """Начинает диалог редактирования. Запрашивает предмет из динамического списка."""
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
 
-    # 1. Собираем статичные предметы из config.py
-    static_subjects = set(l['subject'] for d in config.SCHEDULE_DATA.values() for w in d.values() for l in w)
-
-    # 2. Собираем кастомные предметы из календаря
-    calendar_subjects = await asyncio.to_thread(get_all_subjects_from_calendar, user_id)
-
-    # 3. Объединяем их в один уникальный список
-    all_subjects = sorted(list(static_subjects.union(calendar_subjects)))
-
-    # 4. Добавляем специальный пункт про Лабораторную
-    if "Теоретические основы информатики" in all_subjects and "Лабораторная: Теоретические основы информатики" not in all_subjects:
-        all_subjects.append("Лабораторная: Теоретические основы информатики")
-        all_subjects.sort()
+    all_subjects = await get_dynamic_subject_list(user_id)
 
     if not all_subjects:
         await query.edit_message_text("В вашем календаре нет будущих мероприятий для редактирования.")
@@ -3709,7 +4235,7 @@ async def edit_event_get_date(update: Update, context: CallbackContext) -> int:
         return EDIT_EVENT_GET_DATE
 
     # Ищем событие в календаре администратора, чтобы получить его ID
-    service = get_calendar_service(user_id)
+    service = await get_calendar_service_async(user_id)
     if not service:
         await update.message.reply_text("Ошибка авторизации. Не удалось получить доступ к календарю.")
         return ConversationHandler.END
@@ -3717,9 +4243,7 @@ async def edit_event_get_date(update: Update, context: CallbackContext) -> int:
     time_min = datetime.datetime.combine(target_date, datetime.time.min).isoformat() + 'Z'
     time_max = datetime.datetime.combine(target_date, datetime.time.max).isoformat() + 'Z'
 
-    events = service.events().list(
-        calendarId='primary', timeMin=time_min, timeMax=time_max, singleEvents=True
-    ).execute().get('items', [])
+    events = await get_user_events(user_id, service, time_min=time_min, time_max=time_max)
 
     found_event = None
     for event in events:
@@ -3759,40 +4283,38 @@ def delete_group_event_blocking(iCalUID: str) -> int:
         return 0
 
     # --- 1. Ищем всех пользователей ---
-    user_ids = []
-    # ... (логика поиска user_ids, такая же как в create_group_event_blocking)
-    if config.DEBUG_MODE and config.ADMIN_IDS:
-        user_ids.append(config.ADMIN_IDS[0])
-    else:
-        try:
-            user_ids = [int(f.split('_')[1].split('.')[0]) for f in os.listdir(auth_web.TOKEN_DIR) if
-                        f.startswith('token_')]
-        except (FileNotFoundError, IndexError):
-            user_ids = []
+    user_ids = get_group_user_ids()
 
     if not user_ids:
         return 0
 
     # --- 2. Удаляем событие для каждого пользователя ---
-    deleted_count = 0
-    for user_id in user_ids:
-        try:
-            service = get_calendar_service(user_id)
-            if not service:
-                continue
-
-            # Находим событие в календаре пользователя по уникальному iCalUID
-            events_to_delete = service.events().list(calendarId='primary', iCalUID=iCalUID).execute().get('items', [])
+    def delete_for_user(user_id) -> bool:
+        service = get_calendar_service(user_id)
+        if not service:
+            return False
 
-            if events_to_delete:
-                event_id_to_delete = events_to_delete[0]['id']
-                service.events().delete(calendarId='primary', eventId=event_id_to_delete).execute()
-                deleted_count += 1
-                logger.info(f"Событие с iCalUID {iCalUID} удалено для user_id {user_id}")
-        except Exception as e:
-            logger.error(f"Не удалось удалить событие для user_id {user_id}: {e}")
+        # Находим событие в календаре пользователя по уникальному iCalUID
+        events_to_delete = service.events().list(calendarId='primary', iCalUID=iCalUID).execute().get('items', [])
+        if not events_to_delete:
+            return False
 
-    return deleted_count
+        event_id_to_delete = events_to_delete[0]['id']
+        try:
+            service.events().delete(calendarId='primary', eventId=event_id_to_delete).execute()
+        except HttpError as e:
+            # 410: событие уже удалено (например, предыдущей попыткой)
+            if e.resp.status != 410:
+                raise
+        logger.info(f"Событие с iCalUID {iCalUID} удалено для user_id {user_id}")
+        return True
+
+    result = fanout.run_for_users(user_ids, delete_for_user)
+    for user_id in result.succeeded:
+        event_mirror.mark_stale(user_id)
+    # Удаленное название может остаться у других мероприятий — пересобираем предметы затронутых пользователей
+    refresh_user_subjects(result.succeeded)
+    return len(result.succeeded)
 
 
 async def edit_event_delete(update: Update, context: CallbackContext) -> int:
@@ -3825,7 +4347,7 @@ async def edit_event_delete_confirm(update: Update, context: CallbackContext) ->
 
     await query.edit_message_text(f"Удаляю мероприятие «{summary}»... Это может занять время.")
 
-    deleted_count = await asyncio.to_thread(delete_group_event_blocking, iCalUID)
+    deleted_count = await google_async.run(delete_group_event_blocking, iCalUID)
 
     await query.edit_message_text(f"✅ Готово! Мероприятие удалено у {deleted_count} пользователей.")
 
@@ -3869,7 +4391,7 @@ async def edit_event_save_new_value(update: Update, context: CallbackContext) ->
     await update.message.reply_text(f"Обновляю '{action}' для мероприятия «{summary}» у всех пользователей...")
 
     # Запускаем фоновую задачу обновления
-    updated_count = await asyncio.to_thread(
+    updated_count = await google_async.run(
         update_group_event_blocking, iCalUID, action, new_value
     )
 
@@ -3885,53 +4407,45 @@ def update_group_event_blocking(iCalUID: str, attribute_to_update: str, new_valu
     if not iCalUID:
         return 0
 
-    # ... (логика поиска user_ids, такая же как в delete_group_event_blocking)
-    user_ids = []
-    if config.DEBUG_MODE and config.ADMIN_IDS:
-        user_ids.append(config.ADMIN_IDS[0])
-    else:
-        try:
-            user_ids = [int(f.split('_')[1].split('.')[0]) for f in os.listdir(auth_web.TOKEN_DIR) if
-                        f.startswith('token_')]
-        except (FileNotFoundError, IndexError):
-            user_ids = []
-
-    updated_count = 0
-    for user_id in user_ids:
-        try:
-            service = get_calendar_service(user_id)
-            if not service:
-                continue
-
-            events_to_update = service.events().list(calendarId='primary', iCalUID=iCalUID).execute().get('items', [])
-
-            if events_to_update:
-                event = events_to_update[0]
-
-                if attribute_to_update == 'name':
-                    room_match = re.search(r'\((.*?)\)', event['summary'])
-                    room = room_match.group(1) if room_match else ''
-                    event['summary'] = f"{new_value} ({room})"
+    user_ids = get_group_user_ids()
 
-                    # --- НОВАЯ ЛОГИКА ---
-                elif attribute_to_update == 'room':
-                    # Заменяем содержимое в скобках на новый кабинет
-                    old_summary = event['summary']
-                    event['summary'] = re.sub(r'\(.*?\)', f'({new_value})', old_summary)
-
-                elif attribute_to_update == 'teacher':
-                    event['description'] = f"Преподаватель: {new_value}"
-
-                elif attribute_to_update == 'type':
-                    # "Другой" тип будет желтым (id=5), остальные - по карте цветов
-                    event['colorId'] = config.COLOR_MAP.get(new_value, "5")
-                service.events().update(calendarId='primary', eventId=event['id'], body=event).execute()
-                updated_count += 1
-                logger.info(f"Событие с iCalUID {iCalUID} обновлено для user_id {user_id}")
-        except Exception as e:
-            logger.error(f"Не удалось обновить событие для user_id {user_id}: {e}")
-
-    return updated_count
+    def update_for_user(user_id) -> bool:
+        service = get_calendar_service(user_id)
+        if not service:
+            return False
+
+        events_to_update = service.events().list(calendarId='primary', iCalUID=iCalUID).execute().get('items', [])
+        if not events_to_update:
+            return False
+        event = events_to_update[0]
+
+        if attribute_to_update == 'name':
+            room_match = re.search(r'\((.*?)\)', event['summary'])
+            room = room_match.group(1) if room_match else ''
+            event['summary'] = f"{new_value} ({room})"
+
+            # --- НОВАЯ ЛОГИКА ---
+        elif attribute_to_update == 'room':
+            # Заменяем содержимое в скобках на новый кабинет
+            old_summary = event['summary']
+            event['summary'] = re.sub(r'\(.*?\)', f'({new_value})', old_summary)
+
+        elif attribute_to_update == 'teacher':
+            event['description'] = f"Преподаватель: {new_value}"
+
+        elif attribute_to_update == 'type':
+            # "Другой" тип будет желтым (id=5), остальные - по карте цветов
+            event['colorId'] = config.COLOR_MAP.get(new_value, "5")
+        service.events().update(calendarId='primary', eventId=event['id'], body=event).execute()
+        logger.info(f"Событие с iCalUID {iCalUID} обновлено для user_id {user_id}")
+        return True
+
+    result = fanout.run_for_users(user_ids, update_for_user)
+    for user_id in result.succeeded:
+        event_mirror.mark_stale(user_id)
+    if attribute_to_update == 'name':
+        refresh_user_subjects(result.succeeded)
+    return len(result.succeeded)
 
 
 async def edit_event_ask_for_type(update: Update, context: CallbackContext) -> int:
@@ -3971,7 +4485,7 @@ async def edit_event_save_new_type(update: Update, context: CallbackContext) ->
 
     await query.edit_message_text(f"Обновляю '{action}' для мероприятия «{summary}» у всех пользователей...")
 
-    updated_count = await asyncio.to_thread(
+    updated_count = await google_async.run(
         update_group_event_blocking, iCalUID, action, new_value
     )
 
@@ -4007,17 +4521,17 @@ async def handle_docx_file(update: Update, context: CallbackContext) -> int:
 
     await message.reply_text("Принято! Начинаю форматирование, это может занять несколько секунд...")
 
-    file = await doc.get_file()
-    file_bytes = await file.download_as_bytearray()
+    async def make_formatted_document() -> bytes:
+        file = await doc.get_file()
+        file_bytes = await file.download_as_bytearray()
+        # Запускаем нашу "тяжелую" функцию в отдельном потоке
+        return await asyncio.to_thread(format_docx, bytes(file_bytes))
 
-    # Запускаем нашу "тяжелую" функцию в отдельном потоке
-    formatted_bytes = await asyncio.to_thread(format_docx, bytes(file_bytes))
-
-    # Отправляем отформатированный файл обратно пользователю
-    await message.reply_document(
-        document=io.BytesIO(formatted_bytes),
-        filename=f"formatted_{doc.file_name}"
-    )
+    # Этот же файл Telegram (например, пересланный одногруппником) уже форматировали —
+    # отправляем готовый результат по file_id без скачивания, форматирования и загрузки
+    filename = f"formatted_{doc.file_name}"
+    key = f"docx:{config.DOCX_FORMATTER_VERSION}:{doc.file_unique_id}:{filename}"
+    await telegram_files.reply_cached_document(message, key, make_formatted_document, filename)
 
     # Завершаем диалог
     return ConversationHandler.END
@@ -4045,8 +4559,17 @@ async def main() -> None:
     job_queue = application.job_queue
     # Запускаем проверку каждые 15 минут (900 секунд)
     job_queue.run_repeating(check_seminars_and_schedule_reminders, interval=900, first=10)
+    # Обновляем токены заранее, чтобы в обработчиках не было сетевых запросов к OAuth
+    job_queue.run_repeating(refresh_tokens_job, interval=config.TOKEN_REFRESH_INTERVAL_SECONDS, first=5)
     # ---------------------------------------------
 
+    # Внешние подключения открываются здесь, а не при импорте: процессы пула рендеринга
+    # (spawn) заново импортируют этот модуль как __mp_main__ и не должны их повторять
+    database.init()
+    sheets_logger.init()
+
+    # Загружаем учетные данные всех пользователей одним запросом до старта обработчиков
+    auth_web.init_credential_store()
     auth_web.run_oauth_server()
 
     # --- ОПРЕДЕЛЕНИЕ ОБРАБОТчикОВ ДИАЛОГОВ ---
@@ -4208,14 +4731,15 @@ async def main() -> None:
                 CallbackQueryHandler(summary_file_chosen, pattern=r'^use_db_book_')
             ],
             GET_PAGE_NUMBERS: [
-                MessageHandler(filters.TEXT & ~filters.COMMAND, summary_get_pages)
+                MessageHandler(filters.TEXT & ~filters.COMMAND, summary_get_pages),
+                CallbackQueryHandler(summary_chapter_chosen, pattern=r'^summary_chapter_')
             ],
             GET_ADDITIONAL_INFO: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, summary_get_additional_info),
                 CallbackQueryHandler(summary_skip_additional_info, pattern='^skip_additional_info$')
             ],
             CONFIRM_SUMMARY_GENERATION: [
-                CallbackQueryHandler(summary_generate, pattern='^confirm_summary_yes$')
+                CallbackQueryHandler(summary_generate, pattern='^confirm_summary_(yes|text_only)$')
             ]
         },
         fallbacks=[CommandHandler('start', start_over_fallback), main_menu_fallback],
@@ -4347,6 +4871,8 @@ async def main() -> None:
     application.add_error_handler(error_handler)
     application.add_handler(summary_handler)
     application.add_handler(CallbackQueryHandler(reminder_ignore, pattern='^reminder_ignore$'), group=1)
+    application.add_handler(CommandHandler('clear_summary_cache', clear_summary_cache_command), group=1)
+    application.add_handler(CommandHandler('usage', usage_command), group=1)
     application.add_handler(event_creation_handler)
     application.add_handler(edit_event_handler)
     application.add_handler(docx_formatter_handler)
@@ -4367,12 +4893,18 @@ async def main() -> None:
         logging.info("Бот запущен...")
         await application.start()
         await application.updater.start_polling()
+        summary_queue.start()
+        sheets_logger.start()
         while True:
             await asyncio.sleep(3600)
     finally:
+        await summary_queue.stop()
         await application.updater.stop()
         await application.stop()
         await runner.cleanup()
+        google_async.shutdown()
+        page_render.shutdown()
+        await asyncio.to_thread(sheets_logger.stop)
         logging.info("Бот и веб-серверы остановлены.")
 
 
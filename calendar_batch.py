@@ -0,0 +1,167 @@
+# calendar_batch.py
+
+import time
+import random
+import logging
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from googleapiclient.errors import HttpError
+import config
+import fanout
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimiter:
+    """Ограничитель скорости (token bucket): не больше rate запросов в секунду с запасом burst."""
+
+    def __init__(self, rate: float, burst: int = None):
+        self.rate = rate
+        self.capacity = burst or max(1, int(rate))
+        self.tokens = float(self.capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, count: int = 1):
+        """Ждет, пока не освободится count запросов. Пакет больше burst забирает весь запас и уходит в минус."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= min(count, self.capacity):
+                    self.tokens -= count
+                    return
+                wait_time = (min(count, self.capacity) - self.tokens) / self.rate
+            time.sleep(wait_time)
+
+
+@dataclass
+class BatchResult:
+    """Итог пакетной операции: ответы успешных запросов и ошибки неуспешных (по ключу запроса)."""
+    succeeded: dict = field(default_factory=dict)
+    failed: dict = field(default_factory=dict)
+
+    def summary(self) -> str:
+        return f"успешно: {len(self.succeeded)}, ошибок: {len(self.failed)}"
+
+
+def _is_success_status(error: Exception, ok_statuses: tuple) -> bool:
+    return isinstance(error, HttpError) and error.resp.status in ok_statuses
+
+
+def run_batched(service, requests: list, *, ok_statuses: tuple = (), progress_callback=None,
+                max_workers: int = None, max_batch_size: int = None, rate: float = None,
+                retries: int = None) -> BatchResult:
+    """
+    Выполняет запросы Google API пакетами (batch) в несколько потоков.
+
+    requests — список пар (key, make_request), где make_request() возвращает новый HttpRequest.
+    Пакеты отправляются параллельно под общим ограничителем скорости. Повторяются только
+    те запросы внутри пакета, которые завершились временной ошибкой (429/5xx/лимиты);
+    при таких ошибках размер следующих пакетов уменьшается, при успешных — снова растет.
+    Ошибки с кодом из ok_statuses считаются успехом (например, 409 при повторной вставке).
+    progress_callback(done, total) вызывается из рабочих потоков после каждого пакета.
+    """
+    max_workers = max_workers or config.CALENDAR_BATCH_MAX_WORKERS
+    max_batch_size = max_batch_size or config.CALENDAR_BATCH_MAX_SIZE
+    retries = config.FANOUT_MAX_RETRIES if retries is None else retries
+    limiter = RateLimiter(rate or config.CALENDAR_REQUESTS_PER_SECOND)
+
+    result = BatchResult()
+    total = len(requests)
+    if not total:
+        return result
+
+    factories = dict(requests)
+    pending = deque((key, 0) for key, _ in requests)
+    state = {'batch_size': max_batch_size, 'in_flight': 0, 'pause_until': 0.0}
+    condition = threading.Condition()
+
+    def take_batch() -> list | None:
+        """Забирает очередной пакет из очереди; None — работа закончена."""
+        with condition:
+            while not pending:
+                if state['in_flight'] == 0:
+                    return None
+                condition.wait(timeout=1)
+            size = state['batch_size']
+            batch_items = [pending.popleft() for _ in range(min(size, len(pending)))]
+            state['in_flight'] += 1
+            return batch_items
+
+    def finish_batch(batch_items: list, errors: dict):
+        """Разбирает результаты пакета: повторяет временные ошибки, подстраивает размер пакетов."""
+        throttled = False
+        with condition:
+            for key, attempt in batch_items:
+                if key not in errors:
+                    continue
+                error = errors[key]
+                if attempt < retries and fanout.is_retryable_error(error):
+                    pending.append((key, attempt + 1))
+                    throttled = True
+                else:
+                    result.failed[key] = error
+
+            if throttled:
+                state['batch_size'] = max(config.CALENDAR_BATCH_MIN_SIZE, state['batch_size'] // 2)
+                delay = config.FANOUT_BACKOFF_BASE_SECONDS * (1 + random.uniform(0, 0.5))
+                state['pause_until'] = max(state['pause_until'], time.monotonic() + delay)
+            else:
+                state['batch_size'] = min(max_batch_size, state['batch_size'] + config.CALENDAR_BATCH_MIN_SIZE)
+
+            state['in_flight'] -= 1
+            done = len(result.succeeded) + len(result.failed)
+            condition.notify_all()
+
+        if throttled:
+            logger.info(f"Временные ошибки в пакете, размер пакета уменьшен до {state['batch_size']}.")
+        if progress_callback:
+            try:
+                progress_callback(done, total)
+            except Exception as e:
+                logger.warning(f"Ошибка при отправке прогресса пакетной операции: {e}")
+
+    def worker():
+        while True:
+            batch_items = take_batch()
+            if batch_items is None:
+                return
+
+            pause = state['pause_until'] - time.monotonic()
+            if pause > 0:
+                time.sleep(pause)
+            limiter.acquire(len(batch_items))
+
+            errors = {}
+
+            def callback(request_id, response, exception):
+                if exception is None or _is_success_status(exception, ok_statuses):
+                    with condition:
+                        result.succeeded[request_id] = response
+                else:
+                    errors[request_id] = exception
+
+            try:
+                batch = service.new_batch_http_request(callback=callback)
+                for key, _ in batch_items:
+                    batch.add(factories[key](), request_id=key)
+                batch.execute()
+            except Exception as e:
+                # Пакет целиком не дошел до Google: ошибку получают все запросы, которые еще без ответа
+                logger.error(f"Ошибка при выполнении batch-запроса: {e}")
+                for key, _ in batch_items:
+                    if key not in result.succeeded:
+                        errors.setdefault(key, e)
+            finish_batch(batch_items, errors)
+
+    workers = min(max_workers, (total + max_batch_size - 1) // max_batch_size)
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='calendar-batch') as executor:
+        for future in [executor.submit(worker) for _ in range(workers)]:
+            future.result()
+
+    logger.info(f"Пакетная операция завершена ({total} запросов): {result.summary()}")
+    return result
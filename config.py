@@ -142,6 +142,187 @@ INTERNAL_SERVER_PORT = 8081
 BOT_CALLBACK_URL = f"http://{INTERNAL_SERVER_HOST}:{INTERNAL_SERVER_PORT}/auth_success"
 
 
+# --- Хранилище учетных данных Google ---
+# 'sqlite' — локальный файл базы, 'mongo' — коллекция credentials в MongoDB
+CREDENTIAL_STORE_BACKEND = os.getenv('CREDENTIAL_STORE_BACKEND', 'sqlite')
+CREDENTIAL_DB_PATH = '.venv/credentials.sqlite3'
+
+# --- Фоновое обновление токенов ---
+# Как часто проверять токены (в секундах)
+TOKEN_REFRESH_INTERVAL_SECONDS = 10 * 60
+# Обновляем токены, которые истекут в ближайшие N секунд (должно быть больше интервала проверки)
+TOKEN_REFRESH_MARGIN_SECONDS = 20 * 60
+# Сколько токенов обновлять одновременно
+TOKEN_REFRESH_MAX_WORKERS = 8
+
+# --- Групповые операции над календарями всех пользователей ---
+# Сколько пользователей обрабатывать одновременно
+FANOUT_MAX_WORKERS = 8
+# Максимальное время обработки одного пользователя (в секундах)
+FANOUT_USER_TIMEOUT_SECONDS = 60
+# Повторы при ошибках 429/5xx и базовая задержка экспоненциальной паузы между ними
+FANOUT_MAX_RETRIES = 3
+FANOUT_BACKOFF_BASE_SECONDS = 1.0
+# Таймаут одного HTTP-запроса к Google API (в секундах)
+GOOGLE_HTTP_TIMEOUT_SECONDS = 30
+
+# --- Кэш клиентов Google API ---
+# Сколько клиентов (пар пользователь + API) держать в памяти одновременно
+SERVICE_CACHE_MAX_SIZE = 512
+# Через сколько секунд клиент будет построен заново
+SERVICE_CACHE_TTL_SECONDS = 30 * 60
+
+# --- Асинхронный доступ к Google API ---
+# Размер отдельного пула потоков, в котором выполняются все синхронные запросы к Google из обработчиков
+GOOGLE_API_EXECUTOR_WORKERS = 16
+
+# --- Локальная копия календарей пользователей ---
+# Сколько секунд копия считается актуальной без запроса изменений у Google. Изменения самого бота вносятся сразу,
+# а правки, сделанные пользователем прямо в Google Календаре, видны боту с задержкой до этого времени
+# (кроме мест, где перед чтением вызывается event_mirror.mark_stale)
+EVENT_MIRROR_FRESHNESS_SECONDS = 5 * 60
+# Для скольких пользователей держать копии календарей в памяти
+EVENT_MIRROR_MAX_USERS = 512
+# Сколько событий хранить на одного пользователя: копия содержит только события с понедельника текущей недели,
+# а при превышении лимита остаются ближайшие по времени (повторяющиеся серии без конца разворачиваются далеко вперед)
+EVENT_MIRROR_MAX_EVENTS_PER_USER = 5000
+
+# --- Реестр предметов ---
+# Как часто заново собирать кастомные предметы из календаря (прошедшие мероприятия пропадают из списка)
+SUBJECT_REGISTRY_REFRESH_SECONDS = 6 * 60 * 60
+
+# --- Пакетные запросы к Google Calendar (создание и удаление расписания) ---
+# Последний день семестра: до него создается расписание и повторяющиеся мероприятия
+SEMESTER_END_DATE = "2025-12-31"
+# Режим создания расписания: 'single' — отдельное событие на каждое занятие,
+# 'recurring' — одна повторяющаяся серия на занятие (в разы меньше запросов к API)
+SCHEDULE_MODE = os.getenv('SCHEDULE_MODE', 'single')
+# Удалять ли также расписание, созданное до появления подписи bot_managed_schedule (поиск по названию предмета)
+SCHEDULE_DELETE_LEGACY_SCAN = os.getenv('SCHEDULE_DELETE_LEGACY_SCAN', 'false').lower() == 'true'
+# Максимальный и минимальный размер пакета (API допускает до 1000 запросов, но на больших пакетах чаще срабатывают лимиты)
+CALENDAR_BATCH_MAX_SIZE = 50
+CALENDAR_BATCH_MIN_SIZE = 5
+# Сколько пакетов отправлять одновременно
+CALENDAR_BATCH_MAX_WORKERS = 4
+# Ограничение скорости запросов к календарю одного пользователя (запросов в секунду)
+CALENDAR_REQUESTS_PER_SECOND = 8
+# Как часто обновлять сообщение с прогрессом в Telegram (в секундах)
+SCHEDULE_PROGRESS_INTERVAL_SECONDS = 3
+
+# --- Работа с файлами на Google Drive ---
+# Размер части при потоковом скачивании файлов (в байтах)
+DRIVE_DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+# Каталог и максимальный размер локального кэша файлов с Google Drive (учебники, вложения к ДЗ)
+TEXTBOOK_CACHE_DIR = '.venv/textbook_cache'
+TEXTBOOK_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# --- Обработка учебников при загрузке ---
+# Ширина миниатюры страницы (в пикселях) и качество JPEG
+TEXTBOOK_THUMBNAIL_WIDTH = 200
+TEXTBOOK_THUMBNAIL_JPEG_QUALITY = 60
+# Сколько символов текста страницы сохранять в базе
+TEXTBOOK_PAGE_TEXT_MAX_CHARS = 20000
+# Сколько разделов оглавления показывать кнопками при выборе страниц для конспекта
+SUMMARY_OUTLINE_MAX_BUTTONS = 20
+
+# --- Изображения страниц для конспектов ---
+# HQ-версия для пользователя: DPI рендера и качество JPEG
+SUMMARY_HQ_DPI = 150
+SUMMARY_HQ_JPEG_QUALITY = 90
+# LQ-версия для модели: максимальная сторона (в пикселях) и качество JPEG
+SUMMARY_LQ_MAX_SIZE = 512
+SUMMARY_LQ_JPEG_QUALITY = 50
+# Каталог и максимальный размер кэша отрендеренных страниц
+PAGE_CACHE_DIR = '.venv/page_cache'
+PAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+# Максимум страниц в одном запросе конспекта (столько же фото влезает в один альбом Telegram)
+SUMMARY_MAX_PAGES = 10
+# Число процессов для рендера страниц и таймаут рендера одного запроса (в секундах)
+PAGE_RENDER_WORKERS = min(4, os.cpu_count() or 1)
+PAGE_RENDER_TIMEOUT_SECONDS = 60
+
+# --- Что отправлять модели для конспекта ---
+# 'auto' — текстовый слой PDF, а изображения только для страниц без текста или с рисунками; 'images' — всегда изображения
+SUMMARY_INPUT_MODE = os.getenv('SUMMARY_INPUT_MODE', 'auto')
+# Страница отправляется текстом, если в ней не меньше стольких символов...
+SUMMARY_TEXT_MIN_CHARS = 300
+# ...и рисунки занимают не больше такой доли ее площади
+SUMMARY_FIGURE_COVERAGE_MAX = 0.25
+# Сколько символов текста одной страницы отправлять модели
+SUMMARY_PAGE_TEXT_MAX_CHARS = 6000
+# Примерное число символов на токен (для оценки экономии)
+OPENAI_CHARS_PER_TOKEN = 3
+
+# --- Детализация изображений страниц ---
+# 'adaptive' — плотные страницы отправляются с detail=high в пределах бюджета; 'low' — все с detail=low
+SUMMARY_IMAGE_DETAIL_MODE = os.getenv('SUMMARY_IMAGE_DETAIL_MODE', 'adaptive')
+# Бюджет входных токенов на все страницы одного запроса (текст и изображения)
+SUMMARY_PAGE_TOKEN_BUDGET = 8000
+# Минимальная "плотность" страницы для detail=high (1 — страница с SUMMARY_TEXT_MIN_CHARS символами текста)
+SUMMARY_HD_MIN_DENSITY = 1.0
+# Короткая сторона изображения для detail=high (в пикселях) и качество JPEG
+SUMMARY_HD_SHORT_SIDE = 768
+SUMMARY_HD_JPEG_QUALITY = 75
+# Модель для конспектов и цена изображений для нее во входных токенах. gpt-5-mini считает изображение
+# патчами 32x32 пикселя (не больше OPENAI_IMAGE_MAX_PATCHES, иначе OpenAI уменьшает картинку)
+# и умножает их число на множитель модели; при смене модели эти числа нужно сверить с документацией OpenAI
+SUMMARY_OPENAI_MODEL = 'gpt-5-mini'
+OPENAI_IMAGE_PATCH_SIZE = 32
+OPENAI_IMAGE_MAX_PATCHES = 1536
+OPENAI_IMAGE_TOKEN_MULTIPLIER = 1.62
+
+# --- Кэш готовых конспектов ---
+# Сколько хранить конспект (в секундах); повторный такой же запрос отдается без обращения к OpenAI
+SUMMARY_CACHE_TTL_SECONDS = 14 * 24 * 60 * 60
+# Версия промпта: поменяй при изменении промпта или модели, чтобы старые конспекты не отдавались из кэша
+SUMMARY_PROMPT_VERSION = 1
+
+# --- Очередь конспектов ---
+# Сколько конспектов готовится одновременно (общий лимит на запросы к OpenAI)
+SUMMARY_QUEUE_WORKERS = 3
+# Сколько задач одного пользователя может выполняться одновременно и сколько всего (в очереди и в работе)
+SUMMARY_MAX_RUNNING_PER_USER = 1
+SUMMARY_MAX_JOBS_PER_USER = 2
+# Максимальная длина очереди; при переполнении новые запросы отклоняются
+SUMMARY_QUEUE_MAX_PENDING = 50
+
+# --- Потоковая выдача конспекта ---
+# Показывать ответ модели по мере генерации в статусном сообщении
+SUMMARY_STREAMING = os.getenv('SUMMARY_STREAMING', 'true').lower() == 'true'
+# Как часто обновлять сообщение (в секундах) и сколько символов в нем показывать
+SUMMARY_STREAM_EDIT_INTERVAL_SECONDS = 1.5
+SUMMARY_STREAM_PREVIEW_CHARS = 3500
+
+# --- Повторная отправка файлов в Telegram ---
+# Сколько соответствий "содержимое файла -> file_id" держать в памяти (все хранятся в MongoDB)
+TELEGRAM_FILE_ID_CACHE_SIZE = 4096
+# Версия форматирования .docx: поменяй при изменении doc_formatter, чтобы не отдавать старые результаты
+DOCX_FORMATTER_VERSION = 1
+
+# --- Логирование в Google Sheets ---
+# Строки отправляются пачкой, когда их накопится SHEETS_FLUSH_BATCH_SIZE или пройдет SHEETS_FLUSH_INTERVAL_SECONDS
+SHEETS_FLUSH_BATCH_SIZE = 20
+SHEETS_FLUSH_INTERVAL_SECONDS = 30
+# Максимум строк в одном запросе append_rows и пауза между повторами при ошибке (в секундах)
+SHEETS_FLUSH_MAX_ROWS = 500
+SHEETS_RETRY_DELAY_SECONDS = 10
+
+# --- Журнал использования AI ---
+# Локальная база SQLite: все события с токенами и дневные итоги по пользователям и предметам
+USAGE_LEDGER_PATH = '.venv/usage_ledger.sqlite3'
+
+# --- Лимиты на конспекты (админы из ADMIN_IDS не ограничены) ---
+# Частота запросов одного пользователя: в среднем SUMMARY_REQUESTS_PER_HOUR в час, подряд — не больше SUMMARY_REQUEST_BURST
+SUMMARY_REQUESTS_PER_HOUR = 6
+SUMMARY_REQUEST_BURST = 3
+# Дневной бюджет токенов OpenAI на пользователя (считается по журналу использования)
+SUMMARY_DAILY_TOKEN_BUDGET = 150000
+# Сколько токенов резервировать под конспект, пока фактический расход еще неизвестен
+SUMMARY_TOKEN_RESERVATION = 15000
+# Сколько пользователей держать в памяти для token bucket
+SUMMARY_LIMITS_MAX_USERS = 4096
+
+
 REMINDER_IGNORE_LIST = [
     "Физическая культура и спорт",
     "УТП"
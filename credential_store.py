@@ -0,0 +1,155 @@
+# credential_store.py
+
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+# --- Хранилища (backend) для учетных данных ---
+
+class SqliteCredentialBackend:
+    """Хранит токены всех пользователей в одной таблице SQLite."""
+
+    def __init__(self, path: str):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS credentials ("
+                "user_id TEXT PRIMARY KEY, token_json TEXT NOT NULL, "
+                "updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+            )
+
+    def _connect(self):
+        # Отдельное соединение на каждую операцию: бот и Flask работают в разных потоках
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    def load_all(self) -> dict:
+        with self._connect() as conn:
+            rows = conn.execute("SELECT user_id, token_json FROM credentials").fetchall()
+        return {user_id: json.loads(token_json) for user_id, token_json in rows}
+
+    def save(self, user_id: str, token_info: dict):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO credentials (user_id, token_json, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP) "
+                "ON CONFLICT(user_id) DO UPDATE SET token_json = excluded.token_json, updated_at = CURRENT_TIMESTAMP",
+                (user_id, json.dumps(token_info))
+            )
+
+    def delete(self, user_id: str):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM credentials WHERE user_id = ?", (user_id,))
+
+
+class MongoCredentialBackend:
+    """Хранит токены всех пользователей в коллекции MongoDB (той же базы, что и учебники)."""
+
+    def __init__(self):
+        import database
+        self.collection = database.credentials_collection
+        if self.collection is None:
+            raise RuntimeError("нет подключения к MongoDB")
+
+    def load_all(self) -> dict:
+        return {doc['_id']: doc['token'] for doc in self.collection.find({})}
+
+    def save(self, user_id: str, token_info: dict):
+        self.collection.replace_one({'_id': user_id}, {'_id': user_id, 'token': token_info}, upsert=True)
+
+    def delete(self, user_id: str):
+        self.collection.delete_one({'_id': user_id})
+
+
+# --- Кэш в памяти поверх backend ---
+
+class CredentialStore:
+    """
+    Держит токены всех пользователей в памяти и пишет изменения в backend (write-through).
+    Чтение никогда не обращается к диску после начальной пакетной загрузки.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._tokens = {}
+        self._loaded = False
+        self._lock = threading.RLock()
+
+    def load_all(self):
+        """Загружает токены всех пользователей одним запросом."""
+        with self._lock:
+            self._tokens = self.backend.load_all()
+            self._loaded = True
+            logger.info(f"Загружены учетные данные {len(self._tokens)} пользователей.")
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    self.load_all()
+
+    def get(self, user_id) -> dict | None:
+        self._ensure_loaded()
+        return self._tokens.get(str(user_id))
+
+    def save(self, user_id, token_info: dict):
+        self._ensure_loaded()
+        with self._lock:
+            self.backend.save(str(user_id), token_info)
+            self._tokens[str(user_id)] = token_info
+
+    def delete(self, user_id):
+        self._ensure_loaded()
+        with self._lock:
+            self.backend.delete(str(user_id))
+            self._tokens.pop(str(user_id), None)
+
+    def list_user_ids(self) -> list[int]:
+        """Возвращает ID всех пользователей с сохраненными токенами (служебные ключи вроде 'debug' пропускаются)."""
+        self._ensure_loaded()
+        with self._lock:
+            keys = list(self._tokens.keys())
+        return [int(key) for key in keys if key.lstrip('-').isdigit()]
+
+    def import_token_files(self, token_dir: str) -> int:
+        """
+        Однократно переносит старые файлы token_{id}.json в хранилище.
+        Перенесенные файлы переименовываются, чтобы не импортироваться повторно.
+        """
+        if not os.path.isdir(token_dir):
+            return 0
+
+        imported = 0
+        for file_name in os.listdir(token_dir):
+            if not (file_name.startswith('token_') and file_name.endswith('.json')):
+                continue
+            user_id = file_name[len('token_'):-len('.json')]
+            token_path = os.path.join(token_dir, file_name)
+            try:
+                with open(token_path) as token_file:
+                    token_info = json.load(token_file)
+                if self.get(user_id) is None:
+                    self.save(user_id, token_info)
+                    imported += 1
+                os.rename(token_path, token_path + '.migrated')
+            except Exception as e:
+                logger.error(f"Не удалось перенести токен из файла {token_path}: {e}")
+
+        if imported:
+            logger.info(f"Перенесено {imported} токенов из {token_dir} в хранилище учетных данных.")
+        return imported
+
+
+def create_store(backend_name: str, sqlite_path: str) -> CredentialStore:
+    """Создает хранилище учетных данных с указанным backend ('sqlite' или 'mongo')."""
+    if backend_name == 'mongo':
+        return CredentialStore(MongoCredentialBackend())
+    return CredentialStore(SqliteCredentialBackend(sqlite_path))
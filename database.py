@@ -1,7 +1,9 @@
 # database.py
 
 import logging
-from pymongo import MongoClient
+from datetime import datetime, timezone
+from bson import ObjectId
+from pymongo import MongoClient, ASCENDING
 import config
 
 # --- Настройка логгирования ---
@@ -11,24 +13,53 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Подключение к базе данных ---
-try:
-    # Создаем клиент для подключения к MongoDB, используя строку из конфига
-    client = MongoClient(config.MONGO_DB_CONNECTION_STRING)
+# Подключение выполняется явно из init(): модуль импортируется и в процессах пула рендеринга,
+# где соединение с MongoDB не нужно. До вызова init() все коллекции равны None.
+client = None
+textbooks_collection = None
+textbook_pages_collection = None
+summary_cache_collection = None
+telegram_files_collection = None
+credentials_collection = None
 
-    # Выбираем нашу базу данных (можно назвать ее 'student_bot_db')
-    db = client.student_bot_db
 
-    # Выбираем коллекцию (это как таблица в обычной БД) для хранения учебников
-    textbooks_collection = db.textbooks
+def init():
+    """Подключается к MongoDB и создает индексы. Вызывается один раз при запуске бота."""
+    global client, textbooks_collection, textbook_pages_collection, summary_cache_collection
+    global telegram_files_collection, credentials_collection
+    try:
+        # Создаем клиент для подключения к MongoDB, используя строку из конфига
+        client = MongoClient(config.MONGO_DB_CONNECTION_STRING)
+
+        # Выбираем нашу базу данных (можно назвать ее 'student_bot_db')
+        db = client.student_bot_db
+
+        # Проверка соединения с сервером
+        client.server_info()
+        db.textbook_pages.create_index([("file_id", ASCENDING), ("page", ASCENDING)], unique=True)
+        # TTL-индекс: MongoDB сама удаляет записи кэша конспектов через SUMMARY_CACHE_TTL_SECONDS после создания
+        db.summary_cache.create_index("created_at", expireAfterSeconds=config.SUMMARY_CACHE_TTL_SECONDS)
+        db.summary_cache.create_index("file_id")
+
+        # Выбираем коллекцию (это как таблица в обычной БД) для хранения учебников
+        textbooks_collection = db.textbooks
+
+        # Постраничные данные учебников (текст и миниатюры), собранные при загрузке
+        textbook_pages_collection = db.textbook_pages
+
+        # Готовые конспекты: одинаковые запросы группы не отправляются в OpenAI повторно
+        summary_cache_collection = db.summary_cache
 
-    # Проверка соединения с сервером
-    client.server_info()
-    logger.info("✅ Успешное подключение к MongoDB Atlas.")
+        # file_id уже отправленных в Telegram файлов: повторная отправка по file_id не загружает файл заново
+        telegram_files_collection = db.telegram_files
 
-except Exception as e:
-    logger.error(f"❌ Не удалось подключиться к MongoDB: {e}")
-    client = None
-    textbooks_collection = None
+        # Коллекция для учетных данных Google (используется, если CREDENTIAL_STORE_BACKEND = 'mongo')
+        credentials_collection = db.credentials
+        logger.info("✅ Успешное подключение к MongoDB Atlas.")
+
+    except Exception as e:
+        logger.error(f"❌ Не удалось подключиться к MongoDB: {e}")
+        client = None
 
 
 # --- Функции для работы с коллекцией учебников ---
@@ -72,3 +103,193 @@ def get_textbooks_by_subject(subject: str) -> list:
     except Exception as e:
         logger.error(f"Ошибка при поиске учебников в БД: {e}")
         return []
+
+
+def delete_textbook_by_id(textbook_id: str) -> bool:
+    """
+    Удаляет учебник по его _id вместе с постраничными данными.
+    """
+    if textbooks_collection is None:
+        logger.error("Невозможно удалить учебник: отсутствует подключение к БД.")
+        return False
+
+    try:
+        textbook = textbooks_collection.find_one_and_delete({"_id": ObjectId(textbook_id)})
+        if textbook is None:
+            logger.warning(f"Учебник с ID {textbook_id} не найден в БД.")
+            return False
+        if textbook_pages_collection is not None:
+            textbook_pages_collection.delete_many({"file_id": textbook.get("file_id")})
+        delete_cached_summaries(textbook.get("file_id"))
+        logger.info(f"Учебник '{textbook.get('file_name')}' удален из базы.")
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при удалении учебника из БД: {e}")
+        return False
+
+
+def get_textbook_by_file_id(file_id: str) -> dict | None:
+    """
+    Находит учебник по ID файла на Google Drive.
+    """
+    if textbooks_collection is None:
+        logger.error("Невозможно найти учебник: отсутствует подключение к БД.")
+        return None
+
+    try:
+        return textbooks_collection.find_one({"file_id": file_id})
+    except Exception as e:
+        logger.error(f"Ошибка при поиске учебника в БД: {e}")
+        return None
+
+
+def update_textbook_metadata(file_id: str, metadata: dict) -> bool:
+    """
+    Сохраняет в документ учебника данные, собранные при загрузке (число страниц, оглавление и т.д.).
+    """
+    if textbooks_collection is None:
+        logger.error("Невозможно обновить учебник: отсутствует подключение к БД.")
+        return False
+
+    try:
+        result = textbooks_collection.update_one({"file_id": file_id}, {"$set": metadata})
+        return result.matched_count > 0
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении данных учебника в БД: {e}")
+        return False
+
+
+def save_textbook_pages(file_id: str, pages: list) -> bool:
+    """
+    Сохраняет постраничные данные учебника (один документ на страницу), заменяя старые.
+    """
+    if textbook_pages_collection is None:
+        logger.error("Невозможно сохранить страницы учебника: отсутствует подключение к БД.")
+        return False
+
+    try:
+        textbook_pages_collection.delete_many({"file_id": file_id})
+        if pages:
+            textbook_pages_collection.insert_many([{**page, "file_id": file_id} for page in pages], ordered=False)
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении страниц учебника в БД: {e}")
+        return False
+
+
+def get_textbook_pages(file_id: str, pages: list, with_thumbnails: bool = False) -> list:
+    """
+    Возвращает сохраненные данные указанных страниц учебника (нумерация с 1), отсортированные по номеру.
+    """
+    if textbook_pages_collection is None:
+        logger.error("Невозможно получить страницы учебника: отсутствует подключение к БД.")
+        return []
+
+    try:
+        projection = {"_id": 0} if with_thumbnails else {"_id": 0, "thumbnail": 0}
+        cursor = textbook_pages_collection.find({"file_id": file_id, "page": {"$in": list(pages)}}, projection)
+        return sorted(cursor, key=lambda page: page["page"])
+    except Exception as e:
+        logger.error(f"Ошибка при получении страниц учебника из БД: {e}")
+        return []
+
+
+# --- Функции для работы с кэшем конспектов ---
+
+def get_cached_summary(cache_key: str) -> dict | None:
+    """
+    Возвращает сохраненный конспект по ключу запроса или None.
+    """
+    if summary_cache_collection is None:
+        return None
+
+    try:
+        return summary_cache_collection.find_one({"_id": cache_key})
+    except Exception as e:
+        logger.error(f"Ошибка при чтении кэша конспектов: {e}")
+        return None
+
+
+def save_cached_summary(cache_key: str, file_id: str | None, summary_text: str, usage: dict) -> bool:
+    """
+    Сохраняет готовый конспект. Запись удалится автоматически по TTL-индексу.
+    """
+    if summary_cache_collection is None:
+        return False
+
+    try:
+        summary_cache_collection.replace_one(
+            {"_id": cache_key},
+            {"file_id": file_id, "summary_text": summary_text, "usage": usage,
+             "created_at": datetime.now(timezone.utc)},
+            upsert=True
+        )
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении конспекта в кэш: {e}")
+        return False
+
+
+def delete_cached_summaries(file_id: str | None = None) -> int:
+    """
+    Удаляет сохраненные конспекты по файлу или, если file_id не указан, все. Возвращает число удаленных.
+    """
+    if summary_cache_collection is None:
+        logger.error("Невозможно очистить кэш конспектов: отсутствует подключение к БД.")
+        return 0
+
+    try:
+        query = {"file_id": file_id} if file_id else {}
+        deleted = summary_cache_collection.delete_many(query).deleted_count
+        logger.info(f"Из кэша конспектов удалено записей: {deleted}.")
+        return deleted
+    except Exception as e:
+        logger.error(f"Ошибка при очистке кэша конспектов: {e}")
+        return 0
+
+
+# --- Функции для работы с file_id файлов Telegram ---
+
+def get_telegram_file_ids(keys: list) -> dict:
+    """
+    Возвращает {ключ: file_id} для уже отправленных в Telegram файлов из списка ключей.
+    """
+    if telegram_files_collection is None or not keys:
+        return {}
+
+    try:
+        return {doc["_id"]: doc["file_id"] for doc in telegram_files_collection.find({"_id": {"$in": list(keys)}})}
+    except Exception as e:
+        logger.error(f"Ошибка при чтении file_id Telegram из БД: {e}")
+        return {}
+
+
+def save_telegram_file_ids(file_ids: dict) -> bool:
+    """
+    Сохраняет соответствие {ключ: file_id} для файлов, только что загруженных в Telegram.
+    """
+    if telegram_files_collection is None or not file_ids:
+        return False
+
+    try:
+        for key, file_id in file_ids.items():
+            telegram_files_collection.replace_one(
+                {"_id": key}, {"file_id": file_id, "saved_at": datetime.now(timezone.utc)}, upsert=True
+            )
+        return True
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении file_id Telegram в БД: {e}")
+        return False
+
+
+def delete_telegram_file_id(key: str):
+    """
+    Удаляет устаревший file_id (например, если Telegram перестал его принимать).
+    """
+    if telegram_files_collection is None:
+        return
+
+    try:
+        telegram_files_collection.delete_one({"_id": key})
+    except Exception as e:
+        logger.error(f"Ошибка при удалении file_id Telegram из БД: {e}")
@@ -0,0 +1,159 @@
+# disk_cache.py
+
+import os
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Число блокировок для single-flight заполнения: ключи распределяются по ним хэшем,
+# поэтому память не растет с числом ключей, а случайные совпадения лишь изредка заставят подождать
+_KEY_LOCK_STRIPES = 64
+
+
+class DiskLRUCache:
+    """
+    Кэш файлов на диске с ограничением общего размера.
+    Имя файла — хэш ключа, поэтому разные версии одного файла хранятся под разными ключами.
+    При превышении лимита удаляются файлы, к которым дольше всего не обращались.
+    Порядок использования и общий размер ведутся в памяти; каталог сканируется только при создании кэша
+    (порядок восстанавливается по mtime, который обновляется при каждом обращении).
+    Закрепленные (pin) файлы не вытесняются, пока их не отпустят через unpin().
+    """
+
+    def __init__(self, directory: str, max_bytes: int, name: str = 'cache'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.name = name
+        self._lock = threading.Lock()
+        self._key_locks = [threading.Lock() for _ in range(_KEY_LOCK_STRIPES)]
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        # path -> размер в байтах, от давно не использованных к недавним
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._pins = Counter()
+        os.makedirs(directory, exist_ok=True)
+        self._load_entries()
+
+    def _load_entries(self):
+        entries = []
+        for file_name in os.listdir(self.directory):
+            path = os.path.join(self.directory, file_name)
+            if file_name.startswith('.tmp_'):
+                # Недописанный файл от прерванной записи — больше никому не нужен
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        for _, size, path in sorted(entries):
+            self._entries[path] = size
+            self._total_bytes += size
+
+    def _path(self, key: str, suffix: str = '') -> str:
+        digest = hashlib.sha256(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    def key_lock(self, key: str) -> threading.Lock:
+        """Блокировка для ключа: пока один поток заполняет запись, остальные ждут, а не скачивают то же самое."""
+        digest = hashlib.sha256(key.encode('utf-8')).digest()
+        return self._key_locks[int.from_bytes(digest[:4], 'big') % _KEY_LOCK_STRIPES]
+
+    def _forget(self, path: str):
+        size = self._entries.pop(path, None)
+        if size is not None:
+            self._total_bytes -= size
+
+    def get_path(self, key: str, suffix: str = '', pin: bool = False) -> str | None:
+        """
+        Возвращает путь к файлу из кэша или None. Обращение обновляет время использования записи.
+        pin=True закрепляет файл, чтобы его не удалило вытеснение, пока он нужен вызывающему (см. unpin).
+        """
+        path = self._path(key, suffix)
+        with self._lock:
+            try:
+                os.utime(path)
+            except FileNotFoundError:
+                self._forget(path)
+                self._stats['misses'] += 1
+                return None
+            if path in self._entries:
+                self._entries.move_to_end(path)
+            if pin:
+                self._pins[path] += 1
+            self._stats['hits'] += 1
+        return path
+
+    def get_bytes(self, key: str, suffix: str = '') -> bytes | None:
+        path = self.get_path(key, suffix)
+        if path is None:
+            return None
+        try:
+            with open(path, 'rb') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+    def unpin(self, path: str):
+        """Снимает закрепление, поставленное get_path/put_file с pin=True."""
+        with self._lock:
+            self._pins[path] -= 1
+            if self._pins[path] <= 0:
+                del self._pins[path]
+            self._evict()
+
+    def temp_path(self, suffix: str = '') -> str:
+        """Путь для временного файла в каталоге кэша (чтобы put_file мог переместить его без копирования)."""
+        fd, path = tempfile.mkstemp(suffix=suffix, prefix='.tmp_', dir=self.directory)
+        os.close(fd)
+        return path
+
+    def put_file(self, key: str, source_path: str, suffix: str = '', pin: bool = False) -> str:
+        """Перемещает готовый файл в кэш под ключом и возвращает его новый путь (pin — как в get_path)."""
+        path = self._path(key, suffix)
+        size = os.path.getsize(source_path)
+        with self._lock:
+            os.replace(source_path, path)
+            self._forget(path)
+            self._entries[path] = size
+            self._total_bytes += size
+            if pin:
+                self._pins[path] += 1
+            self._evict(keep=path)
+        return path
+
+    def put_bytes(self, key: str, data: bytes, suffix: str = '', pin: bool = False) -> str:
+        temp_path = self.temp_path(suffix)
+        with open(temp_path, 'wb') as file:
+            file.write(data)
+        return self.put_file(key, temp_path, suffix, pin=pin)
+
+    def _evict(self, keep: str = None):
+        """Удаляет давно не использованные файлы сверх лимита. Вызывается под self._lock."""
+        if self._total_bytes <= self.max_bytes:
+            return
+        for path, size in list(self._entries.items()):
+            if self._total_bytes <= self.max_bytes:
+                break
+            if path == keep or path in self._pins:
+                continue
+            try:
+                os.remove(path)
+                self._stats['evictions'] += 1
+                logger.info(f"Кэш {self.name}: удален файл {os.path.basename(path)} ({size} байт).")
+            except FileNotFoundError:
+                pass
+            self._forget(path)
+
+    def get_stats(self) -> dict:
+        """Возвращает счетчики попаданий/промахов/вытеснений, число файлов и их общий размер."""
+        with self._lock:
+            return {**self._stats, 'files': len(self._entries), 'bytes': self._total_bytes}
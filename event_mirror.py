@@ -0,0 +1,229 @@
+# event_mirror.py
+
+import re
+import copy
+import time
+import logging
+import datetime
+import threading
+from cachetools import LRUCache
+from googleapiclient.errors import HttpError
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def event_subject(summary: str) -> str:
+    """Извлекает чистое название предмета из заголовка события (без кабинета в скобках)."""
+    match = re.search(r'^(.*?)\s*\(', summary)
+    return match.group(1).strip() if match else summary.strip()
+
+
+def _parse_time(value) -> datetime.datetime:
+    """Приводит время (строку ISO или datetime) к datetime с часовым поясом."""
+    if isinstance(value, str):
+        value = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+def _event_bound(event: dict, key: str) -> datetime.datetime | None:
+    """Возвращает начало ('start') или конец ('end') события; для событий на весь день — полночь UTC."""
+    bound = event.get(key, {})
+    if 'dateTime' in bound:
+        return _parse_time(bound['dateTime'])
+    if 'date' in bound:
+        return _parse_time(bound['date'] + 'T00:00:00')
+    return None
+
+
+def _window_start() -> datetime.datetime:
+    """Начало окна копии: понедельник текущей недели (прошлые занятия боту не нужны)."""
+    today = datetime.date.today()
+    monday = today - datetime.timedelta(days=today.weekday())
+    return datetime.datetime.combine(monday, datetime.time.min, tzinfo=datetime.timezone.utc)
+
+
+class UserEventMirror:
+    """
+    Локальная копия событий календаря одного пользователя с понедельника текущей недели,
+    не больше EVENT_MIRROR_MAX_EVENTS_PER_USER событий.
+    Первый запрос загружает календарь целиком, последующие получают только изменения по syncToken.
+    Синхронизация идет без timeMin (с ним syncToken не совместим), поэтому старые события отбрасываются при загрузке.
+    """
+
+    def __init__(self):
+        self.events = {}
+        self.sync_token = None
+        self.synced_at = None
+        self.lock = threading.RLock()
+
+    def is_fresh(self) -> bool:
+        return self.synced_at is not None and time.monotonic() - self.synced_at < config.EVENT_MIRROR_FRESHNESS_SECONDS
+
+    def sync(self, service):
+        """Синхронизирует копию с календарем: полностью при первом обращении или после ошибки 410, иначе инкрементально."""
+        with self.lock:
+            if self.sync_token:
+                try:
+                    self._load(service, sync_token=self.sync_token)
+                    return
+                except HttpError as e:
+                    if e.resp.status != 410:
+                        raise
+                    logger.info("syncToken календаря устарел, выполняю полную синхронизацию.")
+            self.events = {}
+            self._load(service)
+
+    def _load(self, service, sync_token: str = None):
+        window_start = _window_start()
+        page_token = None
+        changed = 0
+        while True:
+            params = {'calendarId': 'primary', 'singleEvents': True, 'maxResults': 2500, 'pageToken': page_token}
+            if sync_token:
+                params['syncToken'] = sync_token
+            events_result = service.events().list(**params).execute()
+
+            for event in events_result.get('items', []):
+                if event.get('status') == 'cancelled' or not self._in_window(event, window_start):
+                    self.events.pop(event['id'], None)
+                else:
+                    self.events[event['id']] = event
+                changed += 1
+
+            page_token = events_result.get('nextPageToken')
+            if not page_token:
+                self.sync_token = events_result.get('nextSyncToken')
+                break
+
+        self._prune(window_start)
+        self.synced_at = time.monotonic()
+        mode = "инкрементальная" if sync_token else "полная"
+        logger.info(f"Синхронизация календаря ({mode}): изменений {changed}, всего событий {len(self.events)}.")
+
+    @staticmethod
+    def _in_window(event: dict, window_start: datetime.datetime) -> bool:
+        end = _event_bound(event, 'end') or _event_bound(event, 'start')
+        return end is not None and end > window_start
+
+    def _prune(self, window_start: datetime.datetime):
+        """Убирает события, закончившиеся до начала окна, и оставляет не больше EVENT_MIRROR_MAX_EVENTS_PER_USER ближайших."""
+        self.events = {
+            event_id: event for event_id, event in self.events.items() if self._in_window(event, window_start)
+        }
+        if len(self.events) > config.EVENT_MIRROR_MAX_EVENTS_PER_USER:
+            nearest = sorted(self.events.values(), key=lambda event: _event_bound(event, 'start') or window_start)
+            self.events = {event['id']: event for event in nearest[:config.EVENT_MIRROR_MAX_EVENTS_PER_USER]}
+            logger.warning(
+                f"В копии календаря больше {config.EVENT_MIRROR_MAX_EVENTS_PER_USER} событий — "
+                f"оставлены ближайшие, более поздние не видны до следующей синхронизации."
+            )
+
+
+# --- Реестр копий календарей ---
+_mirrors = LRUCache(maxsize=config.EVENT_MIRROR_MAX_USERS)
+_lock = threading.Lock()
+_stats = {'hits': 0, 'syncs': 0}
+
+
+def _get_mirror(user_id) -> UserEventMirror:
+    with _lock:
+        mirror = _mirrors.get(user_id)
+        if mirror is None:
+            mirror = UserEventMirror()
+            _mirrors[user_id] = mirror
+        return mirror
+
+
+def _ensure_synced(user_id, service) -> UserEventMirror:
+    mirror = _get_mirror(user_id)
+    with mirror.lock:
+        fresh = mirror.is_fresh()
+        if not fresh:
+            mirror.sync(service)
+    with _lock:
+        _stats['hits' if fresh else 'syncs'] += 1
+    return mirror
+
+
+def list_events(user_id, service, time_min=None, time_max=None, subject: str = None, color_id: str = None,
+                title_contains: str = None, private_property: tuple = None) -> list:
+    """
+    Возвращает события пользователя из локальной копии, отсортированные по времени начала.
+    Как и в Calendar API, в диапазон попадают события, которые заканчиваются после time_min и начинаются до time_max.
+    Возвращаются копии событий, поэтому их можно изменять перед отправкой в API.
+    """
+    mirror = _ensure_synced(user_id, service)
+    time_min = _parse_time(time_min) if time_min else None
+    time_max = _parse_time(time_max) if time_max else None
+
+    matched = []
+    with mirror.lock:
+        for event in mirror.events.values():
+            start, end = _event_bound(event, 'start'), _event_bound(event, 'end')
+            if start is None:
+                continue
+            if time_min and (end or start) <= time_min:
+                continue
+            if time_max and start >= time_max:
+                continue
+            summary = event.get('summary', '')
+            if color_id is not None and event.get('colorId') != color_id:
+                continue
+            if subject is not None and event_subject(summary) != subject:
+                continue
+            if title_contains is not None and title_contains not in summary:
+                continue
+            if private_property is not None:
+                key, value = private_property
+                if event.get('extendedProperties', {}).get('private', {}).get(key) != value:
+                    continue
+            matched.append((start, event))
+
+    matched.sort(key=lambda item: item[0])
+    return [copy.deepcopy(event) for _, event in matched]
+
+
+def upsert(user_id, event: dict):
+    """Записывает в локальную копию событие, которое бот только что создал или изменил."""
+    with _lock:
+        mirror = _mirrors.get(user_id)
+    if mirror is None:
+        return
+    with mirror.lock:
+        if event.get('status') == 'cancelled':
+            mirror.events.pop(event['id'], None)
+        else:
+            mirror.events[event['id']] = copy.deepcopy(event)
+
+
+def remove(user_id, event_id: str):
+    """Удаляет событие из локальной копии."""
+    with _lock:
+        mirror = _mirrors.get(user_id)
+    if mirror is None:
+        return
+    with mirror.lock:
+        mirror.events.pop(event_id, None)
+
+
+def mark_stale(user_id):
+    """Помечает копию устаревшей: при следующем обращении будут запрошены изменения по syncToken."""
+    with _lock:
+        mirror = _mirrors.get(user_id)
+    if mirror is not None:
+        mirror.synced_at = None
+
+
+def invalidate(user_id):
+    """Полностью удаляет копию календаря пользователя (например, при смене аккаунта Google)."""
+    with _lock:
+        _mirrors.pop(user_id, None)
+
+
+def get_stats() -> dict:
+    """Возвращает количество обращений без запросов к API, число синхронизаций и количество копий в памяти."""
+    with _lock:
+        return {**_stats, 'size': len(_mirrors)}
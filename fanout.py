@@ -0,0 +1,107 @@
+# fanout.py
+
+import time
+import random
+import logging
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from googleapiclient.errors import HttpError
+import config
+
+logger = logging.getLogger(__name__)
+
+# Коды ответов Google API, при которых запрос имеет смысл повторить
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Календарь сообщает о превышении лимитов кодом 403 с одной из этих причин
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'quotaExceeded')
+
+
+@dataclass
+class FanOutResult:
+    """Итог групповой операции: у кого получилось, у кого ошибка, кого операция не коснулась."""
+    succeeded: list = field(default_factory=list)
+    failed: list = field(default_factory=list)
+    skipped: list = field(default_factory=list)
+    errors: dict = field(default_factory=dict)
+
+    def summary(self) -> str:
+        return f"успешно: {len(self.succeeded)}, ошибок: {len(self.failed)}, пропущено: {len(self.skipped)}"
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Проверяет, является ли ошибка Google API временной (лимиты или сбой сервера)."""
+    if not isinstance(error, HttpError):
+        return isinstance(error, (TimeoutError, ConnectionError))
+    status = error.resp.status
+    if status in RETRYABLE_STATUSES:
+        return True
+    return status == 403 and any(reason in str(error) for reason in RATE_LIMIT_REASONS)
+
+
+def call_with_retry(func, *args, retries: int = None, **kwargs):
+    """Вызывает func, повторяя его с экспоненциальной задержкой при временных ошибках Google API."""
+    retries = config.FANOUT_MAX_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not is_retryable_error(e):
+                raise
+            delay = config.FANOUT_BACKOFF_BASE_SECONDS * (2 ** attempt) + random.uniform(0, 0.5)
+            logger.info(f"Временная ошибка Google API ({e}), повтор через {delay:.1f} с.")
+            time.sleep(delay)
+            attempt += 1
+
+
+def run_for_users(user_ids: list, task, *, max_workers: int = None, timeout: float = None) -> FanOutResult:
+    """
+    Выполняет task(user_id) для всех пользователей параллельно.
+    task возвращает True, если операция выполнена, и False, если у пользователя нечего менять
+    (например, событие не найдено). Исключение означает ошибку; временные ошибки
+    Google API повторяются с задержкой. Пользователь, чья задача выполняется дольше timeout
+    секунд, считается неуспешным, а результат его задачи больше не ожидается.
+    """
+    max_workers = max_workers or config.FANOUT_MAX_WORKERS
+    timeout = timeout or config.FANOUT_USER_TIMEOUT_SECONDS
+    result = FanOutResult()
+    if not user_ids:
+        return result
+
+    started_at = {}
+
+    def run_task(user_id):
+        started_at[user_id] = time.monotonic()
+        return call_with_retry(task, user_id)
+
+    executor = ThreadPoolExecutor(max_workers=min(max_workers, len(user_ids)), thread_name_prefix='fanout')
+    try:
+        pending = {executor.submit(run_task, user_id): user_id for user_id in user_ids}
+        while pending:
+            done, _ = wait(pending, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                user_id = pending.pop(future)
+                try:
+                    if future.result():
+                        result.succeeded.append(user_id)
+                    else:
+                        result.skipped.append(user_id)
+                except Exception as e:
+                    logger.error(f"Групповая операция не выполнена для user_id {user_id}: {e}")
+                    result.failed.append(user_id)
+                    result.errors[user_id] = str(e)
+
+            # Проверяем зависшие задачи: время считаем с момента фактического старта задачи
+            now = time.monotonic()
+            for future, user_id in list(pending.items()):
+                if user_id in started_at and now - started_at[user_id] > timeout:
+                    logger.error(f"Превышено время ожидания ({timeout} с) для user_id {user_id}.")
+                    pending.pop(future)
+                    result.failed.append(user_id)
+                    result.errors[user_id] = "timeout"
+    finally:
+        # Не ждем зависшие задачи, но и не запускаем те, что еще не начались
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    logger.info(f"Групповая операция завершена: {result.summary()}")
+    return result
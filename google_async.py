@@ -0,0 +1,49 @@
+# google_async.py
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+import config
+
+logger = logging.getLogger(__name__)
+
+# Все синхронные запросы к Google из асинхронных обработчиков выполняются в этом пуле,
+# чтобы один медленный HTTP-запрос не останавливал цикл событий бота для всех пользователей.
+_executor = ThreadPoolExecutor(max_workers=config.GOOGLE_API_EXECUTOR_WORKERS, thread_name_prefix='google-api')
+
+
+def in_event_loop_thread() -> bool:
+    """Проверяет, выполняется ли код в потоке с работающим циклом событий asyncio."""
+    try:
+        asyncio.get_running_loop()
+        return True
+    except RuntimeError:
+        return False
+
+
+async def run(func, *args, **kwargs):
+    """Выполняет синхронную функцию, работающую с Google API, в отдельном пуле потоков."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def execute(request):
+    """Выполняет подготовленный запрос Google API (HttpRequest) вне цикла событий."""
+    return await run(request.execute)
+
+
+async def list_events(service, calendar_id: str = 'primary', **params) -> list:
+    """Возвращает список событий календаря (поле items) по параметрам events().list."""
+    result = await execute(service.events().list(calendarId=calendar_id, **params))
+    return result.get('items', [])
+
+
+async def get_event(service, event_id: str, calendar_id: str = 'primary') -> dict:
+    """Возвращает событие календаря по его ID."""
+    return await execute(service.events().get(calendarId=calendar_id, eventId=event_id))
+
+
+def shutdown():
+    """Останавливает пул потоков (при завершении работы бота)."""
+    _executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,58 @@
+# page_cache.py
+
+import os
+import logging
+import config
+from disk_cache import DiskLRUCache
+
+logger = logging.getLogger(__name__)
+
+# Варианты данных страницы: HQ — изображение для пользователя, LQ — изображение для модели (detail=low),
+# HD — изображение для модели с detail=high, TEXT — извлеченный текст, размер страницы и доля под рисунками (JSON)
+VARIANT_HQ = 'hq'
+VARIANT_LQ = 'lq'
+VARIANT_HD = 'hd'
+VARIANT_TEXT = 'text'
+
+_SUFFIXES = {VARIANT_HQ: '.jpg', VARIANT_LQ: '.jpg', VARIANT_HD: '.jpg', VARIANT_TEXT: '.json'}
+
+# Отрендеренные страницы учебников и вложений: (версия файла, страница, вариант) -> данные
+_cache = DiskLRUCache(config.PAGE_CACHE_DIR, config.PAGE_CACHE_MAX_BYTES, name='страниц')
+
+
+def _variant_settings(variant: str) -> str:
+    """Параметры рендера входят в ключ, чтобы после их изменения в config не отдавались старые картинки."""
+    if variant == VARIANT_HQ:
+        return f"{config.SUMMARY_HQ_DPI}dpi:q{config.SUMMARY_HQ_JPEG_QUALITY}"
+    if variant == VARIANT_HD:
+        return f"{config.SUMMARY_HD_SHORT_SIDE}px:{config.OPENAI_IMAGE_MAX_PATCHES}p:q{config.SUMMARY_HD_JPEG_QUALITY}"
+    if variant == VARIANT_TEXT:
+        return f"{config.SUMMARY_PAGE_TEXT_MAX_CHARS}ch:v2"
+    return f"{config.SUMMARY_LQ_MAX_SIZE}px:q{config.SUMMARY_LQ_JPEG_QUALITY}"
+
+
+def document_key(pdf_path: str) -> str:
+    """
+    Ключ документа для кэша страниц. Кэш учебников хранит каждую версию файла
+    под именем из хэша file_id и версии, поэтому имя файла однозначно определяет версию.
+    """
+    return os.path.splitext(os.path.basename(pdf_path))[0]
+
+
+def _key(doc_key: str, page: int, variant: str) -> str:
+    return f"{doc_key}:{page}:{variant}:{_variant_settings(variant)}"
+
+
+def get(doc_key: str, page: int, variant: str) -> bytes | None:
+    return _cache.get_bytes(_key(doc_key, page, variant), _SUFFIXES[variant])
+
+
+def put(doc_key: str, page: int, variant: str, data: bytes):
+    try:
+        _cache.put_bytes(_key(doc_key, page, variant), data, _SUFFIXES[variant])
+    except OSError as e:
+        logger.warning(f"Не удалось сохранить страницу {page} ({variant}) в кэш: {e}")
+
+
+def get_stats() -> dict:
+    return _cache.get_stats()
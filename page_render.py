@@ -0,0 +1,178 @@
+# page_render.py
+
+import io
+import json
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_EXCEPTION
+import fitz  # PyMuPDF
+from PIL import Image
+import config
+import page_cache
+import summary_input
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _encode_jpeg(pix, quality: int) -> bytes:
+    """
+    Кодирует pixmap в JPEG через Pillow без копирования пикселей (frombuffer поверх samples_mv).
+    Встроенный кодировщик MuPDF (pix.tobytes) на страницах 150 DPI в разы медленнее libjpeg-turbo.
+    """
+    img = Image.frombuffer("RGB", (pix.width, pix.height), pix.samples_mv, "raw", "RGB", pix.stride, 1)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def render_hq_image(page, settings: dict) -> bytes:
+    """HQ-версия для пользователя: рендер с заданным DPI и JPEG прямо из pixmap."""
+    pix = page.get_pixmap(dpi=settings['hq_dpi'], alpha=False)
+    return _encode_jpeg(pix, settings['hq_quality'])
+
+
+def render_lq_image(page, settings: dict) -> bytes:
+    """
+    LQ-версия для AI: MuPDF сразу рендерит страницу в целевом размере (большая сторона — lq_max_size),
+    без промежуточного изображения в высоком разрешении. Крупнее HQ-версии не бывает, как и раньше.
+    """
+    zoom = summary_input.lq_zoom(page.rect.width, page.rect.height)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return _encode_jpeg(pix, settings['lq_quality'])
+
+
+def render_hd_image(page, settings: dict) -> bytes:
+    """Версия для AI с detail=high: размер подобран под лимит патчей OpenAI (см. summary_input.hd_zoom)."""
+    zoom = summary_input.hd_zoom(page.rect.width, page.rect.height)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+    return _encode_jpeg(pix, settings['hd_quality'])
+
+
+def _figure_coverage(page) -> float:
+    """Доля площади страницы, занятая растровыми картинками и векторными рисунками (графики, схемы)."""
+    page_area = abs(page.rect) or 1
+    rects = [fitz.Rect(info['bbox']) for info in page.get_image_info()]
+    try:
+        rects.extend(page.cluster_drawings())
+    except Exception:
+        # В старых версиях PyMuPDF нет cluster_drawings — учитываем только картинки
+        pass
+    covered = sum(abs(rect & page.rect) for rect in rects)
+    return min(1.0, covered / page_area)
+
+
+def analyze_page(page, settings: dict) -> bytes:
+    """Извлекает текстовый слой страницы и оценивает, сколько места на ней занимают рисунки."""
+    text = page.get_text("text").strip()
+    analysis = {
+        'text': text[:settings['text_max_chars']],
+        'text_chars': len(text),
+        'figure_coverage': round(_figure_coverage(page), 3),
+        'width': page.rect.width,
+        'height': page.rect.height,
+    }
+    return json.dumps(analysis, ensure_ascii=False).encode('utf-8')
+
+
+_RENDERERS = {
+    page_cache.VARIANT_HQ: render_hq_image,
+    page_cache.VARIANT_LQ: render_lq_image,
+    page_cache.VARIANT_HD: render_hd_image,
+    page_cache.VARIANT_TEXT: analyze_page,
+}
+
+
+def _render_shard(pdf_path: str, items: list, settings: dict) -> list:
+    """
+    Выполняется в процессе пула: открывает PDF по пути (MuPDF читает с диска только нужные
+    объекты, а сам файл у всех процессов общий через страничный кэш ОС) и рендерит свою часть страниц.
+    items — пары (номер страницы, нужные варианты).
+    """
+    results = []
+    with fitz.open(pdf_path) as doc:
+        for page_num, variants in items:
+            page = doc.load_page(page_num - 1)
+            results.append((page_num, {variant: _RENDERERS[variant](page, settings) for variant in variants}))
+    return results
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # spawn, а не fork: процесс бота многопоточный, и fork мог бы унаследовать захваченные блокировки
+            _executor = ProcessPoolExecutor(
+                max_workers=config.PAGE_RENDER_WORKERS,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+        return _executor
+
+
+def _current_settings() -> dict:
+    return {
+        'hq_dpi': config.SUMMARY_HQ_DPI,
+        'hq_quality': config.SUMMARY_HQ_JPEG_QUALITY,
+        'lq_max_size': config.SUMMARY_LQ_MAX_SIZE,
+        'lq_quality': config.SUMMARY_LQ_JPEG_QUALITY,
+        'hd_quality': config.SUMMARY_HD_JPEG_QUALITY,
+        'text_max_chars': config.SUMMARY_PAGE_TEXT_MAX_CHARS,
+    }
+
+
+def _shard(items: list, shards: int) -> list:
+    """Делит страницы на непрерывные куски примерно одинакового размера (соседние страницы — соседние объекты PDF)."""
+    size, extra = divmod(len(items), shards)
+    result, start = [], 0
+    for index in range(shards):
+        end = start + size + (1 if index < extra else 0)
+        if start < end:
+            result.append(items[start:end])
+        start = end
+    return result
+
+
+def render_pages(pdf_path: str, pages: dict, timeout: float = None) -> dict:
+    """
+    Рендерит страницы PDF параллельно в пуле процессов.
+    pages — {номер страницы: варианты (page_cache.VARIANT_*)}; возвращает {номер страницы: {вариант: JPEG}}.
+    Блокирующая функция: вызывается из рабочего потока, а не из event loop.
+    При превышении таймаута выбрасывает TimeoutError.
+    """
+    if not pages:
+        return {}
+    timeout = timeout or config.PAGE_RENDER_TIMEOUT_SECONDS
+    settings = _current_settings()
+    executor = _get_executor()
+    items = sorted((page_num, tuple(variants)) for page_num, variants in pages.items())
+    futures = [
+        executor.submit(_render_shard, pdf_path, shard, settings)
+        for shard in _shard(items, min(len(items), config.PAGE_RENDER_WORKERS))
+    ]
+
+    done, not_done = wait(futures, timeout=timeout, return_when=FIRST_EXCEPTION)
+    # Уже запущенный кусок отменить нельзя, но еще не начатые не займут пул
+    for future in not_done:
+        future.cancel()
+    for future in done:
+        if future.exception() is not None:
+            raise future.exception()
+    if not_done:
+        raise TimeoutError(f"Рендер {len(items)} страниц не уложился в {timeout} с.")
+
+    rendered = {}
+    for future in futures:
+        rendered.update(future.result())
+    return rendered
+
+
+def shutdown():
+    """Останавливает пул процессов рендера при завершении бота."""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
@@ -0,0 +1,177 @@
+# pdf_access.py
+
+import re
+import logging
+from googleapiclient.http import MediaIoBaseDownload
+import config
+
+logger = logging.getLogger(__name__)
+
+# Размер блока, которым читаются части файла через Range-запросы
+RANGE_BLOCK_SIZE = 64 * 1024
+# Сколько байт с конца файла читать в поисках startxref
+TAIL_SIZE = 2048
+# Сколько раз переходить по /Prev к предыдущим таблицам xref (инкрементальные обновления PDF)
+MAX_XREF_SECTIONS = 8
+
+
+class _RangeReader:
+    """Читает произвольные участки файла с Google Drive Range-запросами, кэшируя прочитанные блоки."""
+
+    def __init__(self, drive_service, file_id: str, size: int):
+        self.drive_service = drive_service
+        self.file_id = file_id
+        self.size = size
+        self.blocks = {}
+        self.requests_made = 0
+
+    def _block(self, index: int) -> bytes:
+        if index not in self.blocks:
+            start = index * RANGE_BLOCK_SIZE
+            end = min(start + RANGE_BLOCK_SIZE, self.size) - 1
+            request = self.drive_service.files().get_media(fileId=self.file_id)
+            request.headers['Range'] = f'bytes={start}-{end}'
+            self.blocks[index] = request.execute()
+            self.requests_made += 1
+        return self.blocks[index]
+
+    def read(self, start: int, length: int) -> bytes:
+        start = max(0, start)
+        end = min(start + length, self.size)
+        if start >= end:
+            return b''
+        first_block, last_block = start // RANGE_BLOCK_SIZE, (end - 1) // RANGE_BLOCK_SIZE
+        data = b''.join(self._block(index) for index in range(first_block, last_block + 1))
+        offset = start - first_block * RANGE_BLOCK_SIZE
+        return data[offset:offset + (end - start)]
+
+
+def _linearized_page_count(reader: _RangeReader) -> int | None:
+    """Для линеаризованного PDF число страниц записано в словаре /Linearized в начале файла (ключ /N)."""
+    head = reader.read(0, 1024)
+    index = head.find(b'/Linearized')
+    if index == -1:
+        return None
+    end = head.find(b'>>', index)
+    params = head[index:end if end != -1 else len(head)]
+    pages = re.search(rb'/N\s+(\d+)', params)
+    length = re.search(rb'/L\s+(\d+)', params)
+    # Если файл дописывался после линеаризации, длина не совпадет и словарю верить нельзя
+    if not pages or (length and int(length.group(1)) != reader.size):
+        return None
+    return int(pages.group(1))
+
+
+def _read_xref_section(reader: _RangeReader, offset: int) -> tuple[list, bytes] | None:
+    """
+    Разбирает классическую таблицу xref по смещению: возвращает подсекции (первый объект, количество,
+    смещение записей) и текст trailer. Для xref-потоков (PDF 1.5+) возвращает None.
+    """
+    if not reader.read(offset, 4).startswith(b'xref'):
+        return None
+
+    subsections = []
+    position = offset + 4
+    while True:
+        chunk = reader.read(position, 64)
+        stripped = chunk.lstrip()
+        position += len(chunk) - len(stripped)
+        if stripped.startswith(b'trailer'):
+            trailer = reader.read(position, 4096)
+            return subsections, trailer
+        header = re.match(rb'(\d+)\s+(\d+)[ \t]*\r?\n', stripped)
+        if not header:
+            return None
+        first_object, count = int(header.group(1)), int(header.group(2))
+        entries_offset = position + header.end()
+        subsections.append((first_object, count, entries_offset))
+        # Каждая запись таблицы xref занимает ровно 20 байт
+        position = entries_offset + count * 20
+
+
+def _object_offset(reader: _RangeReader, sections: list, object_number: int) -> int | None:
+    """Ищет смещение объекта в таблицах xref, начиная с самой новой."""
+    for subsections in sections:
+        for first_object, count, entries_offset in subsections:
+            if first_object <= object_number < first_object + count:
+                entry = reader.read(entries_offset + (object_number - first_object) * 20, 20)
+                match = re.match(rb'(\d{10}) (\d{5}) ([nf])', entry)
+                if not match:
+                    return None
+                return int(match.group(1)) if match.group(3) == b'n' else None
+    return None
+
+
+def _read_object(reader: _RangeReader, offset: int) -> bytes:
+    return reader.read(offset, 4096)
+
+
+def _xref_page_count(reader: _RangeReader) -> int | None:
+    """Читает число страниц через trailer -> /Root -> /Pages -> /Count, не скачивая файл целиком."""
+    tail = reader.read(reader.size - TAIL_SIZE, TAIL_SIZE)
+    positions = [match.group(1) for match in re.finditer(rb'startxref\s+(\d+)', tail)]
+    if not positions:
+        return None
+
+    sections = []
+    root_number = None
+    offset = int(positions[-1])
+    for _ in range(MAX_XREF_SECTIONS):
+        section = _read_xref_section(reader, offset)
+        if section is None:
+            return None
+        subsections, trailer = section
+        sections.append(subsections)
+        if root_number is None:
+            root = re.search(rb'/Root\s+(\d+)\s+\d+\s+R', trailer)
+            root_number = int(root.group(1)) if root else None
+        previous = re.search(rb'/Prev\s+(\d+)', trailer)
+        if not previous:
+            break
+        offset = int(previous.group(1))
+
+    if root_number is None:
+        return None
+    root_offset = _object_offset(reader, sections, root_number)
+    if root_offset is None:
+        return None
+    pages = re.search(rb'/Pages\s+(\d+)\s+\d+\s+R', _read_object(reader, root_offset))
+    if not pages:
+        return None
+    pages_offset = _object_offset(reader, sections, int(pages.group(1)))
+    if pages_offset is None:
+        return None
+    count = re.search(rb'/Count\s+(\d+)(\s+\d+\s+R)?', _read_object(reader, pages_offset))
+    # /Count может быть косвенной ссылкой (/Count 12 0 R) — тогда числа здесь нет, и файл разбирается целиком
+    if not count or count.group(2):
+        return None
+    return int(count.group(1))
+
+
+def get_page_count_by_range(drive_service, file_id: str) -> int | None:
+    """
+    Определяет число страниц PDF на Google Drive, читая только нужные участки файла.
+    Возвращает None, если структуру файла так разобрать нельзя (например, xref-поток).
+    """
+    metadata = drive_service.files().get(fileId=file_id, fields='size', supportsAllDrives=True).execute()
+    size = int(metadata.get('size', 0))
+    if not size:
+        return None
+
+    reader = _RangeReader(drive_service, file_id, size)
+    page_count = _linearized_page_count(reader)
+    if page_count is None:
+        page_count = _xref_page_count(reader)
+    if page_count is not None:
+        logger.info(f"Число страниц PDF {file_id} определено по {reader.requests_made} Range-запросам: {page_count}.")
+    return page_count
+
+
+def download_to_file(drive_service, file_id: str, path: str):
+    """Скачивает файл с Google Drive по частям прямо на диск, не держа его целиком в памяти."""
+    request = drive_service.files().get_media(fileId=file_id)
+    with open(path, 'wb') as file:
+        downloader = MediaIoBaseDownload(file, request, chunksize=config.DRIVE_DOWNLOAD_CHUNK_SIZE)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk(num_retries=3)
@@ -0,0 +1,96 @@
+# service_cache.py
+
+import threading
+import logging
+import httplib2
+import google_auth_httplib2
+from cachetools import TTLCache
+from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+import config
+import google_async
+
+logger = logging.getLogger(__name__)
+
+
+class GuardedHttpRequest(HttpRequest):
+    """
+    HttpRequest, который не дает выполнить синхронный запрос в потоке цикла событий.
+    В режиме отладки такой вызов завершается исключением, в рабочем режиме — записывается в лог.
+    """
+
+    def execute(self, *args, **kwargs):
+        if google_async.in_event_loop_thread():
+            message = f"Синхронный запрос к Google API в потоке цикла событий: {self.method} {self.uri}"
+            if config.DEBUG_MODE:
+                raise RuntimeError(message)
+            logger.error(message, stack_info=True)
+        return super().execute(*args, **kwargs)
+
+
+# --- Реестр готовых клиентов Google API ---
+# Ключ: (user_id, api), значение: объект сервиса, построенный через discovery.build.
+# TTLCache одновременно ограничивает размер (вытесняет самые старые записи по LRU) и время жизни записи.
+_services = TTLCache(maxsize=config.SERVICE_CACHE_MAX_SIZE, ttl=config.SERVICE_CACHE_TTL_SECONDS)
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+
+
+def _build_service(api: str, version: str, credentials):
+    """
+    Строит клиент Google API, который можно безопасно использовать из разных потоков.
+    httplib2.Http не потокобезопасен, поэтому каждый запрос получает свой собственный
+    http-объект, а общий между потоками только сам сервис и учетные данные.
+    """
+    def build_request(http, *args, **kwargs):
+        new_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=config.GOOGLE_HTTP_TIMEOUT_SECONDS))
+        return GuardedHttpRequest(new_http, *args, **kwargs)
+
+    authorized_http = google_auth_httplib2.AuthorizedHttp(credentials, http=httplib2.Http(timeout=config.GOOGLE_HTTP_TIMEOUT_SECONDS))
+    return build(api, version, http=authorized_http, requestBuilder=build_request, cache_discovery=False)
+
+
+def get_service(user_id, api: str, version: str, load_credentials):
+    """
+    Возвращает готовый клиент Google API для пользователя из кэша или строит новый.
+    load_credentials вызывается только при промахе кэша.
+    """
+    key = (user_id, api)
+    with _lock:
+        service = _services.get(key)
+        if service is not None:
+            _stats['hits'] += 1
+            return service
+        _stats['misses'] += 1
+
+    creds = load_credentials(user_id)
+    if not creds:
+        return None
+
+    service = _build_service(api, version, creds)
+    with _lock:
+        _services[key] = service
+    return service
+
+
+def invalidate(user_id):
+    """Удаляет из кэша все клиенты пользователя (после обновления или удаления учетных данных)."""
+    with _lock:
+        keys = [key for key in list(_services.keys()) if key[0] == user_id]
+        for key in keys:
+            _services.pop(key, None)
+        if keys:
+            _stats['invalidations'] += len(keys)
+
+
+def clear():
+    """Полностью очищает кэш клиентов."""
+    with _lock:
+        _stats['invalidations'] += len(_services)
+        _services.clear()
+
+
+def get_stats() -> dict:
+    """Возвращает счетчики попаданий/промахов кэша и его текущий размер."""
+    with _lock:
+        return {**_stats, 'size': len(_services)}
@@ -1,8 +1,9 @@
 # sheets_logger.py
 import gspread
 import logging
-from datetime import datetime
+import threading
 import config
+import usage_ledger
 
 # Настройка логгирования
 logging.basicConfig(
@@ -10,52 +11,110 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-try:
-    # Авторизация с помощью JSON-ключа сервисного аккаунта
-    gc = gspread.service_account(filename='service_account.json')
-    # Открываем нашу таблицу по имени из конфига
-    sh = gc.open(config.GOOGLE_SHEET_NAME)
-    # Выбираем первый лист в таблице
-    worksheet = sh.sheet1
-    logger.info(f"✅ Успешное подключение к Google Sheet: {config.GOOGLE_SHEET_NAME}")
-except Exception as e:
-    worksheet = None
-    logger.error(f"❌ Не удалось подключиться к Google Sheets: {e}")
+# Лист таблицы; подключение выполняется явно из init() при запуске бота
+worksheet = None
+
+
+def init():
+    """Авторизуется в Google Sheets и открывает лист для выгрузки."""
+    global worksheet
+    try:
+        # Авторизация с помощью JSON-ключа сервисного аккаунта
+        gc = gspread.service_account(filename='service_account.json')
+        # Открываем нашу таблицу по имени из конфига
+        sh = gc.open(config.GOOGLE_SHEET_NAME)
+        # Выбираем первый лист в таблице
+        worksheet = sh.sheet1
+        logger.info(f"✅ Успешное подключение к Google Sheet: {config.GOOGLE_SHEET_NAME}")
+    except Exception as e:
+        worksheet = None
+        logger.error(f"❌ Не удалось подключиться к Google Sheets: {e}")
+
+
+# --- Фоновая выгрузка из журнала использования ---
+# Каждое событие сначала записывается в локальный журнал (usage_ledger), а в таблицу выгружаются
+# еще не выгруженные события пачками из фонового потока. Журнал переживает перезапуск бота.
+
+_flush_requested = threading.Event()
+_stop_requested = threading.Event()
+_thread = None
+
+
+def flush() -> bool:
+    """Выгружает очередную пачку событий одним запросом append_rows. Возвращает True, если выгружать больше нечего."""
+    if worksheet is None:
+        return False
+    events = usage_ledger.fetch_unexported(config.SHEETS_FLUSH_MAX_ROWS)
+    if not events:
+        return True
+
+    try:
+        worksheet.append_rows([row for _, row in events])
+    except Exception as e:
+        logger.error(f"Ошибка при записи {len(events)} строк в Google Sheets: {e}")
+        return False
+
+    usage_ledger.mark_exported([event_id for event_id, _ in events])
+    logger.info(f"В Google Sheets записано строк: {len(events)}.")
+    return len(events) < config.SHEETS_FLUSH_MAX_ROWS
+
+
+def _flush_loop():
+    while not _stop_requested.is_set():
+        _flush_requested.wait(timeout=config.SHEETS_FLUSH_INTERVAL_SECONDS)
+        _flush_requested.clear()
+        while not flush() and worksheet is not None and not _stop_requested.is_set():
+            # Ошибка отправки или в журнале больше одной пачки: повторяем после паузы, чтобы не упереться в квоты
+            if _stop_requested.wait(timeout=config.SHEETS_RETRY_DELAY_SECONDS):
+                break
+
+
+def start():
+    """Запускает фоновую выгрузку в Google Sheets; вызывается при старте бота."""
+    global _thread
+    if _thread is not None:
+        return
+    _stop_requested.clear()
+    _thread = threading.Thread(target=_flush_loop, name='sheets-logger', daemon=True)
+    _thread.start()
+
+
+def stop():
+    """Останавливает фоновую выгрузку и пытается выгрузить остаток; невыгруженное останется в журнале."""
+    global _thread
+    if _thread is None:
+        return
+    _stop_requested.set()
+    _flush_requested.set()
+    _thread.join(timeout=config.SHEETS_FLUSH_INTERVAL_SECONDS)
+    _thread = None
+    flush()
 
 
 def log_g_sheets(user_id, prompt_tokens, completion_tokens, total_tokens, summary_text,
-                 subject, homework_text, pages_str):
+                 subject, homework_text, pages_str, input_mode='images', text_pages=0, tokens_saved=0,
+                 estimated_prompt_tokens=0):
     """
-    Добавляет полную строку с данными об использовании ИИ в Google Таблицу.
-    Не делает ничего, если в конфиге включен DEBUG_MODE.
+    Записывает данные об использовании ИИ в локальный журнал (usage_ledger).
+    В Google Таблицу строка выгрузится из фонового потока вместе с другими.
+    В DEBUG_MODE событие пишется в журнал, но в таблицу не выгружается.
     """
+    try:
+        event_id = usage_ledger.record(
+            user_id, prompt_tokens, completion_tokens, total_tokens, subject, homework_text, pages_str,
+            summary_text, input_mode, text_pages, tokens_saved, estimated_prompt_tokens
+        )
+    except Exception as e:
+        logger.error(f"Ошибка при записи в журнал использования: {e}")
+        return
+
     # --- НОВАЯ ПРОВЕРКА ---
-    # Если бот в режиме отладки, ничего не делаем и выходим из функции
+    # Если бот в режиме отладки, в таблицу не выгружаем
     if config.DEBUG_MODE:
         logger.info("Режим отладки включен. Пропускаю логирование в Google Sheets.")
+        usage_ledger.mark_exported([event_id])
         return
     # -----------------------
 
-    if worksheet is None:
-        logger.warning("Пропускаю логирование в Google Sheets: отсутствует подключение.")
-        return
-
-    try:
-        current_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-
-        # Собираем строку со всеми новыми данными в правильном порядке
-        row = [
-            user_id,
-            current_time,
-            prompt_tokens,
-            completion_tokens,
-            total_tokens,
-            subject,
-            homework_text,
-            pages_str,
-            summary_text
-        ]
-        worksheet.append_row(row)
-        logger.info("Полная информация о запросе к AI успешно залогирована в Google Sheets.")
-    except Exception as e:
-        logger.error(f"Ошибка при записи в Google Sheets: {e}")
\ No newline at end of file
+    if usage_ledger.count_unexported() >= config.SHEETS_FLUSH_BATCH_SIZE:
+        _flush_requested.set()
@@ -0,0 +1,76 @@
+# subject_registry.py
+
+import time
+import threading
+import config
+
+# Предмет из расписания, для которого в меню добавляется отдельный пункт про лабораторную
+LAB_SUBJECT = "Теоретические основы информатики"
+LAB_SUBJECT_ITEM = "Лабораторная: Теоретические основы информатики"
+
+# Статичные предметы из config.SCHEDULE_DATA не меняются во время работы бота, поэтому считаются один раз
+STATIC_SUBJECTS = frozenset(
+    lesson['subject'] for day in config.SCHEDULE_DATA.values() for week in day.values() for lesson in week
+)
+
+# Кастомные предметы хранятся отдельно для каждого пользователя, а меню — их объединение: пересборка
+# по календарю одного пользователя (например, зарегистрированного позже создания мероприятий)
+# не стирает предметы, которые есть у других
+_lock = threading.Lock()
+_user_subjects = {}
+_loaded_at = {}
+_subjects_list = None
+
+
+def _build_list() -> list:
+    all_subjects = sorted(STATIC_SUBJECTS.union(*_user_subjects.values()))
+    if LAB_SUBJECT in all_subjects and LAB_SUBJECT_ITEM not in all_subjects:
+        all_subjects.append(LAB_SUBJECT_ITEM)
+        all_subjects.sort()
+    return all_subjects
+
+
+def needs_refresh(user_id) -> bool:
+    """Проверяет, нужно ли заново собрать кастомные предметы пользователя из его календаря."""
+    with _lock:
+        loaded_at = _loaded_at.get(user_id)
+        return loaded_at is None or time.monotonic() - loaded_at > config.SUBJECT_REGISTRY_REFRESH_SECONDS
+
+
+def set_user_subjects(user_id, subjects: set):
+    """Заменяет набор кастомных предметов пользователя (после сбора их из его календаря)."""
+    global _subjects_list
+    with _lock:
+        _user_subjects[user_id] = set(subjects)
+        _loaded_at[user_id] = time.monotonic()
+        _subjects_list = None
+
+
+def add_custom_subject(subject: str, user_ids: list):
+    """Добавляет предмет нового мероприятия пользователям, которым оно создано, не дожидаясь сбора из календаря."""
+    global _subjects_list
+    subject = subject.strip()
+    if not subject:
+        return
+    with _lock:
+        for user_id in user_ids:
+            _user_subjects.setdefault(user_id, set()).add(subject)
+        _subjects_list = None
+
+
+def forget_user(user_id):
+    """Удаляет предметы пользователя (например, при выходе из аккаунта)."""
+    global _subjects_list
+    with _lock:
+        _user_subjects.pop(user_id, None)
+        _loaded_at.pop(user_id, None)
+        _subjects_list = None
+
+
+def get_subjects() -> list:
+    """Возвращает отсортированный список всех предметов (статичных и кастомных всех пользователей)."""
+    global _subjects_list
+    with _lock:
+        if _subjects_list is None:
+            _subjects_list = _build_list()
+        return list(_subjects_list)
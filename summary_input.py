@@ -0,0 +1,208 @@
+# summary_input.py
+
+import re
+import json
+import math
+import base64
+import hashlib
+import config
+
+# Как страница передается модели
+INPUT_TEXT = 'text'
+INPUT_IMAGE = 'image'
+
+# Детализация изображения в запросе к OpenAI
+DETAIL_LOW = 'low'
+DETAIL_HIGH = 'high'
+
+
+def choose_page_input(analysis: dict) -> str:
+    """
+    Решает, отправлять страницу текстом или изображением: текстом — если у нее есть
+    достаточно плотный текстовый слой и на ней мало рисунков, которые текстом не передать.
+    """
+    if config.SUMMARY_INPUT_MODE != 'auto' or analysis is None:
+        return INPUT_IMAGE
+    if analysis['text_chars'] < config.SUMMARY_TEXT_MIN_CHARS:
+        return INPUT_IMAGE
+    if analysis['figure_coverage'] > config.SUMMARY_FIGURE_COVERAGE_MAX:
+        return INPUT_IMAGE
+    return INPUT_TEXT
+
+
+def normalize_text(text: str | None) -> str:
+    """Приводит текст к виду, в котором несущественные различия (регистр, пробелы) не влияют на ключ кэша."""
+    return re.sub(r'\s+', ' ', text or '').strip().lower()
+
+
+def make_cache_key(doc_key: str, pages: list, subject: str, homework_text: str | None,
+                   additional_info: str | None) -> str:
+    """
+    Ключ кэша готовых конспектов: версия файла, страницы, предмет, нормализованные тексты ДЗ
+    и доп. требований, а также модель, режим отправки страниц, выбор детализации и версия промпта.
+    """
+    parts = [
+        doc_key, sorted(pages), subject, normalize_text(homework_text), normalize_text(additional_info),
+        config.SUMMARY_OPENAI_MODEL, config.SUMMARY_INPUT_MODE, config.SUMMARY_IMAGE_DETAIL_MODE,
+        config.SUMMARY_PAGE_TOKEN_BUDGET, config.SUMMARY_PROMPT_VERSION,
+    ]
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+
+def lq_zoom(width: float, height: float) -> float:
+    """Масштаб рендера страницы для detail=low: большая сторона — SUMMARY_LQ_MAX_SIZE, но не крупнее HQ-версии."""
+    return min(config.SUMMARY_LQ_MAX_SIZE / max(width, height, 1), config.SUMMARY_HQ_DPI / 72)
+
+
+def _fit_patches(width: float, height: float) -> tuple[float, float]:
+    """
+    Размер, до которого OpenAI уменьшает изображение, если в нем больше OPENAI_IMAGE_MAX_PATCHES патчей:
+    пропорциональное уменьшение под лимит с выравниванием ширины по целому числу патчей.
+    """
+    patch = config.OPENAI_IMAGE_PATCH_SIZE
+    if math.ceil(width / patch) * math.ceil(height / patch) <= config.OPENAI_IMAGE_MAX_PATCHES:
+        return width, height
+    shrink = math.sqrt(patch * patch * config.OPENAI_IMAGE_MAX_PATCHES / (width * height))
+    width_patches = width * shrink / patch
+    shrink *= math.floor(width_patches) / width_patches
+    return width * shrink, height * shrink
+
+
+def hd_zoom(width: float, height: float) -> float:
+    """
+    Масштаб рендера страницы для detail=high: короткая сторона — SUMMARY_HD_SHORT_SIDE пикселей,
+    но не больше, чем OpenAI оставит после уменьшения под OPENAI_IMAGE_MAX_PATCHES, чтобы не рендерить лишнее.
+    """
+    width, height = max(width, 1), max(height, 1)
+    zoom = config.SUMMARY_HD_SHORT_SIDE / min(width, height)
+    fitted_width, _ = _fit_patches(width * zoom, height * zoom)
+    return fitted_width / width
+
+
+def estimate_image_tokens(width: float, height: float) -> int:
+    """
+    Цена изображения width x height пикселей во входных токенах для SUMMARY_OPENAI_MODEL: число патчей
+    OPENAI_IMAGE_PATCH_SIZE x OPENAI_IMAGE_PATCH_SIZE (после уменьшения под лимит, не больше
+    OPENAI_IMAGE_MAX_PATCHES), умноженное на OPENAI_IMAGE_TOKEN_MULTIPLIER.
+    Цена зависит только от размера, поэтому detail=low дешевле лишь за счет меньшей LQ-версии страницы.
+    """
+    patch = config.OPENAI_IMAGE_PATCH_SIZE
+    width, height = _fit_patches(max(width, 1), max(height, 1))
+    patches = min(math.ceil(width / patch) * math.ceil(height / patch), config.OPENAI_IMAGE_MAX_PATCHES)
+    return math.ceil(patches * config.OPENAI_IMAGE_TOKEN_MULTIPLIER)
+
+
+def page_image_tokens(width: float | None, height: float | None, detail: str) -> int:
+    """
+    Цена страницы размером width x height (в пунктах PDF), отправленной изображением с детализацией detail.
+    Если размер страницы неизвестен, для detail=low берется верхняя оценка — квадрат SUMMARY_LQ_MAX_SIZE.
+    """
+    if not width or not height:
+        return estimate_image_tokens(config.SUMMARY_LQ_MAX_SIZE, config.SUMMARY_LQ_MAX_SIZE)
+    zoom = hd_zoom(width, height) if detail == DETAIL_HIGH else lq_zoom(width, height)
+    return estimate_image_tokens(width * zoom, height * zoom)
+
+
+def _page_density(analysis: dict) -> float:
+    """
+    Насколько страница нуждается в высокой детализации: плотный текст и рисунки (формулы, схемы,
+    сканы — у скана нет текстового слоя, но картинка на всю страницу) важнее почти пустых страниц.
+    """
+    return analysis['text_chars'] / config.SUMMARY_TEXT_MIN_CHARS + analysis['figure_coverage'] * 4
+
+
+def plan_image_details(analyses: dict, image_pages: list, base_tokens: int) -> dict:
+    """
+    Выбирает детализацию для страниц, отправляемых изображениями, в пределах бюджета
+    SUMMARY_PAGE_TOKEN_BUDGET на все страницы запроса. Сначала все страницы получают detail=low,
+    затем самые плотные по очереди переводятся в detail=high, пока хватает бюджета.
+    base_tokens — сколько бюджета уже занимают страницы, отправленные текстом.
+    """
+    details = {page_num: DETAIL_LOW for page_num in image_pages}
+    if config.SUMMARY_IMAGE_DETAIL_MODE != 'adaptive':
+        return details
+
+    low_tokens = {
+        page_num: page_image_tokens(*_page_size(analyses.get(page_num)), DETAIL_LOW) for page_num in image_pages
+    }
+    budget = config.SUMMARY_PAGE_TOKEN_BUDGET - base_tokens - sum(low_tokens.values())
+    candidates = [
+        page_num for page_num in image_pages
+        if analyses.get(page_num) and _page_density(analyses[page_num]) >= config.SUMMARY_HD_MIN_DENSITY
+    ]
+    candidates.sort(key=lambda page_num: _page_density(analyses[page_num]), reverse=True)
+    for page_num in candidates:
+        extra = page_image_tokens(*_page_size(analyses[page_num]), DETAIL_HIGH) - low_tokens[page_num]
+        if extra <= budget:
+            details[page_num] = DETAIL_HIGH
+            budget -= extra
+    return details
+
+
+def _page_size(analysis: dict | None) -> tuple:
+    """Размер страницы в пунктах PDF из анализа страницы или (None, None), если анализа нет."""
+    return (analysis['width'], analysis['height']) if analysis else (None, None)
+
+
+def estimate_page_tokens(page_input: dict) -> int:
+    """Оценка входных токенов одной страницы в запросе."""
+    if page_input['kind'] == INPUT_TEXT:
+        return estimate_text_tokens(page_input['text'])
+    return page_image_tokens(page_input.get('width'), page_input.get('height'), page_input.get('detail', DETAIL_LOW))
+
+
+def estimate_prompt_tokens(prompt_text: str, page_inputs: list) -> int:
+    """Оценка входных токенов всего запроса: промпт и страницы."""
+    return estimate_text_tokens(prompt_text) + sum(estimate_page_tokens(page_input) for page_input in page_inputs)
+
+
+def parse_analysis(data: bytes | None) -> dict | None:
+    return json.loads(data.decode('utf-8')) if data else None
+
+
+def estimate_text_tokens(text: str) -> int:
+    return len(text) // config.OPENAI_CHARS_PER_TOKEN + 1
+
+
+def build_content_parts(page_inputs: list) -> list:
+    """
+    Собирает части сообщения для OpenAI в порядке страниц.
+    page_inputs — словари {'page', 'kind', 'text' | 'image', 'detail', 'width', 'height'}
+    (размер страницы в пунктах PDF нужен только для оценки токенов).
+    """
+    parts = []
+    for page_input in page_inputs:
+        if page_input['kind'] == INPUT_TEXT:
+            parts.append({"type": "text", "text": f"--- Страница {page_input['page']} (текст) ---\n{page_input['text']}"})
+        else:
+            parts.append({"type": "text", "text": f"--- Страница {page_input['page']} (изображение) ---"})
+            parts.append({
+                "type": "image_url",
+                "image_url": {
+                    "url": f"data:image/jpeg;base64,{base64.b64encode(page_input['image']).decode('utf-8')}",
+                    "detail": page_input.get('detail', DETAIL_LOW)
+                }
+            })
+    return parts
+
+
+def describe_inputs(page_inputs: list) -> tuple[str, int, int]:
+    """
+    Возвращает режим запроса ('images', 'text' или 'mixed'), число страниц, отправленных текстом,
+    и оценку сэкономленных входных токенов по сравнению с отправкой всех страниц изображениями.
+    Экономия может быть отрицательной: плотная страница текстом дороже изображения с detail=low,
+    зато модель получает текст без потерь от сжатия.
+    """
+    text_inputs = [page_input for page_input in page_inputs if page_input['kind'] == INPUT_TEXT]
+    if not text_inputs:
+        mode = 'images'
+    elif len(text_inputs) == len(page_inputs):
+        mode = 'text'
+    else:
+        mode = 'mixed'
+    tokens_saved = sum(
+        page_image_tokens(page_input.get('width'), page_input.get('height'), DETAIL_LOW)
+        - estimate_text_tokens(page_input['text'])
+        for page_input in text_inputs
+    )
+    return mode, len(text_inputs), tokens_saved
@@ -0,0 +1,180 @@
+# summary_queue.py
+
+import time
+import uuid
+import asyncio
+import logging
+from collections import deque, Counter
+from dataclasses import dataclass, field
+import config
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Задачу нельзя поставить в очередь; текст исключения можно показать пользователю."""
+
+
+@dataclass
+class SummaryJob:
+    """
+    Задача на конспект. run() выполняет всю работу (скачивание, рендер, запрос к модели, отправку результата),
+    on_position(n) сообщает пользователю его место в очереди (1 — следующая).
+    """
+    user_id: int
+    run: object
+    on_position: object = None
+    job_id: str = field(default_factory=lambda: uuid.uuid4().hex[:8])
+    enqueued_at: float = field(default_factory=time.monotonic)
+    position: int = 0
+    started: bool = False
+    # Не дает уведомлению о месте в очереди перезаписать сообщение, которое уже редактирует сама задача
+    status_lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+
+class SummaryQueue:
+    """
+    Очередь задач на конспект с ограниченным пулом обработчиков.
+    Общий лимит одновременных задач — число обработчиков; у одного пользователя одновременно
+    выполняется не больше max_running_per_user задач, а всего (в очереди и в работе) — не больше max_jobs_per_user.
+    """
+
+    def __init__(self, workers: int, max_running_per_user: int, max_jobs_per_user: int, max_pending: int):
+        self.workers = workers
+        self.max_running_per_user = max_running_per_user
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_pending = max_pending
+        self._pending = deque()
+        self._running = Counter()
+        self._condition = asyncio.Condition()
+        self._positions_changed = asyncio.Event()
+        self._tasks = []
+        self._stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'rejected': 0}
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._worker(), name=f"summary_worker_{i}") for i in range(self.workers)]
+        self._tasks.append(loop.create_task(self._position_notifier(), name="summary_positions"))
+        logger.info(f"Очередь конспектов запущена: {self.workers} обработчиков.")
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, job: SummaryJob) -> int:
+        """Ставит задачу в очередь и возвращает ее место. Выбрасывает QueueFullError, если лимиты исчерпаны."""
+        async with self._condition:
+            user_jobs = self._running[job.user_id] + sum(1 for queued in self._pending if queued.user_id == job.user_id)
+            if user_jobs >= self.max_jobs_per_user:
+                self._stats['rejected'] += 1
+                raise QueueFullError(
+                    "У вас уже есть запрос на конспект в работе. Дождитесь результата и попробуйте снова."
+                )
+            if len(self._pending) >= self.max_pending:
+                self._stats['rejected'] += 1
+                raise QueueFullError("Сейчас слишком много запросов на конспекты. Попробуйте через несколько минут.")
+            self._pending.append(job)
+            position = len(self._pending)
+            self._stats['submitted'] += 1
+            self._condition.notify_all()
+        # Первое место в очереди пользователь увидит от уведомителя (если задача не запустится раньше)
+        self._positions_changed.set()
+        logger.info(f"Задача конспекта {job.job_id} пользователя {job.user_id} в очереди, место {position}.")
+        return position
+
+    def _take_next(self) -> SummaryJob | None:
+        """Берет первую задачу, пользователь которой не превысил лимит одновременных задач."""
+        for job in self._pending:
+            if self._running[job.user_id] < self.max_running_per_user:
+                self._pending.remove(job)
+                self._running[job.user_id] += 1
+                return job
+        return None
+
+    async def _worker(self):
+        while True:
+            async with self._condition:
+                job = self._take_next()
+                while job is None:
+                    await self._condition.wait()
+                    job = self._take_next()
+            self._positions_changed.set()
+
+            async with job.status_lock:
+                job.started = True
+            waited = time.monotonic() - job.enqueued_at
+            logger.info(f"Задача конспекта {job.job_id} запущена после {waited:.1f} с в очереди.")
+            try:
+                await job.run()
+                self._stats['completed'] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._stats['failed'] += 1
+                logger.error(f"Ошибка в задаче конспекта {job.job_id}: {e}", exc_info=True)
+            finally:
+                async with self._condition:
+                    self._running[job.user_id] -= 1
+                    if self._running[job.user_id] <= 0:
+                        del self._running[job.user_id]
+                    self._condition.notify_all()
+
+    async def _position_notifier(self):
+        """Сообщает ожидающим пользователям их новое место в очереди, когда очередь сдвигается."""
+        while True:
+            await self._positions_changed.wait()
+            self._positions_changed.clear()
+            async with self._condition:
+                changed = []
+                for position, job in enumerate(self._pending, start=1):
+                    if job.position != position:
+                        job.position = position
+                        changed.append(job)
+            for job in changed:
+                if job.on_position is None:
+                    continue
+                async with job.status_lock:
+                    if job.started:
+                        continue
+                    try:
+                        await job.on_position(job.position)
+                    except Exception as e:
+                        logger.warning(f"Не удалось обновить место в очереди для задачи {job.job_id}: {e}")
+
+    def get_stats(self) -> dict:
+        return {**self._stats, 'pending': len(self._pending), 'running': sum(self._running.values())}
+
+
+_queue: SummaryQueue | None = None
+
+
+def start():
+    """Создает и запускает очередь конспектов; вызывается из работающего event loop при старте бота."""
+    global _queue
+    _queue = SummaryQueue(
+        workers=config.SUMMARY_QUEUE_WORKERS,
+        max_running_per_user=config.SUMMARY_MAX_RUNNING_PER_USER,
+        max_jobs_per_user=config.SUMMARY_MAX_JOBS_PER_USER,
+        max_pending=config.SUMMARY_QUEUE_MAX_PENDING,
+    )
+    _queue.start()
+
+
+async def stop():
+    if _queue is not None:
+        await _queue.stop()
+
+
+async def submit(user_id: int, run, on_position=None) -> tuple[str, int]:
+    """Ставит задачу в очередь; возвращает ID задачи и ее место в очереди."""
+    if _queue is None:
+        raise QueueFullError("Очередь конспектов еще не запущена. Попробуйте через минуту.")
+    job = SummaryJob(user_id=user_id, run=run, on_position=on_position)
+    position = await _queue.submit(job)
+    return job.job_id, position
+
+
+def get_stats() -> dict:
+    return _queue.get_stats() if _queue is not None else {}
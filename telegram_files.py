@@ -0,0 +1,110 @@
+# telegram_files.py
+
+import io
+import asyncio
+import hashlib
+import logging
+import telegram
+from telegram import InputMediaPhoto
+from cachetools import LRUCache
+import config
+import database
+
+logger = logging.getLogger(__name__)
+
+# Локальная копия соответствий ключ -> file_id, чтобы не ходить в MongoDB за часто отправляемыми файлами
+_file_ids = LRUCache(maxsize=config.TELEGRAM_FILE_ID_CACHE_SIZE)
+_stats = {'reused': 0, 'uploaded': 0}
+
+
+def content_key(kind: str, data: bytes) -> str:
+    """Ключ файла по содержимому: одинаковые байты — один и тот же файл в Telegram."""
+    return f"{kind}:{hashlib.sha256(data).hexdigest()}"
+
+
+async def lookup(keys: list) -> dict:
+    """Возвращает {ключ: file_id} для уже отправленных файлов."""
+    found = {key: _file_ids[key] for key in keys if key in _file_ids}
+    missing = [key for key in keys if key not in found]
+    if missing:
+        stored = await asyncio.to_thread(database.get_telegram_file_ids, missing)
+        _file_ids.update(stored)
+        found.update(stored)
+    return found
+
+
+async def remember(file_ids: dict):
+    """Запоминает file_id только что загруженных файлов."""
+    if not file_ids:
+        return
+    _file_ids.update(file_ids)
+    await asyncio.to_thread(database.save_telegram_file_ids, file_ids)
+
+
+async def forget(keys: list):
+    for key in keys:
+        _file_ids.pop(key, None)
+        await asyncio.to_thread(database.delete_telegram_file_id, key)
+
+
+async def send_photo_group(bot, chat_id: int, images: list[bytes]):
+    """
+    Отправляет альбом из JPEG-изображений. Уже отправленные раньше изображения передаются по file_id,
+    без повторной загрузки; для новых file_id запоминается из ответа Telegram.
+    """
+    keys = [content_key('photo', image) for image in images]
+    known = await lookup(keys)
+
+    def build_media(use_known: bool) -> list:
+        return [
+            InputMediaPhoto(media=known[key] if use_known and key in known else io.BytesIO(image))
+            for key, image in zip(keys, images)
+        ]
+
+    try:
+        messages = await bot.send_media_group(chat_id=chat_id, media=build_media(use_known=True))
+    except telegram.error.BadRequest as e:
+        if not known:
+            raise
+        # Сохраненный file_id больше не принимается — забываем их и загружаем изображения заново
+        logger.warning(f"Telegram не принял сохраненные file_id, загружаю изображения заново: {e}")
+        await forget(list(known))
+        known = {}
+        messages = await bot.send_media_group(chat_id=chat_id, media=build_media(use_known=False))
+
+    uploaded = {
+        key: message.photo[-1].file_id
+        for key, message in zip(keys, messages)
+        if key not in known and message.photo
+    }
+    _stats['reused'] += len(keys) - len(uploaded)
+    _stats['uploaded'] += len(uploaded)
+    await remember(uploaded)
+    return messages
+
+
+async def reply_cached_document(message, key: str, make_document, filename: str):
+    """
+    Отвечает документом. Если документ с таким ключом уже отправлялся, он передается по file_id,
+    а make_document() (подготовка байтов) не вызывается вовсе.
+    """
+    file_id = (await lookup([key])).get(key)
+    if file_id:
+        try:
+            sent = await message.reply_document(document=file_id)
+            _stats['reused'] += 1
+            return sent
+        except telegram.error.BadRequest as e:
+            logger.warning(f"Telegram не принял сохраненный file_id документа, загружаю заново: {e}")
+            await forget([key])
+
+    data = await make_document()
+    sent = await message.reply_document(document=io.BytesIO(data), filename=filename)
+    _stats['uploaded'] += 1
+    if sent.document:
+        await remember({key: sent.document.file_id})
+    return sent
+
+
+def get_stats() -> dict:
+    return dict(_stats)
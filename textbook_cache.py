@@ -0,0 +1,101 @@
+# textbook_cache.py
+
+import os
+import hashlib
+import logging
+import fitz  # PyMuPDF
+import config
+import pdf_access
+from disk_cache import DiskLRUCache
+
+logger = logging.getLogger(__name__)
+
+# Файлы с Google Drive (учебники и вложения к ДЗ), по одной копии на каждую версию файла
+_cache = DiskLRUCache(config.TEXTBOOK_CACHE_DIR, config.TEXTBOOK_CACHE_MAX_BYTES, name='учебников')
+
+
+def get_version_key(drive_service, file_id: str) -> str:
+    """Ключ кэша: ID файла + md5Checksum (или modifiedTime, если у файла нет контрольной суммы)."""
+    metadata = drive_service.files().get(
+        fileId=file_id, fields='md5Checksum,modifiedTime', supportsAllDrives=True
+    ).execute()
+    version = metadata.get('md5Checksum') or metadata.get('modifiedTime', '')
+    return f"{file_id}:{version}"
+
+
+def get_cached_path(drive_service, file_id: str, suffix: str = '.pdf', pin: bool = False) -> str | None:
+    """Возвращает путь к актуальной версии файла, если она уже есть в кэше (pin — как в get_path)."""
+    return _cache.get_path(get_version_key(drive_service, file_id), suffix, pin=pin)
+
+
+def get_path(drive_service, file_id: str, suffix: str = '.pdf', pin: bool = False) -> str:
+    """
+    Возвращает путь к локальной копии актуальной версии файла, скачивая его при промахе.
+    Одновременные запросы одного файла ждут одну загрузку.
+    pin=True закрепляет файл в кэше: пока вызывающий не вызовет release(path), вытеснение его не удалит.
+    """
+    key = get_version_key(drive_service, file_id)
+    path = _cache.get_path(key, suffix, pin=pin)
+    if path:
+        return path
+
+    with _cache.key_lock(key):
+        path = _cache.get_path(key, suffix, pin=pin)
+        if path:
+            return path
+        temp_path = _cache.temp_path(suffix)
+        try:
+            pdf_access.download_to_file(drive_service, file_id, temp_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        logger.info(f"Файл {file_id} скачан в кэш учебников ({os.path.getsize(temp_path)} байт).")
+        return _cache.put_file(key, temp_path, suffix, pin=pin)
+
+
+def release(path: str):
+    """Снимает закрепление файла, полученного с pin=True."""
+    _cache.unpin(path)
+
+
+def put_uploaded(file_id: str, data: bytes, suffix: str = '.pdf', pin: bool = False) -> str:
+    """
+    Кладет в кэш файл, который бот только что сам загрузил на Drive, чтобы не скачивать его обратно.
+    md5Checksum у Drive — это MD5 содержимого, поэтому ключ совпадает с тем, что вернет get_version_key.
+    """
+    key = f"{file_id}:{hashlib.md5(data).hexdigest()}"
+    return _cache.put_bytes(key, data, suffix, pin=pin)
+
+
+def open_document(path: str):
+    """
+    Открывает документ по пути: MuPDF читает страницы с диска по мере надобности,
+    поэтому даже большой учебник не загружается в память целиком.
+    """
+    return fitz.open(path)
+
+
+def get_page_count(drive_service, file_id: str) -> int | None:
+    """
+    Возвращает число страниц PDF: из кэша, если файл уже скачан; иначе через Range-запросы;
+    если PDF так не разобрать — скачивает его в кэш (он понадобится для конспекта).
+    """
+    path = get_cached_path(drive_service, file_id, pin=True)
+    if path is None:
+        try:
+            page_count = pdf_access.get_page_count_by_range(drive_service, file_id)
+            if page_count is not None:
+                return page_count
+        except Exception as e:
+            logger.warning(f"Не удалось определить число страниц PDF {file_id} по частям: {e}")
+        path = get_path(drive_service, file_id, pin=True)
+
+    try:
+        with open_document(path) as doc:
+            return doc.page_count
+    finally:
+        release(path)
+
+
+def get_stats() -> dict:
+    return _cache.get_stats()
@@ -0,0 +1,125 @@
+# textbook_ingest.py
+
+import logging
+from datetime import datetime, timezone
+from bson import Binary
+import fitz  # PyMuPDF
+import config
+import database
+import page_cache
+import page_render
+import summary_input
+import textbook_cache
+
+logger = logging.getLogger(__name__)
+
+
+def _build_outline(doc) -> list:
+    """
+    Превращает оглавление PDF в список разделов с диапазонами страниц.
+    Раздел заканчивается перед началом следующего раздела того же или более высокого уровня.
+    """
+    entries = [
+        (level, title.strip(), page)
+        for level, title, page, *_ in doc.get_toc(simple=True)
+        if 1 <= page <= doc.page_count and title.strip()
+    ]
+    outline = []
+    for index, (level, title, start_page) in enumerate(entries):
+        end_page = doc.page_count
+        for next_level, _, next_page in entries[index + 1:]:
+            if next_level <= level:
+                end_page = max(start_page, next_page - 1)
+                break
+        outline.append({"level": level, "title": title, "start_page": start_page, "end_page": end_page})
+    return outline
+
+
+def _page_thumbnail(page) -> bytes:
+    """Рендерит маленькое превью страницы в JPEG (ширина TEXTBOOK_THUMBNAIL_WIDTH)."""
+    zoom = config.TEXTBOOK_THUMBNAIL_WIDTH / max(page.rect.width, 1)
+    pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
+    return pix.tobytes("jpeg", jpg_quality=config.TEXTBOOK_THUMBNAIL_JPEG_QUALITY)
+
+
+def extract_textbook_data(doc) -> tuple[dict, list]:
+    """
+    Собирает из открытого PDF данные для документа учебника (число страниц, оглавление)
+    и постраничные записи: анализ страницы, как для конспекта (текст, доля рисунков, размер), и миниатюра.
+    """
+    settings = {'text_max_chars': config.TEXTBOOK_PAGE_TEXT_MAX_CHARS}
+    pages = []
+    text_pages = 0
+    for page in doc:
+        analysis = summary_input.parse_analysis(page_render.analyze_page(page, settings))
+        if analysis['text']:
+            text_pages += 1
+        pages.append({
+            "page": page.number + 1,
+            **analysis,
+            "thumbnail": Binary(_page_thumbnail(page)),
+        })
+
+    metadata = {
+        "page_count": doc.page_count,
+        "outline": _build_outline(doc),
+        "text_pages": text_pages,
+    }
+    return metadata, pages
+
+
+def ingest_textbook(file_id: str, file_bytes: bytes) -> dict | None:
+    """
+    Обрабатывает только что загруженный учебник: кладет файл в кэш учебников, извлекает
+    число страниц, оглавление, текст и миниатюры страниц и сохраняет их в MongoDB.
+    Выполняется в фоновом потоке, поэтому ошибки только логируются.
+    """
+    started_at = datetime.now(timezone.utc)
+    try:
+        path = textbook_cache.put_uploaded(file_id, file_bytes, pin=True)
+        try:
+            with textbook_cache.open_document(path) as doc:
+                metadata, pages = extract_textbook_data(doc)
+        finally:
+            textbook_cache.release(path)
+        # Версия файла, по которой собраны страницы: для другой версии сохраненный анализ не подходит
+        metadata["doc_key"] = page_cache.document_key(path)
+    except Exception as e:
+        logger.error(f"Не удалось обработать учебник {file_id}: {e}")
+        return None
+
+    if not database.save_textbook_pages(file_id, pages):
+        return None
+    metadata["ingested_at"] = datetime.now(timezone.utc)
+    database.update_textbook_metadata(file_id, metadata)
+
+    elapsed = (metadata["ingested_at"] - started_at).total_seconds()
+    logger.info(
+        f"Учебник {file_id} обработан за {elapsed:.1f} с: {metadata['page_count']} стр., "
+        f"{len(metadata['outline'])} разделов в оглавлении, {metadata['text_pages']} стр. с текстом."
+    )
+    return metadata
+
+
+def get_page_analyses(file_id: str, doc_key: str, pages: list) -> dict:
+    """
+    Возвращает {номер страницы: анализ} из данных, сохраненных при загрузке учебника, чтобы не разбирать
+    PDF заново. Пусто, если учебник не обработан или обработана другая версия файла (doc_key).
+    Текст обрезается до SUMMARY_PAGE_TEXT_MAX_CHARS, как в анализе страниц для конспекта.
+    """
+    textbook = database.get_textbook_by_file_id(file_id)
+    if not textbook or textbook.get("doc_key") != doc_key:
+        return {}
+    analyses = {}
+    for stored in database.get_textbook_pages(file_id, pages):
+        # Учебники, обработанные до сохранения анализа, содержат только текст
+        if "text_chars" not in stored:
+            continue
+        analyses[stored["page"]] = {
+            "text": stored["text"][:config.SUMMARY_PAGE_TEXT_MAX_CHARS],
+            "text_chars": stored["text_chars"],
+            "figure_coverage": stored["figure_coverage"],
+            "width": stored["width"],
+            "height": stored["height"],
+        }
+    return analyses
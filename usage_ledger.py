@@ -0,0 +1,185 @@
+# usage_ledger.py
+
+import os
+import sqlite3
+import logging
+import threading
+from datetime import datetime, timedelta
+import config
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage_events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    day TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    subject TEXT,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    input_mode TEXT,
+    text_pages INTEGER NOT NULL DEFAULT 0,
+    tokens_saved INTEGER NOT NULL DEFAULT 0,
+    estimated_prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    homework_text TEXT,
+    pages_str TEXT,
+    summary_text TEXT,
+    exported INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS usage_events_unexported ON usage_events (exported, id);
+
+CREATE TABLE IF NOT EXISTS usage_daily (
+    user_id INTEGER NOT NULL,
+    subject TEXT NOT NULL,
+    day TEXT NOT NULL,
+    requests INTEGER NOT NULL DEFAULT 0,
+    cache_hits INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens INTEGER NOT NULL DEFAULT 0,
+    completion_tokens INTEGER NOT NULL DEFAULT 0,
+    total_tokens INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, day, subject)
+);
+CREATE INDEX IF NOT EXISTS usage_daily_by_day ON usage_daily (day);
+"""
+
+# Порядок полей в строке Google Таблицы (как в прежнем log_g_sheets)
+_EXPORT_COLUMNS = (
+    'user_id', 'created_at', 'prompt_tokens', 'completion_tokens', 'total_tokens', 'subject',
+    'homework_text', 'pages_str', 'summary_text', 'input_mode', 'text_pages', 'tokens_saved',
+    'estimated_prompt_tokens',
+)
+
+# Колонки, добавленные после создания схемы: в существующую базу они добавляются при подключении
+_ADDED_COLUMNS = {
+    'estimated_prompt_tokens': "INTEGER NOT NULL DEFAULT 0",
+}
+
+_lock = threading.Lock()
+_connection = None
+
+
+def _connect() -> sqlite3.Connection:
+    global _connection
+    if _connection is None:
+        os.makedirs(os.path.dirname(config.USAGE_LEDGER_PATH) or '.', exist_ok=True)
+        _connection = sqlite3.connect(config.USAGE_LEDGER_PATH, check_same_thread=False)
+        _connection.row_factory = sqlite3.Row
+        # WAL: чтение агрегатов не ждет записи новых событий
+        _connection.execute("PRAGMA journal_mode=WAL")
+        _connection.executescript(_SCHEMA)
+        existing = {row['name'] for row in _connection.execute("PRAGMA table_info(usage_events)")}
+        for column, definition in _ADDED_COLUMNS.items():
+            if column not in existing:
+                _connection.execute(f"ALTER TABLE usage_events ADD COLUMN {column} {definition}")
+    return _connection
+
+
+def today() -> str:
+    return datetime.now().strftime('%Y-%m-%d')
+
+
+def record(user_id: int, prompt_tokens: int, completion_tokens: int, total_tokens: int, subject: str = None,
+           homework_text: str = None, pages_str: str = None, summary_text: str = None,
+           input_mode: str = 'images', text_pages: int = 0, tokens_saved: int = 0,
+           estimated_prompt_tokens: int = 0) -> int:
+    """
+    Добавляет событие использования AI и в той же транзакции обновляет дневные агрегаты
+    по пользователю и предмету. Возвращает ID события.
+    """
+    created_at = datetime.now()
+    day = created_at.strftime('%Y-%m-%d')
+    cache_hit = 1 if input_mode == 'cache' else 0
+    with _lock:
+        connection = _connect()
+        with connection:
+            cursor = connection.execute(
+                "INSERT INTO usage_events (created_at, day, user_id, subject, prompt_tokens, completion_tokens, "
+                "total_tokens, input_mode, text_pages, tokens_saved, estimated_prompt_tokens, homework_text, "
+                "pages_str, summary_text) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (created_at.strftime('%Y-%m-%d %H:%M:%S'), day, user_id, subject, prompt_tokens, completion_tokens,
+                 total_tokens, input_mode, text_pages, tokens_saved, estimated_prompt_tokens, homework_text,
+                 pages_str, summary_text)
+            )
+            connection.execute(
+                "INSERT INTO usage_daily (user_id, subject, day, requests, cache_hits, prompt_tokens, "
+                "completion_tokens, total_tokens) VALUES (?, ?, ?, 1, ?, ?, ?, ?) "
+                "ON CONFLICT (user_id, day, subject) DO UPDATE SET "
+                "requests = requests + 1, cache_hits = cache_hits + excluded.cache_hits, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, "
+                "completion_tokens = completion_tokens + excluded.completion_tokens, "
+                "total_tokens = total_tokens + excluded.total_tokens",
+                (user_id, subject or '', day, cache_hit, prompt_tokens, completion_tokens, total_tokens)
+            )
+        return cursor.lastrowid
+
+
+def get_user_tokens_for_day(user_id: int, day: str = None) -> int:
+    """Сколько токенов пользователь израсходовал за день (по умолчанию — сегодня)."""
+    with _lock:
+        row = _connect().execute(
+            "SELECT COALESCE(SUM(total_tokens), 0) AS tokens FROM usage_daily WHERE user_id = ? AND day = ?",
+            (user_id, day or today())
+        ).fetchone()
+    return row['tokens']
+
+
+def get_daily_totals(day: str = None) -> list:
+    """Итоги дня по пользователям, от самых активных."""
+    with _lock:
+        rows = _connect().execute(
+            "SELECT user_id, SUM(requests) AS requests, SUM(cache_hits) AS cache_hits, "
+            "SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens, "
+            "SUM(total_tokens) AS total_tokens FROM usage_daily WHERE day = ? "
+            "GROUP BY user_id ORDER BY total_tokens DESC",
+            (day or today(),)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_user_usage(user_id: int, days: int = 7) -> list:
+    """Агрегаты пользователя по дням и предметам за последние days дней."""
+    since = (datetime.now() - timedelta(days=days - 1)).strftime('%Y-%m-%d')
+    with _lock:
+        rows = _connect().execute(
+            "SELECT day, subject, requests, cache_hits, prompt_tokens, completion_tokens, total_tokens "
+            "FROM usage_daily WHERE user_id = ? AND day >= ? ORDER BY day DESC, total_tokens DESC",
+            (user_id, since)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def get_subject_totals(since_day: str) -> list:
+    """Суммарное использование по предметам начиная с дня since_day."""
+    with _lock:
+        rows = _connect().execute(
+            "SELECT subject, SUM(requests) AS requests, SUM(total_tokens) AS total_tokens "
+            "FROM usage_daily WHERE day >= ? GROUP BY subject ORDER BY total_tokens DESC",
+            (since_day,)
+        ).fetchall()
+    return [dict(row) for row in rows]
+
+
+def fetch_unexported(limit: int) -> list:
+    """Возвращает (ID, строка для Google Таблицы) для еще не выгруженных событий, по порядку."""
+    with _lock:
+        rows = _connect().execute(
+            f"SELECT id, {', '.join(_EXPORT_COLUMNS)} FROM usage_events WHERE exported = 0 ORDER BY id LIMIT ?",
+            (limit,)
+        ).fetchall()
+    return [(row['id'], [row[column] for column in _EXPORT_COLUMNS]) for row in rows]
+
+
+def count_unexported() -> int:
+    with _lock:
+        return _connect().execute("SELECT COUNT(*) FROM usage_events WHERE exported = 0").fetchone()[0]
+
+
+def mark_exported(event_ids: list):
+    if not event_ids:
+        return
+    with _lock:
+        connection = _connect()
+        with connection:
+            connection.executemany("UPDATE usage_events SET exported = 1 WHERE id = ?", [(i,) for i in event_ids])
@@ -0,0 +1,124 @@
+# usage_limits.py
+
+import time
+import logging
+import threading
+from collections import Counter
+from cachetools import LRUCache
+import config
+import usage_ledger
+
+logger = logging.getLogger(__name__)
+
+
+class LimitExceeded(Exception):
+    """Запрос отклонен лимитом; текст исключения можно показать пользователю."""
+
+
+class _UserBucket:
+    """Token bucket одного пользователя: запас SUMMARY_REQUEST_BURST запросов, пополняется равномерно."""
+
+    def __init__(self):
+        self.tokens = float(config.SUMMARY_REQUEST_BURST)
+        self.updated_at = time.monotonic()
+
+    def try_acquire(self) -> float:
+        """Забирает один запрос; возвращает 0 при успехе или сколько секунд ждать до следующего."""
+        rate = config.SUMMARY_REQUESTS_PER_HOUR / 3600
+        now = time.monotonic()
+        self.tokens = min(config.SUMMARY_REQUEST_BURST, self.tokens + (now - self.updated_at) * rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / rate
+
+    def refund(self):
+        """Возвращает запрос, который так и не был выполнен."""
+        self.tokens = min(config.SUMMARY_REQUEST_BURST, self.tokens + 1)
+
+
+_lock = threading.Lock()
+_buckets = LRUCache(maxsize=config.SUMMARY_LIMITS_MAX_USERS)
+# Токены, зарезервированные под конспекты в работе: расход по ним еще не попал в журнал
+_reserved = Counter()
+
+
+def is_exempt(user_id: int) -> bool:
+    return user_id in config.ADMIN_IDS
+
+
+def _format_wait(seconds: float) -> str:
+    minutes = int(seconds // 60) + 1
+    return f"{minutes} мин." if minutes < 60 else f"{minutes // 60} ч {minutes % 60} мин."
+
+
+def _check_budget(user_id: int):
+    """
+    Проверяет дневной бюджет с учетом резервов конспектов, которые еще выполняются.
+    Вызывается под _lock, чтобы между проверкой и резервированием не вклинился другой конспект.
+    """
+    used = usage_ledger.get_user_tokens_for_day(user_id)
+    reserved = _reserved[user_id]
+    if used + reserved + config.SUMMARY_TOKEN_RESERVATION > config.SUMMARY_DAILY_TOKEN_BUDGET:
+        raise LimitExceeded(
+            f"Дневной лимит на конспекты исчерпан ({used} из {config.SUMMARY_DAILY_TOKEN_BUDGET} токенов). "
+            "Попробуйте завтра."
+        )
+
+
+def check_request(user_id: int):
+    """
+    Проверяет, можно ли принять новый запрос на конспект: частоту запросов (token bucket)
+    и дневной бюджет токенов. При успехе расходует один запрос из bucket; если запрос не удалось
+    поставить в очередь, его нужно вернуть через refund_request().
+    Выбрасывает LimitExceeded. Админы из config.ADMIN_IDS не ограничены.
+    """
+    if is_exempt(user_id):
+        return
+    with _lock:
+        _check_budget(user_id)
+        bucket = _buckets.get(user_id)
+        if bucket is None:
+            bucket = _buckets[user_id] = _UserBucket()
+        wait_seconds = bucket.try_acquire()
+    if wait_seconds:
+        raise LimitExceeded(f"Слишком много запросов на конспекты. Следующий можно через {_format_wait(wait_seconds)}")
+
+
+def refund_request(user_id: int):
+    """Возвращает в bucket запрос, принятый check_request(), но не попавший в очередь."""
+    if is_exempt(user_id):
+        return
+    with _lock:
+        bucket = _buckets.get(user_id)
+        if bucket is not None:
+            bucket.refund()
+
+
+def reserve(user_id: int):
+    """
+    Резервирует токены под конспект перед обращением к модели (после ожидания в очереди бюджет проверяется снова).
+    Фактический расход списывается записью response.usage в журнал, после чего резерв снимается release().
+    """
+    if is_exempt(user_id):
+        return
+    with _lock:
+        _check_budget(user_id)
+        _reserved[user_id] += config.SUMMARY_TOKEN_RESERVATION
+
+
+def release(user_id: int):
+    if is_exempt(user_id):
+        return
+    with _lock:
+        _reserved[user_id] -= config.SUMMARY_TOKEN_RESERVATION
+        if _reserved[user_id] <= 0:
+            del _reserved[user_id]
+
+
+def get_remaining_tokens(user_id: int) -> int | None:
+    """Остаток дневного бюджета пользователя; None — без ограничений."""
+    if is_exempt(user_id):
+        return None
+    return max(0, config.SUMMARY_DAILY_TOKEN_BUDGET - usage_ledger.get_user_tokens_for_day(user_id))